@@ -0,0 +1,312 @@
+import functools
+import time
+from collections import OrderedDict
+
+from deathnut.client.deathnut_client import BaseDeathnutClient
+from deathnut.util.logger import get_deathnut_logger
+from deathnut.util.metrics import NoopMetrics
+from deathnut.util.redis import (get_async_redis_connection, is_cluster_connection,
+                                 supports_cluster_transactions)
+
+logger = get_deathnut_logger(__name__)
+
+def timed(operation):
+    """Coroutine version of deathnut.util.metrics.timed"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapped(self, *args, **kwargs):
+            if not self._metrics.enabled:
+                return await func(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await func(self, *args, **kwargs)
+            finally:
+                self._metrics.observe("deathnut_operation_seconds", time.perf_counter() - start,
+                    operation=operation, service=self._name)
+        return wrapped
+    return decorator
+
+def guarded(func):
+    """Coroutine version of deathnut.util.circuit_breaker.guarded"""
+    @functools.wraps(func)
+    async def wrapped(self, *args, **kwargs):
+        breaker = self._breaker
+        if breaker is None:
+            return await func(self, *args, **kwargs)
+        breaker.before_call()
+        start = time.perf_counter()
+        try:
+            result = await func(self, *args, **kwargs)
+        except Exception as exc:
+            breaker.after_call(time.perf_counter() - start, exc)
+            raise
+        breaker.after_call(time.perf_counter() - start)
+        return result
+    return wrapped
+
+class AsyncDeathnutClient(BaseDeathnutClient):
+    def __init__(self, service, resource_type=None, **kwargs):
+        """
+        asyncio counterpart of DeathnutClient backed by redis.asyncio. Every method is a coroutine
+        (get_resources_page is an async iterator) and data is read/written in the same layout, so
+        both clients can be used against the same redis.
+
+        Parameters
+        ----------
+        service: str
+            Name of calling service.
+        resource_type: str
+            Optional name of specific resource being protected, used in the event services have
+            multiple resource types.
+        kwargs: dict
+            Either a redis.asyncio.Redis connection (redis_connection) or redis_host, redis_port,
+            redis_pw, redis_db. See get_async_redis_connection.
+        hash_tag_keys: bool
+            See DeathnutClient.
+        reverse_index: bool
+            See DeathnutClient.
+        metrics: NoopMetrics
+            See DeathnutClient.
+        circuit_breaker: CircuitBreaker
+            See DeathnutClient.
+
+        Note
+        ----
+        Only the default hash storage is supported.
+        """
+        self._client = get_async_redis_connection(**kwargs)
+        self._metrics = kwargs.get("metrics") or NoopMetrics()
+        self._breaker = kwargs.get("circuit_breaker")
+        self._cluster = is_cluster_connection(self._client)
+        self._cluster_transactions = self._cluster and supports_cluster_transactions(self._client)
+        super(AsyncDeathnutClient, self).__init__(service, resource_type,
+            kwargs.get("hash_tag_keys", self._cluster), reverse_index=kwargs.get("reverse_index",
+            False))
+        self._check_and_change_script = None
+
+    def get_redis_connection(self):
+        return self._client
+
+    async def close(self):
+        await self._client.close()
+
+    async def _bulk_change(self, assign, grants, transaction):
+        for user, _, _ in grants:
+            self._check_authenticated(user)
+        if not grants:
+            return
+        queue_action = self._queue_assign if assign else self._queue_revoke
+        batches = self._group_by_user(grants) if transaction and self._cluster else [grants]
+        separate_index = self._index_batches(transaction)
+        for batch in batches:
+            async with self._client.pipeline(transaction=self._transactional(transaction)) as pipe:
+                for user, role, resource_id in batch:
+                    queue_action(pipe, user, role, resource_id)
+                if self._reverse_index and not separate_index:
+                    self._queue_grantees(pipe, assign, batch)
+                await pipe.execute()
+        if separate_index:
+            async with self._client.pipeline(transaction=False) as pipe:
+                self._queue_grantees(pipe, assign, grants)
+                await pipe.execute()
+
+    @timed("assign")
+    @guarded
+    async def assign_role(self, user, role, resource_id):
+        self._check_authenticated(user)
+        logger.debug("Assigning role <%s> to user <%s> for resource <%s>, id <%s>", role, user,
+            self._name, resource_id)
+        await self._bulk_change(True, [(user, role, resource_id)], False)
+
+    @timed("assign")
+    @guarded
+    async def assign_roles(self, grants, transaction=False):
+        """See DeathnutClient.assign_roles"""
+        grants = list(grants)
+        logger.debug("Assigning %d role(s) for resource <%s>", len(grants), self._name)
+        await self._bulk_change(True, grants, transaction)
+
+    @timed("check")
+    @guarded
+    async def check_role(self, user, role, resource_id):
+        return bool(await self._client.hget(self._role_key(user, role), resource_id))
+
+    @timed("check")
+    @guarded
+    async def check_any_role(self, user, roles, resource_id):
+        """See DeathnutClient.check_any_role"""
+        roles = list(roles)
+        if len(roles) == 1:
+            return bool(await self._client.hget(self._role_key(user, roles[0]), resource_id))
+        async with self._client.pipeline(transaction=False) as pipe:
+            for role in roles:
+                pipe.hget(self._role_key(user, role), resource_id)
+            return any(await pipe.execute())
+
+    @timed("check_many")
+    @guarded
+    async def check_roles_many(self, user, role, resource_ids):
+        """See DeathnutClient.check_roles_many"""
+        resource_ids = list(resource_ids)
+        if not resource_ids:
+            return {}
+        values = await self._client.hmget(self._role_key(user, role), resource_ids)
+        return dict((rid, bool(value)) for rid, value in zip(resource_ids, values))
+
+    @timed("check_many")
+    @guarded
+    async def check_any_roles_many(self, user, roles, resource_ids):
+        """See DeathnutClient.check_any_roles_many"""
+        roles = list(roles)
+        resource_ids = list(resource_ids)
+        if not resource_ids:
+            return {}
+        async with self._client.pipeline(transaction=False) as pipe:
+            for role in roles:
+                pipe.hmget(self._role_key(user, role), resource_ids)
+            values = await pipe.execute()
+        return dict((rid, any(role_values[i] for role_values in values))
+            for i, rid in enumerate(resource_ids))
+
+    @timed("check_and_change")
+    @guarded
+    async def check_and_change_roles(self, granter, requires, user, roles, resource_id,
+                                     revoke=False):
+        """See DeathnutClient.check_and_change_roles"""
+        roles = list(roles)
+        if roles:
+            self._check_authenticated(user)
+        logger.info("User <%s> %s role(s) %s for user <%s> on resource <%s>, id <%s>", granter,
+            "revoking" if revoke else "assigning", roles, user, self._name, resource_id)
+        if self._cluster:
+            if not await self._client.hget(self._role_key(granter, requires), resource_id):
+                return False
+            await self._bulk_change(not revoke, [(user, role, resource_id) for role in roles],
+                False)
+            return True
+        if self._check_and_change_script is None:
+            self._check_and_change_script = self._client.register_script(self.CHECK_AND_CHANGE)
+        keys, args = self._check_and_change_args(granter, requires, user, roles, resource_id,
+            resource_id, revoke)
+        return bool(await self._check_and_change_script(keys=keys, args=args, client=self._client))
+
+    @timed("revoke")
+    @guarded
+    async def revoke_role(self, user, role, resource_id):
+        self._check_authenticated(user)
+        logger.debug("Revoking role <%s> from user <%s> for resource <%s>, id <%s>", role, user,
+            self._name, resource_id)
+        await self._bulk_change(False, [(user, role, resource_id)], False)
+
+    @timed("revoke")
+    @guarded
+    async def revoke_roles(self, grants, transaction=False):
+        """See DeathnutClient.revoke_roles"""
+        grants = list(grants)
+        logger.debug("Revoking %d role(s) for resource <%s>", len(grants), self._name)
+        await self._bulk_change(False, grants, transaction)
+
+    @timed("get_grantees")
+    @guarded
+    async def get_grantees(self, resource_id):
+        """See DeathnutClient.get_grantees"""
+        self._check_reverse_index()
+        return self._parse_grantees(await self._client.smembers(self._grantees_key(resource_id)))
+
+    @timed("revoke_all")
+    @guarded
+    async def revoke_all(self, resource_id):
+        """See DeathnutClient.revoke_all"""
+        self._check_reverse_index()
+        key = self._grantees_key(resource_id)
+        if self._cluster:
+            grantees = self._parse_grantees(await self._client.smembers(key))
+            async with self._client.pipeline(transaction=False) as pipe:
+                for user, role in grantees:
+                    self._queue_revoke(pipe, user, role, resource_id)
+                pipe.delete(key)
+                await pipe.execute()
+        else:
+            async def revoke(pipe):
+                found = self._parse_grantees(await pipe.smembers(key))
+                pipe.multi()
+                for user, role in found:
+                    self._queue_revoke(pipe, user, role, resource_id)
+                pipe.delete(key)
+                return found
+            grantees = await self._client.transaction(revoke, key, value_from_callable=True)
+        logger.info("Revoked %d grant(s) on resource <%s>, id <%s>", len(grantees), self._name,
+            resource_id)
+        return grantees
+
+    async def get_resources_page(self, user, role, page_size=10):
+        """
+        Async iterator over pages of resource ids, ex:
+
+            async for page in client.get_resources_page(user, 'view'):
+                ...
+        """
+        cursor = '0'
+        while cursor != 0:
+            cursor, data = await self._client.hscan(self._role_key(user, role), cursor=cursor,
+                count=page_size)
+            yield [x.decode() for x in data]
+
+    @timed("get_resources")
+    @guarded
+    async def get_resources_from(self, user, role, cursor=0, count=500):
+        """See DeathnutClient.get_resources_from"""
+        cursor, data = await self._client.hscan(self._role_key(user, role), cursor=cursor,
+            count=count)
+        return cursor, [x.decode() for x in data]
+
+    @timed("get_resources")
+    @guarded
+    async def get_resources(self, user, role, limit=None):
+        """See DeathnutClient.get_resources"""
+        if limit is None:
+            return [x.decode() for x in await self._client.hgetall(self._role_key(user, role))]
+        ids = []
+        cursor = 0
+        while len(ids) < limit:
+            cursor, batch = await self._client.hscan(self._role_key(user, role), cursor=cursor,
+                count=min(limit, 1000))
+            ids.extend(x.decode() for x in batch)
+            if cursor == 0:
+                break
+        return ids[0:limit]
+
+    @timed("get_resources")
+    @guarded
+    async def get_resources_any_role(self, user, roles, limit=None):
+        """See DeathnutClient.get_resources_any_role"""
+        keys = [self._role_key(user, role) for role in roles]
+        count = 1000 if limit is None else min(limit, 1000)
+        async with self._client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                if limit is None:
+                    pipe.hgetall(key)
+                else:
+                    pipe.hscan(key, cursor=0, count=count)
+            first = await pipe.execute()
+        ids = OrderedDict()
+        for key, raw in zip(keys, first):
+            cursor, data = (0, raw) if limit is None else raw
+            ids.update((x.decode(), None) for x in data)
+            while cursor and len(ids) < limit:
+                cursor, data = await self._client.hscan(key, cursor=cursor, count=count)
+                ids.update((x.decode(), None) for x in data)
+            if limit is not None and len(ids) >= limit:
+                break
+        return list(ids)[0:limit]
+
+    @timed("get_roles")
+    @guarded
+    async def get_roles(self, user):
+        """See DeathnutClient.get_roles"""
+        roles = sorted(x.decode() for x in await self._client.smembers(self._roles_key(user)))
+        async with self._client.pipeline(transaction=False) as pipe:
+            for role in roles:
+                pipe.hgetall(self._role_key(user, role))
+            results = await pipe.execute()
+        return dict((role, [x.decode() for x in ids]) for role, ids in zip(roles, results) if ids)
@@ -0,0 +1,144 @@
+"""
+Interface every deathnut backend implements. Interfaces only talk to their client through it, so
+any backend can be passed to them (backend kwarg) in place of the default redis DeathnutClient.
+"""
+from abc import abstractmethod
+from collections import OrderedDict
+
+from deathnut.util.abstract_classes import ABC
+from deathnut.util.deathnut_exception import DeathnutException
+from deathnut.util.metrics import NoopMetrics
+
+
+class DeathnutBackend(ABC):
+    """
+    Stores which users hold which roles on which resource ids of one service (or service and
+    resource type, see get_name).
+
+    Implementations provide the abstract methods, the others have default implementations built
+    on them which backends can override with cheaper equivalents.
+    """
+    _metrics = NoopMetrics()
+
+    def get_name(self):
+        return self._name
+
+    def get_metrics(self):
+        return self._metrics
+
+    def get_redis_connection(self):
+        """Underlying redis connection, None for backends not using redis"""
+        return None
+
+    def get_circuit_breaker(self):
+        return None
+
+    def get_cache_stats(self):
+        return None
+
+    def flush(self, timeout=None):
+        """Waits for buffered writes, if the backend buffers any. False on timeout"""
+        return True
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def assign_roles(self, grants, transaction=False):
+        """Assigns (user, role, resource_id) grants, all or none of them if transaction is set"""
+
+    @abstractmethod
+    def revoke_roles(self, grants, transaction=False):
+        """Revokes (user, role, resource_id) grants, all or none of them if transaction is set"""
+
+    @abstractmethod
+    def check_role(self, user, role, resource_id):
+        pass
+
+    @abstractmethod
+    def check_roles_many(self, user, role, resource_ids):
+        """Returns a dict of each resource_id to whether user has role for it"""
+
+    @abstractmethod
+    def get_resources_from(self, user, role, cursor=0, count=500):
+        """
+        Returns (next_cursor, ids): about count of the ids user has role for starting at the
+        integer cursor (0 to start). next_cursor is 0 once every id was returned.
+        """
+
+    @abstractmethod
+    def get_roles(self, user):
+        """Returns a dict of role -> resource ids for every role the user holds"""
+
+    @abstractmethod
+    def scan_grants(self, count=1000):
+        """Yields (user, role, resource_ids) batches covering every grant of the service"""
+
+    def assign_role(self, user, role, resource_id):
+        self.assign_roles([(user, role, resource_id)])
+
+    def revoke_role(self, user, role, resource_id):
+        self.revoke_roles([(user, role, resource_id)])
+
+    def check_any_role(self, user, roles, resource_id):
+        return any(self.check_role(user, role, resource_id) for role in roles)
+
+    def check_any_roles_many(self, user, roles, resource_ids):
+        """Returns a dict of each resource_id to whether user holds any of roles for it"""
+        resource_ids = list(resource_ids)
+        allowed = set()
+        for role in roles:
+            pending = [rid for rid in resource_ids if rid not in allowed]
+            if not pending:
+                break
+            granted = self.check_roles_many(user, role, pending)
+            allowed.update(rid for rid in pending if granted[rid])
+        return dict((rid, rid in allowed) for rid in resource_ids)
+
+    def check_and_change_roles(self, granter, requires, user, roles, resource_id, revoke=False):
+        """
+        Assigns (or revokes) roles on resource_id to user if granter holds requires on it, returns
+        False otherwise. The default checks then writes, backends should make this atomic.
+        """
+        if not self.check_role(granter, requires, resource_id):
+            return False
+        change = self.revoke_roles if revoke else self.assign_roles
+        change([(user, role, resource_id) for role in roles])
+        return True
+
+    def get_resources(self, user, role, limit=None):
+        ids = []
+        cursor = 0
+        while limit is None or len(ids) < limit:
+            cursor, batch = self.get_resources_from(user, role, cursor)
+            ids.extend(batch)
+            if cursor == 0:
+                break
+        return ids[0:limit]
+
+    def get_resources_any_role(self, user, roles, limit=None):
+        """
+        Returns the ids user holds any of roles for, those of the first role first and without
+        duplicates, at most limit of them.
+        """
+        ids = OrderedDict()
+        for role in roles:
+            ids.update((rid, None) for rid in self.get_resources(user, role,
+                None if limit is None else limit - len(ids)))
+            if limit is not None and len(ids) >= limit:
+                break
+        return list(ids)[0:limit]
+
+    def get_resources_page(self, user, role, page_size=10):
+        cursor = None
+        while cursor != 0:
+            cursor, ids = self.get_resources_from(user, role, cursor or 0, page_size)
+            yield ids
+
+    def get_grantees(self, resource_id):
+        """Returns the sorted (user, role) pairs granted on resource_id"""
+        raise DeathnutException("Grantee lookups are not supported by this backend")
+
+    def revoke_all(self, resource_id):
+        """Revokes every role any user holds on resource_id, returns the (user, role) pairs"""
+        raise DeathnutException("Grantee lookups are not supported by this backend")
@@ -1,10 +1,154 @@
+import itertools
+from collections import OrderedDict
+
+from deathnut.client.backend import DeathnutBackend
+from deathnut.client.storage import HashStorage, MigratingStorage, get_storage
+from deathnut.util.cache import MISSING, DecisionCache, LRUCache
+from deathnut.util.circuit_breaker import guarded
 from deathnut.util.deathnut_exception import DeathnutException
 from deathnut.util.logger import get_deathnut_logger
-from deathnut.util.redis import get_redis_connection
+from deathnut.util.metrics import NoopMetrics, timed
+from deathnut.util.redis import (KeyspaceListener, get_redis_connection,
+                                 get_redis_replicas, is_cluster_connection,
+                                 supports_cluster_transactions)
+from deathnut.util.write_behind import WriteBehindQueue
 
 logger = get_deathnut_logger(__name__)
 
-class DeathnutClient(object):
+class BaseDeathnutClient(object):
+    """Key naming, validation and command queuing shared by the sync and asyncio clients"""
+    # Checks the granter's role and applies every grant/revoke of the grantee atomically, see
+    # _check_and_change_args for the KEYS/ARGV layout. Returns 0 if the granter lacks the role.
+    # True once a role key holds no ids: emptied hashes/sets are deleted, bitmaps have no bit set.
+    _EMPTY_ROLE = """
+    local function empty(key)
+        if redis.call('EXISTS', key) == 0 then
+            return true
+        end
+        return redis.call('TYPE', key).ok == 'string' and redis.call('BITCOUNT', key) == 0
+    end
+    """
+    # Drops ARGV[1] from the role index KEYS[2] once a revoke left role key KEYS[1] empty.
+    PRUNE_ROLE = _EMPTY_ROLE + """
+    if empty(KEYS[1]) then
+        redis.call('SREM', KEYS[2], ARGV[1])
+    end
+    """
+    CHECK_AND_CHANGE = _EMPTY_ROLE + """
+    local allowed = redis.call(ARGV[2], KEYS[1], ARGV[1])
+    if not allowed or allowed == 0 then
+        return 0
+    end
+    local revoke = ARGV[3] == '1'
+    for i = 4, #KEYS do
+        if ARGV[5] == '' then
+            redis.call(ARGV[4], KEYS[i], ARGV[1])
+        else
+            redis.call(ARGV[4], KEYS[i], ARGV[1], ARGV[5])
+        end
+        local role = ARGV[i + 3]
+        if not revoke then
+            redis.call('SADD', KEYS[2], role)
+        elseif empty(KEYS[i]) then
+            redis.call('SREM', KEYS[2], role)
+        end
+        if ARGV[6] ~= '' then
+            if revoke then
+                redis.call('SREM', KEYS[3], role .. ':' .. ARGV[6])
+            else
+                redis.call('SADD', KEYS[3], role .. ':' .. ARGV[6])
+            end
+        end
+    end
+    return 1
+    """
+
+    def __init__(self, service, resource_type=None, hash_tag_keys=False, storage=None,
+                 reverse_index=False):
+        if resource_type:
+            self._name = "{}_{}".format(service, resource_type)
+        else:
+            self._name = service
+        self._hash_tag_keys = hash_tag_keys
+        self._storage = storage or HashStorage()
+        self._storage.bind(self._name)
+        self._reverse_index = reverse_index
+
+    def _user_tag(self, user):
+        # '{user}' makes redis cluster hash only the user id, so all of a user's keys share a slot.
+        return "{{{}}}".format(user) if self._hash_tag_keys else user
+
+    def _check_authenticated(self, user):
+        if user == "Unauthenticated":
+            raise DeathnutException("Unauthenticated user cannot be granted/removed from roles")
+
+    def _role_key(self, user, role):
+        return "{}:{}:{}".format(self._name, self._user_tag(user), role)
+
+    def _roles_key(self, user):
+        return "{}-roles:{}".format(self._name, self._user_tag(user))
+
+    def _grantees_key(self, resource_id):
+        return "{}-grantees:{}".format(self._name, resource_id)
+
+    def _check_reverse_index(self):
+        if not self._reverse_index:
+            raise DeathnutException("Grantee lookups require the client to be created with "
+                "reverse_index=True")
+
+    def _parse_grantees(self, grantees):
+        # members are 'role:user', roles never contain ':' (see rebuild_role_index)
+        return sorted(tuple(reversed(x.decode().split(":", 1))) for x in grantees)
+
+    def _group_by_user(self, grants):
+        by_user = {}
+        for grant in grants:
+            by_user.setdefault(grant[0], []).append(grant)
+        return list(by_user.values())
+
+    def _queue_assign(self, pipe, user, role, member):
+        self._storage.queue_assign(pipe, self._role_key(user, role), member)
+        pipe.sadd(self._roles_key(user), role)
+
+    def _queue_revoke(self, pipe, user, role, member):
+        self._storage.queue_revoke(pipe, self._role_key(user, role), member)
+        # both keys must share a slot on cluster, which only hash tagged keys guarantee
+        if not self._cluster or self._hash_tag_keys:
+            pipe.eval(self.PRUNE_ROLE, 2, self._role_key(user, role), self._roles_key(user), role)
+
+    def _queue_grantees(self, pipe, assign, grants):
+        for user, role, resource_id in grants:
+            grantee = "{}:{}".format(role, user)
+            if assign:
+                pipe.sadd(self._grantees_key(resource_id), grantee)
+            else:
+                pipe.srem(self._grantees_key(resource_id), grantee)
+
+    def _check_and_change_args(self, granter, requires, user, roles, resource_id, member, revoke):
+        """
+        KEYS: granter's role key, grantee's role index, resource's grantee set, grantee's role keys
+        ARGV: member, check command, revoke flag, write command, write value, grantee user (only
+        with the reverse index), roles
+        """
+        command, value = self._storage.revoke_command if revoke else self._storage.assign_command
+        keys = [self._role_key(granter, requires), self._roles_key(user),
+                self._grantees_key(resource_id)] + [self._role_key(user, role) for role in roles]
+        args = [member, self._storage.check_command, int(revoke), command,
+                "" if value is None else value, user if self._reverse_index else ""] + list(roles)
+        return keys, args
+
+    def _transactional(self, transaction):
+        """
+        Whether bulk change pipelines run in MULTI/EXEC. Cluster clients whose pipelines do not
+        support transactions fall back to plain per user pipelines.
+        """
+        return transaction and (not self._cluster or self._cluster_transactions)
+
+    def _index_batches(self, transaction):
+        """Whether grantee updates need their own pipeline: on cluster they span slots"""
+        return self._reverse_index and transaction and self._cluster
+
+class DeathnutClient(BaseDeathnutClient, DeathnutBackend):
     def __init__(self, service, resource_type=None, **kwargs):
         """
         Parameters
@@ -19,68 +163,679 @@ class DeathnutClient(object):
             deathnut client to inject their own) OR the specification or redis_host, redis_port,
             redis_pw, redis_db in which case we will attempt to establish a redis connection for
             the client.
+        decision_cache_size: int
+            If set, check_role decisions (positive and negative) are kept in a bounded in-process
+            LRU cache of this many entries.
+        decision_cache_ttl: float
+            Seconds a cached decision stays valid (default 5). Bounds staleness should an
+            invalidation be missed.
+        decision_cache_invalidation: bool
+            If True (default), a background thread subscribes to keyspace notifications on this
+            client's hashes and drops cached decisions for any key modified by another process.
+            Requires notify-keyspace-events to include 'Kgh' on the redis server. Not available
+            on Redis Cluster, where cached decisions only expire through decision_cache_ttl.
+        hash_tag_keys: bool
+            If True keys are laid out as '{service}:{{user}}:{role}' so that all keys of a user
+            hash to the same cluster slot and multi-key operations stay cluster safe. Defaults to
+            True for Redis Cluster connections and False otherwise (existing single node data uses
+            the untagged layout).
+        storage: str or storage instance
+            Layout of role data, see deathnut.client.storage. "hash" (default) keeps one hash of
+            resource ids per (user, role). "bitmap" keeps one bitmap per (user, role) indexed by
+            integer resource id, which is far smaller for dense integer ids; pass
+            BitmapStorage(RedisIdMapper()) to map arbitrary ids to dense offsets. Keyspace
+            invalidation of bitmaps additionally requires '$' in notify-keyspace-events.
+        migrate_from: str or storage instance
+            Layout the data is being migrated from (ex: "set") while deathnut.tools.migrate
+            converts keys to storage. Each key is read and written in the layout it currently
+            has, at the cost of a small Lua script per check/write. Drop once migrated.
+        reverse_index: bool
+            If True, a set of 'role:user' grantees is kept per resource ('{service}-grantees:{id}')
+            alongside every assign/revoke, enabling get_grantees and revoke_all. Only grants made
+            while the index is enabled are tracked. On Redis Cluster, transactional bulk changes
+            update the index in a separate pipeline after the per user transactions.
+        redis_replicas: list
+            Read replicas, as redis.Redis connections or dicts of connection kwargs (see
+            get_redis_connection). check_role, check_roles_many, get_resources* and get_roles
+            are spread over the replicas round robin, writes always go to the primary.
+        redis_sentinel: dict
+            Alternative to redis_host/redis_replicas: {"sentinels": [(host, port), ...],
+            "service_name": str, "password": str}. The primary and replicas are discovered
+            through sentinel.
+        read_your_writes: float
+            Seconds after a user's roles are changed through this client during which reads of
+            that user's data are sent to the primary, hiding replication lag (default 1).
+        metrics: NoopMetrics
+            Instrumentation hook, ex: deathnut.util.metrics.PrometheusMetrics. Latency of every
+            public operation is recorded as deathnut_operation_seconds. Defaults to NoopMetrics.
+        circuit_breaker: CircuitBreaker
+            If set, public operations fail fast with CircuitOpenError (a redis ConnectionError)
+            while redis is failing or slow, see deathnut.util.circuit_breaker. Can be shared with
+            other clients of the same redis.
+        write_behind: bool
+            If True, assign_role/revoke_role and non-transactional assign_roles/revoke_roles
+            return once the change is queued, a background thread writes queued changes in
+            coalesced pipelines (see deathnut.util.write_behind). check_role, check_any_role and
+            check_roles_many see queued changes immediately, get_resources*/get_roles only once
+            written. Call flush() (or close()) to wait for queued changes, this also happens at
+            interpreter exit.
+        write_behind_queue_size: int
+            Queued changes beyond which write calls block (default 10000).
+        write_behind_interval: float
+            Seconds a queued change may wait to be batched with others (default 0.005).
+        write_behind_batch_size: int
+            Maximum changes written per pipeline (default 500).
         """
         self._client = get_redis_connection(**kwargs)
-        if resource_type:
-            self._name = "{}_{}".format(service, resource_type)
-        else:
-            self._name = service
+        self._metrics = kwargs.get("metrics") or NoopMetrics()
+        self._breaker = kwargs.get("circuit_breaker")
+        self._replicas = get_redis_replicas(**kwargs)
+        self._replica_counter = itertools.count()
+        self._recent_writes = LRUCache(maxsize=10000, ttl=kwargs.get("read_your_writes", 1.0))
+        self._cluster = is_cluster_connection(self._client)
+        self._cluster_transactions = self._cluster and supports_cluster_transactions(self._client)
+        storage = get_storage(kwargs.get("storage"))
+        if kwargs.get("migrate_from"):
+            storage = MigratingStorage(get_storage(kwargs["migrate_from"]), storage)
+        super(DeathnutClient, self).__init__(service, resource_type,
+            kwargs.get("hash_tag_keys", self._cluster), storage, kwargs.get("reverse_index", False))
+        self._check_and_change_script = None
+        self._cache = None
+        self._cache_listener = None
+        self._write_behind = None
+        if kwargs.get("write_behind"):
+            self._write_behind = WriteBehindQueue(
+                lambda assign, grants: self._bulk_change(assign, grants, False),
+                kwargs.get("write_behind_queue_size", 10000),
+                kwargs.get("write_behind_interval", 0.005),
+                kwargs.get("write_behind_batch_size", 500))
+        if kwargs.get("decision_cache_size"):
+            self._cache = DecisionCache(kwargs["decision_cache_size"],
+                kwargs.get("decision_cache_ttl", 5.0))
+            if self._cluster:
+                logger.warning("Keyspace invalidation of the decision cache is not supported on "
+                    "Redis Cluster, relying on decision_cache_ttl")
+            elif kwargs.get("decision_cache_invalidation", True):
+                self._cache_listener = KeyspaceListener(self._client, "{}:*".format(self._name),
+                    self._cache.invalidate_redis_key, self._cache.clear)
 
     def get_redis_connection(self):
         return self._client
 
-    def _check_authenticated(self, user):
-        if user == "Unauthenticated":
-            raise DeathnutException("Unauthenticated user cannot be granted/removed from roles")
+    def get_name(self):
+        return self._name
+
+    def get_metrics(self):
+        return self._metrics
+
+    def get_circuit_breaker(self):
+        return self._breaker
+
+    def get_cache_stats(self):
+        """Returns hit/miss counters of the decision cache, or None if caching is disabled"""
+        return self._cache.stats() if self._cache is not None else None
+
+    def flush(self, timeout=None):
+        """Waits for changes queued in write_behind mode to be written, False on timeout"""
+        return self._write_behind is None or self._write_behind.flush(timeout)
 
+    def close(self):
+        if self._write_behind is not None:
+            self._write_behind.close()
+        if self._cache_listener:
+            self._cache_listener.stop()
+            self._cache_listener = None
+
+    def _after_write(self, grants):
+        if self._cache is not None:
+            for user, role, resource_id in grants:
+                self._cache.invalidate((self._role_key(user, role), resource_id))
+        if self._replicas:
+            for user in set(grant[0] for grant in grants):
+                self._recent_writes.set(user, True)
+
+    def _reader(self, user):
+        """Connection to read user's data from: a replica unless the user was recently written"""
+        if not self._replicas or self._recent_writes.get(user) is not MISSING:
+            return self._client
+        return self._replicas[next(self._replica_counter) % len(self._replicas)]
+
+    def _change(self, assign, grants, transaction):
+        """Writes grants, or queues them in write_behind mode"""
+        if self._write_behind is None or transaction:
+            self.flush()
+            return self._bulk_change(assign, grants, transaction)
+        for user, _, _ in grants:
+            self._check_authenticated(user)
+        self._write_behind.put(assign, grants)
+
+    def _pending(self, user, role, resource_id):
+        """Queued, unwritten assign (True) or revoke (False) of the grant, None if there is none"""
+        if self._write_behind is None:
+            return None
+        return self._write_behind.pending(user, role, resource_id)
+
+    def _bulk_change(self, assign, grants, transaction):
+        for user, _, _ in grants:
+            self._check_authenticated(user)
+        if not grants:
+            return
+        queue_action = self._queue_assign if assign else self._queue_revoke
+        resource_ids = list(OrderedDict.fromkeys(grant[2] for grant in grants))
+        members = dict(zip(resource_ids, self._storage.encode(self._client, resource_ids, assign)))
+        # cluster transactions cannot span slots, keys are only co-located per user.
+        batches = self._group_by_user(grants) if transaction and self._cluster else [grants]
+        separate_index = self._index_batches(transaction)
+        try:
+            for batch in batches:
+                pipe = self._client.pipeline(transaction=self._transactional(transaction))
+                for user, role, resource_id in batch:
+                    # ids unknown to the storage's id mapper were never granted, nothing to revoke
+                    if members[resource_id] is not None:
+                        queue_action(pipe, user, role, members[resource_id])
+                if self._reverse_index and not separate_index:
+                    self._queue_grantees(pipe, assign, batch)
+                pipe.execute()
+            if separate_index:
+                pipe = self._client.pipeline(transaction=False)
+                self._queue_grantees(pipe, assign, grants)
+                pipe.execute()
+        finally:
+            self._after_write(grants)
+
+    @timed("assign")
+    @guarded
     def assign_role(self, user, role, resource_id):
         self._check_authenticated(user)
-        logger.warn("Assigning role <{}> to user <{}> for resource <{}>, id <{}>".format(role, user,
-            self._name, resource_id))
-        #self._client.sadd("{}:{}:{}".format(self._name, user, role), resource_id)
-        self._client.hset("{}:{}:{}".format(self._name, user, role), resource_id, 1)
+        logger.debug("Assigning role <%s> to user <%s> for resource <%s>, id <%s>", role, user,
+            self._name, resource_id)
+        self._change(True, [(user, role, resource_id)], False)
+
+    @timed("assign")
+    @guarded
+    def assign_roles(self, grants, transaction=False):
+        """
+        Assigns many roles in a single pipelined round trip.
+
+        Parameters
+        ----------
+        grants: iterable
+            (user, role, resource_id) tuples to assign.
+        transaction: bool
+            If True, the pipeline is wrapped in MULTI/EXEC so either all grants apply or none do.
+            On Redis Cluster the guarantee holds per user (one transaction per user), and only if
+            the installed cluster client supports pipeline transactions; otherwise each user's
+            changes are sent as one pipeline without MULTI/EXEC.
+        """
+        grants = list(grants)
+        logger.debug("Assigning %d role(s) for resource <%s>", len(grants), self._name)
+        self._change(True, grants, transaction)
+
+    def _check(self, user, key, resource_id):
+        member = self._storage.encode(self._client, [resource_id])[0]
+        return member is not None and self._storage.check(self._reader(user), key, member)
 
+    @timed("check")
+    @guarded
     def check_role(self, user, role, resource_id):
-        #return bool(self._client.sismember("{}:{}:{}".format(self._name, user, role), resource_id))
-        return bool(self._client.hget("{}:{}:{}".format(self._name, user, role), resource_id))
+        return self._check_role(user, role, resource_id)
+
+    def _check_role(self, user, role, resource_id):
+        pending = self._pending(user, role, resource_id)
+        if pending is not None:
+            return pending
+        key = self._role_key(user, role)
+        if self._cache is None:
+            return self._check(user, key, resource_id)
+        allowed = self._cache.get((key, resource_id))
+        if allowed is MISSING:
+            generation = self._cache.generation()
+            allowed = self._check(user, key, resource_id)
+            self._cache.set((key, resource_id), allowed, generation)
+        return allowed
+
+    @timed("check")
+    @guarded
+    def check_any_role(self, user, roles, resource_id):
+        """
+        Returns whether user holds any of roles on resource_id. Cached decisions are consulted
+        first (in order, stopping at the first granted role); the remaining roles are checked in
+        a single pipeline.
+        """
+        roles = list(roles)
+        if self._write_behind is not None:
+            pending = [self._pending(user, role, resource_id) for role in roles]
+            if True in pending:
+                return True
+            roles = [role for role, queued in zip(roles, pending) if queued is None]
+            if not roles:
+                return False
+        if len(roles) == 1:
+            return self._check_role(user, roles[0], resource_id)
+        keys = [self._role_key(user, role) for role in roles]
+        generation = None
+        if self._cache is not None:
+            generation = self._cache.generation()
+            cached = [self._cache.get((key, resource_id)) for key in keys]
+            if True in cached:
+                return True
+            keys = [key for key, allowed in zip(keys, cached) if allowed is MISSING]
+        if not keys:
+            return False
+        member = self._storage.encode(self._client, [resource_id])[0]
+        if member is None:
+            return False
+        pipe = self._reader(user).pipeline(transaction=False)
+        for key in keys:
+            self._storage.queue_check(pipe, key, member)
+        allowed = [bool(x) for x in pipe.execute()]
+        if self._cache is not None:
+            for key, value in zip(keys, allowed):
+                self._cache.set((key, resource_id), value, generation)
+        return any(allowed)
+
+    @timed("check_many")
+    @guarded
+    def check_roles_many(self, user, role, resource_ids):
+        """
+        Checks a role for many resource ids in a single round trip (HMGET, or pipelined GETBIT
+        with bitmap storage).
+
+        Returns
+        -------
+        dict
+            Mapping of each resource_id to whether the user has the role for it.
+        """
+        return self._check_roles_many(user, role, resource_ids)
+
+    def _check_roles_many(self, user, role, resource_ids):
+        key = self._role_key(user, role)
+        result = {}
+        if self._write_behind is not None:
+            resource_ids = list(resource_ids)
+            for rid in resource_ids:
+                pending = self._pending(user, role, rid)
+                if pending is not None:
+                    result[rid] = pending
+            resource_ids = [rid for rid in resource_ids if rid not in result]
+        if self._cache is None:
+            missing = list(resource_ids)
+        else:
+            missing = []
+            for rid in resource_ids:
+                allowed = self._cache.get((key, rid))
+                if allowed is MISSING:
+                    missing.append(rid)
+                else:
+                    result[rid] = allowed
+        if missing:
+            generation = self._cache.generation() if self._cache is not None else None
+            members = self._storage.encode(self._client, missing)
+            known = [member for member in members if member is not None]
+            values = iter(self._storage.check_many(self._reader(user), key, known) if known else [])
+            for rid, member in zip(missing, members):
+                result[rid] = member is not None and next(values)
+                if self._cache is not None:
+                    self._cache.set((key, rid), result[rid], generation)
+        return result
+
+    def _known(self, user, role, resource_id):
+        """Decision from queued writes or the decision cache, MISSING if redis must be asked"""
+        pending = self._pending(user, role, resource_id)
+        if pending is not None:
+            return pending
+        if self._cache is None:
+            return MISSING
+        return self._cache.get((self._role_key(user, role), resource_id))
+
+    @timed("check_many")
+    @guarded
+    def check_any_roles_many(self, user, roles, resource_ids):
+        """
+        Checks whether user holds any of roles (ex: a role and the roles implying it) for each of
+        resource_ids. Every (role, resource_id) pair not answered by queued writes or the decision
+        cache is checked in a single pipeline.
+
+        Returns
+        -------
+        dict
+            Mapping of each resource_id to whether the user holds any of the roles for it.
+        """
+        roles = list(roles)
+        if len(roles) == 1:
+            return self._check_roles_many(user, roles[0], resource_ids)
+        resource_ids = list(resource_ids)
+        result = dict((rid, False) for rid in resource_ids)
+        unknown = []
+        for rid in resource_ids:
+            known = [self._known(user, role, rid) for role in roles]
+            if True in known:
+                result[rid] = True
+            else:
+                unknown.extend((role, rid) for role, allowed in zip(roles, known)
+                    if allowed is MISSING)
+        if not unknown:
+            return result
+        generation = self._cache.generation() if self._cache is not None else None
+        missing = list(OrderedDict.fromkeys(rid for _, rid in unknown))
+        members = dict(zip(missing, self._storage.encode(self._client, missing)))
+        queued = [(role, rid) for role, rid in unknown if members[rid] is not None]
+        pipe = self._reader(user).pipeline(transaction=False)
+        for role, rid in queued:
+            self._storage.queue_check(pipe, self._role_key(user, role), members[rid])
+        values = dict(zip(queued, (bool(x) for x in pipe.execute()))) if queued else {}
+        for role, rid in unknown:
+            allowed = values.get((role, rid), False)
+            result[rid] = result[rid] or allowed
+            if self._cache is not None:
+                self._cache.set((self._role_key(user, role), rid), allowed, generation)
+        return result
+
+    @timed("check_and_change")
+    @guarded
+    def check_and_change_roles(self, granter, requires, user, roles, resource_id, revoke=False):
+        """
+        Assigns (or revokes) roles on resource_id to user only if granter holds role requires on
+        it. The check and all writes run in one Lua script (loaded once, then sent by EVALSHA), so
+        this takes a single round trip and the granter's role cannot be revoked between check and
+        write. On Redis Cluster the granter's and grantee's keys live in different slots and the
+        check is followed by a separate pipelined write instead, as it is while migrating layouts.
 
+        Returns
+        -------
+        bool
+            False if granter does not hold requires, in which case nothing was changed.
+        """
+        roles = list(roles)
+        if roles:
+            self._check_authenticated(user)
+        self.flush()
+        # never allocate here: an id the granter holds a role on is already known to the storage's
+        # id mapper, unknown ids were never granted to anyone (granter included) so nothing changes
+        member = self._storage.encode(self._client, [resource_id])[0]
+        if member is None:
+            return False
+        logger.info("User <%s> %s role(s) %s for user <%s> on resource <%s>, id <%s>", granter,
+            "revoking" if revoke else "assigning", roles, user, self._name, resource_id)
+        if self._cluster or self._storage.check_command is None:
+            if not self._storage.check(self._client, self._role_key(granter, requires), member):
+                return False
+            self._bulk_change(not revoke, [(user, role, resource_id) for role in roles], False)
+            return True
+        if self._check_and_change_script is None:
+            self._check_and_change_script = self._client.register_script(self.CHECK_AND_CHANGE)
+        keys, args = self._check_and_change_args(granter, requires, user, roles, resource_id,
+            member, revoke)
+        try:
+            return bool(self._check_and_change_script(keys=keys, args=args, client=self._client))
+        finally:
+            self._after_write([(user, role, resource_id) for role in roles])
+
+    @timed("revoke")
+    @guarded
     def revoke_role(self, user, role, resource_id):
         self._check_authenticated(user)
-        logger.warn("Revoking role <{}> from user <{}> for resource <{}>, id <{}>".format(role,
-            user, self._name, resource_id))
-        # self._client.srem("{}:{}:{}".format(self._name, user, role), resource_id)
-        self._client.hdel("{}:{}:{}".format(self._name, user, role), resource_id)
+        logger.debug("Revoking role <%s> from user <%s> for resource <%s>, id <%s>", role, user,
+            self._name, resource_id)
+        self._change(False, [(user, role, resource_id)], False)
 
-    def get_resources_page(self, user, role, page_size=10):
-        cursor = '0'
-        while cursor != 0:
-            # cursor, data = self._client.sscan("{}:{}:{}".format(self._name, user, role),
-            #     cursor=cursor, count=page_size)
-            # yield [x.decode() for x in data]
-            cursor, data = self._client.hscan("{}:{}:{}".format(self._name, user, role),
-                cursor=cursor, count=page_size)
-            yield [x[0].decode() for x in data.items()]
+    @timed("revoke")
+    @guarded
+    def revoke_roles(self, grants, transaction=False):
+        """
+        Revokes many roles in a single pipelined round trip.
 
-    def get_resources(self, user, role, limit=None):
+        Parameters
+        ----------
+        grants: iterable
+            (user, role, resource_id) tuples to revoke.
+        transaction: bool
+            If True, the pipeline is wrapped in MULTI/EXEC so either all revokes apply or none do.
+            On Redis Cluster the guarantee holds per user (one transaction per user), and only if
+            the installed cluster client supports pipeline transactions; otherwise each user's
+            changes are sent as one pipeline without MULTI/EXEC.
+        """
+        grants = list(grants)
+        logger.debug("Revoking %d role(s) for resource <%s>", len(grants), self._name)
+        self._change(False, grants, transaction)
+
+    @timed("get_grantees")
+    @guarded
+    def get_grantees(self, resource_id):
+        """
+        Returns the sorted (user, role) pairs granted on resource_id, read from the reverse index
+        with a single SMEMBERS. Requires reverse_index=True.
+        """
+        self._check_reverse_index()
+        return self._parse_grantees(self._client.smembers(self._grantees_key(resource_id)))
+
+    @timed("revoke_all")
+    @guarded
+    def revoke_all(self, resource_id):
+        """
+        Revokes every role any user holds on resource_id, ex: when the resource is deleted.
+        Requires reverse_index=True.
+
+        The grantee set is read under WATCH and all revokes are applied in one MULTI/EXEC, retried
+        should the set change in between (on cluster: read, then one non-transactional pipeline).
+
+        Returns
+        -------
+        list
+            The (user, role) pairs that were revoked.
+        """
+        self._check_reverse_index()
+        self.flush()
+        key = self._grantees_key(resource_id)
+        if self._cluster:
+            grantees = self._parse_grantees(self._client.smembers(key))
+            pipe = self._client.pipeline(transaction=False)
+            self._queue_revoke_all(pipe, resource_id, grantees)
+            pipe.execute()
+        else:
+            def revoke(pipe):
+                found = self._parse_grantees(pipe.smembers(key))
+                pipe.multi()
+                self._queue_revoke_all(pipe, resource_id, found)
+                return found
+            grantees = self._client.transaction(revoke, key, value_from_callable=True)
+        logger.info("Revoked %d grant(s) on resource <%s>, id <%s>", len(grantees), self._name,
+            resource_id)
+        self._after_write([(user, role, resource_id) for user, role in grantees])
+        return grantees
+
+    def _queue_revoke_all(self, pipe, resource_id, grantees):
+        member = self._storage.encode(self._client, [resource_id])[0]
+        if member is not None:
+            for user, role in grantees:
+                self._queue_revoke(pipe, user, role, member)
+        pipe.delete(self._grantees_key(resource_id))
+
+    def get_resources_page(self, user, role, page_size=10):
         """
         Note
         ----
         In real redis, page_size is just a suggestion. If a value less than hash-max-ziplist-entries
         is provided, it will be ignored. See https://redis.io/commands/scan.
         """
-        # ids = list(self._client.smembers("{}:{}:{}".format(self._name, user, role)))
-        # return [x.decode() for x in ids][0:limit]
-        ids = list(self._client.hgetall("{}:{}:{}".format(self._name, user, role)))
-        return [x.decode() for x in ids][0:limit]
+        cursor = '0'
+        while cursor != 0:
+            cursor, data = self._storage.scan(self._reader(user), self._role_key(user, role),
+                cursor, page_size)
+            yield self._storage.decode(self._client, data)
+
+    @timed("get_resources")
+    @guarded
+    def get_resources_from(self, user, role, cursor=0, count=500):
+        """
+        Fetches one HSCAN batch of resource ids starting at cursor (with bitmap storage the
+        cursor is a bit offset into the bitmap).
+
+        Returns
+        -------
+        tuple
+            (next_cursor, ids). next_cursor is 0 once the whole hash has been visited. count is a
+            hint, redis may return more ids (small hashes are always returned whole). Bitmap
+            batches hold at most count ids.
+        """
+        cursor, data = self._storage.scan(self._reader(user), self._role_key(user, role), cursor,
+            count)
+        return cursor, self._storage.decode(self._client, data)
 
+    @timed("get_resources")
+    @guarded
+    def get_resources(self, user, role, limit=None):
+        """
+        Returns resource ids the user has role for, at most limit of them. With a limit the hash
+        is walked with HSCAN and iteration stops as soon as enough ids were collected, instead of
+        fetching (and decoding) every field.
+        """
+        return self._get_resources(user, role, limit)
+
+    def _get_resources(self, user, role, limit=None):
+        if limit is None:
+            members = self._storage.members(self._reader(user), self._role_key(user, role))
+            return self._storage.decode(self._client, members)
+        ids = []
+        cursor = 0
+        while len(ids) < limit:
+            cursor, batch = self._storage.scan(self._reader(user), self._role_key(user, role),
+                cursor, min(limit, 1000))
+            ids.extend(self._storage.decode(self._client, batch))
+            if cursor == 0:
+                break
+        return ids[0:limit]
+
+    @timed("get_resources")
+    @guarded
+    def get_resources_any_role(self, user, roles, limit=None):
+        """
+        Returns resource ids user holds any of roles for, those of the first role first and
+        without duplicates, at most limit of them. The ids of every role (with a limit: their first
+        scan batch) are fetched in a single pipeline, further batches only if more are needed.
+        """
+        roles = list(roles)
+        if len(roles) == 1:
+            return self._get_resources(user, roles[0], limit)
+        reader = self._reader(user)
+        keys = [self._role_key(user, role) for role in roles]
+        count = 1000 if limit is None else min(limit, 1000)
+        first = None
+        if limit is None or self._storage.queue_scan is not None:
+            pipe = reader.pipeline(transaction=False)
+            for key in keys:
+                if limit is None:
+                    self._storage.queue_members(pipe, key)
+                else:
+                    self._storage.queue_scan(pipe, key, 0, count)
+            first = pipe.execute()
+        ids = OrderedDict()
+        for i, key in enumerate(keys):
+            if first is None:
+                cursor, members = self._storage.scan(reader, key, 0, count)
+            elif limit is None:
+                cursor, members = 0, self._storage.parse_members(first[i])
+            else:
+                cursor, members = self._storage.parse_scan(first[i], 0, count)
+            ids.update((rid, None) for rid in self._storage.decode(self._client, members))
+            while cursor and len(ids) < limit:
+                cursor, members = self._storage.scan(reader, key, cursor, count)
+                ids.update((rid, None) for rid in self._storage.decode(self._client, members))
+            if limit is not None and len(ids) >= limit:
+                break
+        return list(ids)[0:limit]
+
+    @timed("get_roles")
+    @guarded
     def get_roles(self, user):
+        """
+        Returns a dict of role -> resource ids for every role the user holds.
+
+        Roles are read from the per-user role index maintained on assignment (see
+        rebuild_role_indexes for data written before the index existed), then all role hashes are
+        fetched in one pipeline.
+        """
+        reader = self._reader(user)
+        roles = sorted(x.decode() for x in reader.smembers(self._roles_key(user)))
+        pipe = reader.pipeline(transaction=False)
+        for role in roles:
+            self._storage.queue_members(pipe, self._role_key(user, role))
         res = {}
-        # for key in self._client.keys("{}:{}*".format(self._name, user)):
-        #     role = key.decode().split(':')[-1]
-        #     role_result = self.get_resources(user, role)
-        #     res[role] = role_result
-        for key in self._client.keys("{}:{}*".format(self._name, user)):
-            role = key.decode().split(':')[-1]
-            role_result = self.get_resources(user, role)
-            res[role] = role_result
+        for role, raw in zip(roles, pipe.execute()):
+            members = self._storage.parse_members(raw)
+            # revokes prune the index, but data revoked by older clients may still be listed
+            if members:
+                res[role] = self._storage.decode(self._client, members)
         return res
+
+    def scan_grants(self, count=1000):
+        """
+        Yields (user, role, resource_ids) for every role key of this service, walking keys with
+        SCAN and each key with HSCAN (or its storage's equivalent) so memory stays bounded by
+        count whatever the size of the data. A large key is yielded in several batches.
+        """
+        for key in self._scan_role_keys(count):
+            user, role = self._parse_role_key(key)
+            cursor = 0
+            while True:
+                cursor, data = self._storage.scan(self._client, key, cursor, count)
+                if data:
+                    yield user, role, self._storage.decode(self._client, data)
+                if cursor == 0:
+                    break
+
+    def _scan_role_keys(self, count):
+        return self._client.scan_iter(match=_escape_glob("{}:".format(self._name)) + "*",
+            count=count)
+
+    def _parse_role_key(self, key):
+        """(user, role) of a '{service}:{user}:{role}' key"""
+        user, _, role = key.decode()[len(self._name) + 1:].rpartition(":")
+        if self._hash_tag_keys:
+            user = user[1:-1]
+        return user, role
+
+    def rebuild_role_indexes(self, count=1000):
+        """
+        Rebuilds the role index of every user of the service from existing role keys, walking
+        them with SCAN and writing the index in pipelines of count commands. Run once when
+        upgrading data assigned before the role index was introduced (deathnut-acl reindex),
+        get_roles does not see such roles until then.
+
+        Returns
+        -------
+        int
+            Number of (user, role) pairs indexed.
+        """
+        indexed = 0
+        pipe = self._client.pipeline(transaction=False)
+        for key in self._scan_role_keys(count):
+            user, role = self._parse_role_key(key)
+            pipe.sadd(self._roles_key(user), role)
+            indexed += 1
+            if len(pipe) >= count:
+                pipe.execute()
+        pipe.execute()
+        return indexed
+
+    def rebuild_role_index(self, user):
+        """
+        Rebuilds the role index of a user from existing role hashes using SCAN (never KEYS).
+        Only needed for data assigned before the role index was introduced, see
+        rebuild_role_indexes to rebuild every user's index at once.
+        """
+        prefix = self._role_key(user, "")
+        roles = set()
+        for key in self._client.scan_iter(match=_escape_glob(prefix) + "*", count=1000):
+            role = key.decode()[len(prefix):]
+            if ":" not in role:
+                roles.add(role)
+        if roles:
+            self._client.sadd(self._roles_key(user), *roles)
+        return roles
+
+
+def _escape_glob(pattern):
+    for char in "\\*?[]":
+        pattern = pattern.replace(char, "\\" + char)
+    return pattern
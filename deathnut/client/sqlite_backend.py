@@ -0,0 +1,233 @@
+import sqlite3
+import threading
+
+from deathnut.client.backend import DeathnutBackend
+from deathnut.util.deathnut_exception import DeathnutException
+from deathnut.util.logger import get_deathnut_logger
+from deathnut.util.metrics import NoopMetrics, timed
+
+logger = get_deathnut_logger(__name__)
+
+# sqlite's default limit on host parameters per statement is 999
+_MAX_PARAMS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deathnut_grants (
+    id INTEGER PRIMARY KEY,
+    service TEXT NOT NULL,
+    user TEXT NOT NULL,
+    role TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    UNIQUE (service, user, role, resource_id)
+);
+CREATE INDEX IF NOT EXISTS deathnut_grants_resource ON deathnut_grants (service, resource_id);
+"""
+
+ASSIGN = ("INSERT OR IGNORE INTO deathnut_grants (service, user, role, resource_id) "
+    "VALUES (?, ?, ?, ?)")
+REVOKE = ("DELETE FROM deathnut_grants WHERE service = ? AND user = ? AND role = ? AND "
+    "resource_id = ?")
+
+
+def _chunks(items, size=_MAX_PARAMS):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class SqliteDeathnutClient(DeathnutBackend):
+    def __init__(self, service, resource_type=None, path=":memory:", **kwargs):
+        """
+        Embedded backend keeping grants in a SQLite database (python's sqlite3, no server), for
+        single node deployments and tests. Checks are an indexed lookup in process, without a
+        network round trip. Grantee lookups (get_grantees, revoke_all) are always available.
+
+        Parameters
+        ----------
+        service: str
+            Name of calling service.
+        resource_type: str
+            Optional name of specific resource being protected.
+        path: str
+            Database file, shared by every service using it. ":memory:" (default) keeps grants
+            in this process only. File databases use WAL so readers in other processes do not
+            block on writes.
+        metrics: NoopMetrics
+            See DeathnutClient.
+        """
+        self._name = "{}_{}".format(service, resource_type) if resource_type else service
+        self._metrics = kwargs.get("metrics") or NoopMetrics()
+        self._lock = threading.Lock()
+        # one connection serialized by _lock, calls are short enough that a pool buys nothing
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _check_authenticated(user):
+        if user == "Unauthenticated":
+            raise DeathnutException("Unauthenticated user cannot be granted/removed from roles")
+
+    def _write(self, sql, rows):
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(sql, rows)
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _change(self, assign, grants):
+        for user, _, _ in grants:
+            self._check_authenticated(user)
+        with self._lock:
+            self._write(ASSIGN if assign else REVOKE, [(self._name, user, role, str(rid))
+                for user, role, rid in grants])
+
+    @timed("assign")
+    def assign_roles(self, grants, transaction=False):
+        """Assigns (user, role, resource_id) grants in one SQLite transaction"""
+        grants = list(grants)
+        logger.debug("Assigning %d role(s) for resource <%s>", len(grants), self._name)
+        self._change(True, grants)
+
+    @timed("revoke")
+    def revoke_roles(self, grants, transaction=False):
+        """Revokes (user, role, resource_id) grants in one SQLite transaction"""
+        grants = list(grants)
+        logger.debug("Revoking %d role(s) for resource <%s>", len(grants), self._name)
+        self._change(False, grants)
+
+    def _has_any(self, user, roles, resource_id):
+        sql = ("SELECT 1 FROM deathnut_grants WHERE service = ? AND user = ? AND resource_id = ? "
+            "AND role IN ({}) LIMIT 1".format(", ".join("?" * len(roles))))
+        return self._conn.execute(sql, [self._name, user, str(resource_id)] + list(roles)
+            ).fetchone() is not None
+
+    @timed("check")
+    def check_role(self, user, role, resource_id):
+        with self._lock:
+            return self._has_any(user, [role], resource_id)
+
+    @timed("check")
+    def check_any_role(self, user, roles, resource_id):
+        roles = list(roles)
+        if not roles:
+            return False
+        with self._lock:
+            return self._has_any(user, roles, resource_id)
+
+    @timed("check_many")
+    def check_roles_many(self, user, role, resource_ids):
+        resource_ids = list(resource_ids)
+        granted = set()
+        with self._lock:
+            for chunk in _chunks([str(rid) for rid in resource_ids]):
+                sql = ("SELECT resource_id FROM deathnut_grants WHERE service = ? AND user = ? AND "
+                    "role = ? AND resource_id IN ({})".format(", ".join("?" * len(chunk))))
+                granted.update(row[0] for row in self._conn.execute(sql, [self._name, user, role]
+                    + chunk))
+        return dict((rid, str(rid) in granted) for rid in resource_ids)
+
+    @timed("check_many")
+    def check_any_roles_many(self, user, roles, resource_ids):
+        roles = list(roles)
+        resource_ids = list(resource_ids)
+        granted = set()
+        with self._lock:
+            for chunk in _chunks([str(rid) for rid in resource_ids], _MAX_PARAMS - len(roles)):
+                sql = ("SELECT resource_id FROM deathnut_grants WHERE service = ? AND user = ? AND "
+                    "role IN ({}) AND resource_id IN ({})".format(", ".join("?" * len(roles)),
+                    ", ".join("?" * len(chunk))))
+                granted.update(row[0] for row in self._conn.execute(sql, [self._name, user]
+                    + roles + chunk))
+        return dict((rid, str(rid) in granted) for rid in resource_ids)
+
+    @timed("check_and_change")
+    def check_and_change_roles(self, granter, requires, user, roles, resource_id, revoke=False):
+        """Checks granter's role and applies the change in one SQLite transaction"""
+        roles = list(roles)
+        if roles:
+            self._check_authenticated(user)
+        logger.info("User <%s> %s role(s) %s for user <%s> on resource <%s>, id <%s>", granter,
+            "revoking" if revoke else "assigning", roles, user, self._name, resource_id)
+        with self._lock:
+            if not self._has_any(granter, [requires], resource_id):
+                return False
+            self._write(REVOKE if revoke else ASSIGN, [(self._name, user, role, str(resource_id))
+                for role in roles])
+        return True
+
+    @timed("get_resources")
+    def get_resources_from(self, user, role, cursor=0, count=500):
+        """cursor is the row id of the last grant returned, 0 to start"""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, resource_id FROM deathnut_grants WHERE "
+                "service = ? AND user = ? AND role = ? AND id > ? ORDER BY id LIMIT ?",
+                (self._name, user, role, int(cursor), count)).fetchall()
+        next_cursor = rows[-1][0] if len(rows) == count else 0
+        return next_cursor, [row[1] for row in rows]
+
+    @timed("get_resources")
+    def get_resources(self, user, role, limit=None):
+        with self._lock:
+            rows = self._conn.execute("SELECT resource_id FROM deathnut_grants WHERE service = ? "
+                "AND user = ? AND role = ? ORDER BY id LIMIT ?",
+                (self._name, user, role, -1 if limit is None else limit)).fetchall()
+        return [row[0] for row in rows]
+
+    @timed("get_roles")
+    def get_roles(self, user):
+        res = {}
+        with self._lock:
+            rows = self._conn.execute("SELECT role, resource_id FROM deathnut_grants WHERE "
+                "service = ? AND user = ? ORDER BY id", (self._name, user)).fetchall()
+        for role, resource_id in rows:
+            res.setdefault(role, []).append(resource_id)
+        return res
+
+    @timed("get_grantees")
+    def get_grantees(self, resource_id):
+        with self._lock:
+            return self._grantees(resource_id)
+
+    def _grantees(self, resource_id):
+        return sorted(self._conn.execute("SELECT user, role FROM deathnut_grants WHERE "
+            "service = ? AND resource_id = ?", (self._name, str(resource_id))).fetchall())
+
+    @timed("revoke_all")
+    def revoke_all(self, resource_id):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                grantees = self._grantees(resource_id)
+                self._conn.execute("DELETE FROM deathnut_grants WHERE service = ? AND "
+                    "resource_id = ?", (self._name, str(resource_id)))
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        logger.info("Revoked %d grant(s) on resource <%s>, id <%s>", len(grantees), self._name,
+            resource_id)
+        return grantees
+
+    def scan_grants(self, count=1000):
+        cursor = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute("SELECT id, user, role, resource_id FROM "
+                    "deathnut_grants WHERE service = ? AND id > ? ORDER BY id LIMIT ?",
+                    (self._name, cursor, count)).fetchall()
+            if not rows:
+                return
+            cursor = rows[-1][0]
+            batches = {}
+            for _, user, role, resource_id in rows:
+                batches.setdefault((user, role), []).append(resource_id)
+            for (user, role), ids in batches.items():
+                yield user, role, ids
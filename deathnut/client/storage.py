@@ -0,0 +1,491 @@
+"""
+Storage strategies: how the resource ids of one '{service}:{user}:{role}' key are laid out in redis.
+
+A strategy works on "members", the value actually stored for a resource id. HashStorage stores the
+resource id itself (see docs/redis.md), BitmapStorage stores a bit at an integer offset obtained
+from an id mapper. Clients translate resource ids to members with encode() before queuing writes or
+issuing checks and translate listed members back with decode().
+"""
+from redis.exceptions import ResponseError
+
+from deathnut.util.cache import MISSING, LRUCache
+from deathnut.util.deathnut_exception import DeathnutException
+
+
+class HashStorage(object):
+    """One hash per (user, role), resource ids are fields with value 1. The default layout."""
+    name = "hash"
+    # redis type of the key and commands (and trailing value) used by server side scripts to
+    # check/assign/revoke a member and to list members
+    redis_type = "hash"
+    check_command = "HGET"
+    assign_command = ("HSET", 1)
+    revoke_command = ("HDEL", None)
+    members_command = "HKEYS"
+
+    def bind(self, namespace):
+        pass
+
+    def encode(self, conn, resource_ids, create=False):
+        return list(resource_ids)
+
+    def decode(self, conn, members):
+        return [x.decode() if isinstance(x, bytes) else x for x in members]
+
+    def queue_assign(self, pipe, key, member):
+        pipe.hset(key, member, 1)
+
+    def queue_revoke(self, pipe, key, member):
+        pipe.hdel(key, member)
+
+    def check(self, conn, key, member):
+        return bool(conn.hget(key, member))
+
+    def queue_check(self, pipe, key, member):
+        pipe.hget(key, member)
+
+    def check_many(self, conn, key, members):
+        return [bool(x) for x in conn.hmget(key, members)]
+
+    def scan(self, conn, key, cursor=0, count=500):
+        return self.parse_scan(conn.hscan(key, cursor=cursor, count=count))
+
+    def queue_scan(self, pipe, key, cursor=0, count=500):
+        pipe.hscan(key, cursor=cursor, count=count)
+
+    def parse_scan(self, raw, cursor=0, count=500):
+        cursor, data = raw
+        return cursor, list(data)
+
+    def queue_members(self, pipe, key):
+        pipe.hgetall(key)
+
+    def parse_members(self, raw):
+        return list(raw)
+
+    def members(self, conn, key):
+        return self.parse_members(conn.hgetall(key))
+
+
+class SetStorage(HashStorage):
+    """
+    One set per (user, role), the original layout (see docs/redis.md). Only kept to read and
+    migrate data written before hashes were introduced.
+    """
+    name = "set"
+    redis_type = "set"
+    check_command = "SISMEMBER"
+    assign_command = ("SADD", None)
+    revoke_command = ("SREM", None)
+    members_command = "SMEMBERS"
+
+    def queue_assign(self, pipe, key, member):
+        pipe.sadd(key, member)
+
+    def queue_revoke(self, pipe, key, member):
+        pipe.srem(key, member)
+
+    def check(self, conn, key, member):
+        return bool(conn.sismember(key, member))
+
+    def queue_check(self, pipe, key, member):
+        pipe.sismember(key, member)
+
+    def check_many(self, conn, key, members):
+        pipe = conn.pipeline(transaction=False)
+        for member in members:
+            pipe.sismember(key, member)
+        return [bool(x) for x in pipe.execute()]
+
+    def scan(self, conn, key, cursor=0, count=500):
+        return self.parse_scan(conn.sscan(key, cursor=cursor, count=count))
+
+    def queue_scan(self, pipe, key, cursor=0, count=500):
+        pipe.sscan(key, cursor=cursor, count=count)
+
+    def queue_members(self, pipe, key):
+        pipe.smembers(key)
+
+    def members(self, conn, key):
+        return self.parse_members(conn.smembers(key))
+
+
+class IntegerIdMapper(object):
+    """
+    Maps resource ids that are (dense) non-negative integers to the same bit offset.
+
+    Parameters
+    ----------
+    max_offset: int
+        Largest id accepted. A bitmap takes (highest id granted) / 8 bytes, so this bounds the
+        memory a single stray large id can make one (user, role) key allocate: 2MB with the
+        default of 2 ** 24, 512MB at 2 ** 32. Raise it only if ids really are that dense.
+    """
+    def __init__(self, max_offset=2 ** 24):
+        self.max_offset = max_offset
+
+    def bind(self, namespace):
+        pass
+
+    def to_offsets(self, conn, resource_ids, create=False):
+        """Offsets for resource_ids. Invalid ids raise when assigning and map to None otherwise"""
+        offsets = []
+        for rid in resource_ids:
+            try:
+                offset = int(rid)
+            except (TypeError, ValueError):
+                offset = None
+            if offset is None or not 0 <= offset <= self.max_offset:
+                if create:
+                    raise DeathnutException("Bitmap storage requires integer resource ids between "
+                        "0 and {}, got <{}>".format(self.max_offset, rid))
+                offset = None
+            offsets.append(offset)
+        return offsets
+
+    def to_ids(self, conn, offsets):
+        return [str(offset) for offset in offsets]
+
+
+class RedisIdMapper(object):
+    """
+    Assigns dense integer offsets to arbitrary resource ids on first assignment, keeping the
+    mapping in two hashes ('{{namespace}}-ids:fwd' id -> offset and '{{namespace}}-ids:rev'
+    offset -> id) plus a counter. The namespace is hash tagged so the three keys share a Redis
+    Cluster slot, as the allocation script touching them requires. Mappings never change once
+    assigned, so they are cached in-process.
+
+    Parameters
+    ----------
+    namespace: str
+        Key prefix. Defaults to the name of the client the storage is bound to.
+    cache_size: int
+        Number of id <-> offset mappings remembered in each direction.
+    """
+    ALLOCATE = """
+    local offsets = {}
+    for i, rid in ipairs(ARGV) do
+        local offset = redis.call('HGET', KEYS[1], rid)
+        if not offset then
+            offset = redis.call('INCR', KEYS[3]) - 1
+            redis.call('HSET', KEYS[1], rid, offset)
+            redis.call('HSET', KEYS[2], offset, rid)
+        end
+        offsets[i] = tonumber(offset)
+    end
+    return offsets
+    """
+
+    def __init__(self, namespace=None, cache_size=100000):
+        self._namespace = namespace
+        self._offsets = LRUCache(maxsize=cache_size)
+        self._ids = LRUCache(maxsize=cache_size)
+        self._allocate = None
+
+    def bind(self, namespace):
+        if self._namespace is None:
+            self._namespace = namespace
+
+    def _keys(self):
+        prefix = "{{{}}}-ids".format(self._namespace)
+        return [prefix + ":fwd", prefix + ":rev", prefix + ":next"]
+
+    def _remember(self, rid, offset):
+        self._offsets.set(rid, offset)
+        self._ids.set(offset, rid)
+
+    def to_offsets(self, conn, resource_ids, create=False):
+        """Offsets for resource_ids, None for ids never assigned (unless create is set)"""
+        resource_ids = [str(rid) for rid in resource_ids]
+        offsets = [self._offsets.get(rid) for rid in resource_ids]
+        unknown = [rid for rid, offset in zip(resource_ids, offsets) if offset is MISSING]
+        if unknown:
+            if create:
+                if self._allocate is None:
+                    self._allocate = conn.register_script(self.ALLOCATE)
+                found = self._allocate(keys=self._keys(), args=unknown, client=conn)
+            else:
+                found = conn.hmget(self._keys()[0], unknown)
+            found = dict((rid, None if offset is None else int(offset))
+                for rid, offset in zip(unknown, found))
+            for rid, offset in found.items():
+                if offset is not None:
+                    self._remember(rid, offset)
+            offsets = [found[rid] if offset is MISSING else offset
+                for rid, offset in zip(resource_ids, offsets)]
+        return offsets
+
+    def to_ids(self, conn, offsets):
+        ids = [self._ids.get(offset) for offset in offsets]
+        unknown = [offset for offset, rid in zip(offsets, ids) if rid is MISSING]
+        if unknown:
+            found = dict(zip(unknown, conn.hmget(self._keys()[1], unknown)))
+            for offset in unknown:
+                if found[offset] is not None:
+                    found[offset] = found[offset].decode()
+                    self._remember(found[offset], offset)
+            ids = [found[offset] if rid is MISSING else rid for offset, rid in zip(offsets, ids)]
+        return [rid for rid in ids if rid is not None]
+
+
+class BitmapStorage(object):
+    """
+    One bitmap per (user, role): the bit at a resource's offset is set when the role is granted.
+    Uses SETBIT/GETBIT to write and check and BITPOS/GETRANGE to list. For dense integer ids this
+    takes about one bit per possible id instead of tens of bytes per granted id.
+
+    Parameters
+    ----------
+    id_mapper: IntegerIdMapper or RedisIdMapper
+        Translates resource ids to bit offsets. Defaults to IntegerIdMapper.
+    """
+    name = "bitmap"
+    redis_type = "string"
+    check_command = "GETBIT"
+    assign_command = ("SETBIT", 1)
+    revoke_command = ("SETBIT", 0)
+    members_command = "GET"
+
+    def __init__(self, id_mapper=None):
+        self._mapper = id_mapper or IntegerIdMapper()
+
+    def bind(self, namespace):
+        self._mapper.bind(namespace)
+
+    def encode(self, conn, resource_ids, create=False):
+        return self._mapper.to_offsets(conn, resource_ids, create)
+
+    def decode(self, conn, members):
+        return self._mapper.to_ids(conn, members)
+
+    def queue_assign(self, pipe, key, member):
+        pipe.setbit(key, member, 1)
+
+    def queue_revoke(self, pipe, key, member):
+        pipe.setbit(key, member, 0)
+
+    def check(self, conn, key, member):
+        return bool(conn.getbit(key, member))
+
+    def queue_check(self, pipe, key, member):
+        pipe.getbit(key, member)
+
+    def check_many(self, conn, key, members):
+        pipe = conn.pipeline(transaction=False)
+        for member in members:
+            pipe.getbit(key, member)
+        return [bool(x) for x in pipe.execute()]
+
+    @staticmethod
+    def _set_bits(data, first_byte=0):
+        data = bytearray(data or b"")
+        return [(first_byte + i) * 8 + bit for i, byte in enumerate(data) if byte
+            for bit in range(8) if byte & (0x80 >> bit)]
+
+    @staticmethod
+    def _window(count):
+        """Bytes read per scan, enough for count ids if the bitmap is dense"""
+        return max(128, (count + 7) // 8)
+
+    def _page(self, data, first_byte, start, count):
+        """
+        At most count set bits at or after bit start, and the bit offset to resume from: right
+        after the last bit returned, or the end of the window if it has been exhausted.
+        """
+        bits = [bit for bit in self._set_bits(data, first_byte) if bit >= start]
+        if len(bits) > count:
+            return bits[count - 1] + 1, bits[:count]
+        size = self._window(count)
+        return ((first_byte + size) * 8 if len(data) == size else 0), bits
+
+    def scan(self, conn, key, cursor=0, count=500):
+        """cursor is a bit offset into the bitmap, BITPOS skips runs of unset bits"""
+        start = int(cursor)
+        first = conn.bitpos(key, 1, start // 8) if start else conn.bitpos(key, 1)
+        if first is None or first < 0:
+            return 0, []
+        first_byte = first // 8
+        data = conn.getrange(key, first_byte, first_byte + self._window(count) - 1)
+        return self._page(data, first_byte, start, count)
+
+    def queue_scan(self, pipe, key, cursor=0, count=500):
+        """Pipelined scan, a single GETRANGE from cursor without skipping unset bits"""
+        first_byte = int(cursor) // 8
+        pipe.getrange(key, first_byte, first_byte + self._window(count) - 1)
+
+    def parse_scan(self, raw, cursor=0, count=500):
+        return self._page(raw, int(cursor) // 8, int(cursor), count)
+
+    def queue_members(self, pipe, key):
+        pipe.get(key)
+
+    def parse_members(self, raw):
+        return self._set_bits(raw)
+
+    def members(self, conn, key):
+        return self.parse_members(conn.get(key))
+
+
+class _Members(list):
+    """Members listed by MigratingStorage, remembering the storage they were read with"""
+    def __init__(self, storage, members):
+        super(_Members, self).__init__(members)
+        self.storage = storage
+
+
+def _wrong_type(exc):
+    return str(exc).startswith("WRONGTYPE")
+
+
+class MigratingStorage(object):
+    """
+    Storage used while keys are converted from one layout to another (see
+    deathnut.tools.migrate). A key is read and written in whichever layout it currently has,
+    decided server side by its redis type, so the client and the migrator never conflict: keys
+    not converted yet keep getting old layout writes (converted later on), converted and new keys
+    use the new layout.
+
+    Single key checks and writes run as a small Lua script branching on TYPE, listings fall back
+    to the old layout on WRONGTYPE. Both layouts must use different redis types.
+
+    Parameters
+    ----------
+    old: storage instance
+        Layout being migrated from.
+    new: storage instance
+        Layout being migrated to.
+    """
+    # ARGV: old layout's redis type, then command, member, value for the old and new layouts.
+    # An empty member means the id is unknown to that layout.
+    OP = """
+    local o = 5
+    if redis.call('TYPE', KEYS[1])['ok'] == ARGV[1] then
+        o = 2
+    end
+    if ARGV[o + 1] == '' then
+        return false
+    end
+    if ARGV[o + 2] == '' then
+        return redis.call(ARGV[o], KEYS[1], ARGV[o + 1])
+    end
+    return redis.call(ARGV[o], KEYS[1], ARGV[o + 1], ARGV[o + 2])
+    """
+
+    # Returns {type, members}, members listed with the command of the key's layout
+    MEMBERS = """
+    local t = redis.call('TYPE', KEYS[1])['ok']
+    if t == ARGV[1] then
+        return {t, redis.call(ARGV[2], KEYS[1])}
+    end
+    if t == 'none' then
+        return {t, false}
+    end
+    return {t, redis.call(ARGV[3], KEYS[1])}
+    """
+    # no single command checks a member in both layouts, scripts built on it cannot be used
+    check_command = None
+    # scans fall back to the old layout on WRONGTYPE, they cannot be pipelined
+    queue_scan = None
+
+    def __init__(self, old, new):
+        if old.redis_type == new.redis_type:
+            raise DeathnutException("Cannot migrate between layouts of the same redis type <{}>"
+                .format(old.redis_type))
+        self.old = old
+        self.new = new
+        self.name = "{}->{}".format(old.name, new.name)
+        self._op = None
+        self._members = None
+
+    def bind(self, namespace):
+        self.old.bind(namespace)
+        self.new.bind(namespace)
+
+    def encode(self, conn, resource_ids, create=False):
+        """Members are (old member, new member) pairs, None if the id is unknown to both"""
+        resource_ids = list(resource_ids)
+        try:
+            old = self.old.encode(conn, resource_ids, create)
+        except DeathnutException:
+            # id invalid in the old layout, it can only be written to converted keys
+            old = self.old.encode(conn, resource_ids)
+        new = self.new.encode(conn, resource_ids, create)
+        return [None if pair == (None, None) else pair for pair in zip(old, new)]
+
+    def decode(self, conn, members):
+        return members.storage.decode(conn, list(members)) if members else []
+
+    def _script(self, conn, key, member, old_command, new_command):
+        if self._op is None:
+            self._op = conn.register_script(self.OP)
+        args = [self.old.redis_type]
+        for (command, value), value_member in ((old_command, member[0]),
+                (new_command, member[1])):
+            args += [command, "" if value_member is None else value_member,
+                "" if value is None else value]
+        return self._op(keys=[key], args=args, client=conn)
+
+    def queue_assign(self, pipe, key, member):
+        self._script(pipe, key, member, self.old.assign_command, self.new.assign_command)
+
+    def queue_revoke(self, pipe, key, member):
+        self._script(pipe, key, member, self.old.revoke_command, self.new.revoke_command)
+
+    def check(self, conn, key, member):
+        return bool(self._script(conn, key, member, (self.old.check_command, None),
+            (self.new.check_command, None)))
+
+    def queue_check(self, pipe, key, member):
+        self._script(pipe, key, member, (self.old.check_command, None),
+            (self.new.check_command, None))
+
+    def check_many(self, conn, key, members):
+        pipe = conn.pipeline(transaction=False)
+        for member in members:
+            self.queue_check(pipe, key, member)
+        return [bool(x) for x in pipe.execute()]
+
+    def scan(self, conn, key, cursor=0, count=500):
+        """Note: a cursor is only meaningful for the layout the key had when it was returned"""
+        try:
+            cursor, data = self.new.scan(conn, key, cursor, count)
+            return cursor, _Members(self.new, data)
+        except ResponseError as exc:
+            if not _wrong_type(exc):
+                raise
+        cursor, data = self.old.scan(conn, key, cursor, count)
+        return cursor, _Members(self.old, data)
+
+    def queue_members(self, pipe, key):
+        if self._members is None:
+            self._members = pipe.register_script(self.MEMBERS)
+        self._members(keys=[key], args=[self.old.redis_type, self.old.members_command,
+            self.new.members_command], client=pipe)
+
+    def parse_members(self, raw):
+        redis_type, data = raw
+        storage = self.old if redis_type.decode() == self.old.redis_type else self.new
+        return _Members(storage, storage.parse_members(data) if data else [])
+
+    def members(self, conn, key):
+        try:
+            return _Members(self.new, self.new.members(conn, key))
+        except ResponseError as exc:
+            if not _wrong_type(exc):
+                raise
+        return _Members(self.old, self.old.members(conn, key))
+
+
+STORAGES = {"hash": HashStorage, "bitmap": BitmapStorage, "set": SetStorage}
+
+
+def get_storage(storage=None):
+    """Returns a storage strategy from an instance, a name in STORAGES or None (hash)"""
+    if storage is None:
+        return HashStorage()
+    if isinstance(storage, str):
+        if storage not in STORAGES:
+            raise DeathnutException("Unknown storage <{}>, expected one of {}".format(storage,
+                sorted(STORAGES)))
+        return STORAGES[storage]()
+    return storage
@@ -2,9 +2,10 @@ from abc import abstractmethod
 
 from deathnut.util.abstract_classes import ABC
 from deathnut.util.deathnut_exception import DeathnutException
-from deathnut.util.logger import get_deathnut_logger
+from deathnut.util.logger import RateLimitedLogger, get_deathnut_logger
 
 logger = get_deathnut_logger(__name__)
+_throttled_logger = RateLimitedLogger(logger)
 
 class BaseAuthEndpoint(ABC):
     def __init__(self, auth_o, name):
@@ -14,10 +15,34 @@ class BaseAuthEndpoint(ABC):
         self.generate_auth_endpoint()
 
     def check_grant_enabled(self, requires, grants):
-        logger.warn("Required: {} grants: {}".format(requires, grants))
+        logger.debug("Required: %s grants: %s", requires, grants)
         if grants not in self._allowed.get(requires):
             raise DeathnutException('Role {} is not authorized to grant role {}'.format(requires, grants))
 
+    def _grants_to_apply(self, requires, user, grants):
+        # make sure the granting user has access to grant all roles.
+        for role in grants:
+            self.check_grant_enabled(requires, role)
+        if not self._auth_o.is_authenticated(user):
+            _throttled_logger.warning("Unauthenticated user attempt to update roles")
+            return []
+        return grants
+
+    def change_roles(self, calling_user, requires, user, grants, resource_id, revoke=False):
+        """
+        Grants (or revokes) roles on resource_id to user if calling_user holds role requires on
+        it. The check and all writes are a single atomic operation on the deathnut client.
+
+        Raises
+        ------
+        DeathnutException
+            If calling_user may not grant the roles.
+        """
+        roles = self._grants_to_apply(requires, user, grants)
+        if not self._auth_o.get_client().check_and_change_roles(calling_user, requires, user,
+                roles, resource_id, revoke):
+            raise DeathnutException('Unauthorized to grant')
+
     def allow_grant(self, requires_role, grants_roles):
         """
         For a given role, allow users with that role to assign roles to others
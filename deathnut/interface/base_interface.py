@@ -1,14 +1,20 @@
 import functools
 from abc import abstractmethod
-from concurrent.futures import ThreadPoolExecutor
 
 from deathnut.client.deathnut_client import DeathnutClient
 from deathnut.util.abstract_classes import ABC
+from deathnut.util.cache import MISSING, LRUCache
+from deathnut.util.circuit_breaker import CircuitOpenError
 from deathnut.util.deathnut_exception import DeathnutException
-from deathnut.util.jwt import get_user_from_jwt_header
-from deathnut.util.logger import get_deathnut_logger
+from deathnut.util.executor import BoundedExecutor
+from deathnut.util.jwt import get_user_cache_stats, get_user_from_jwt_header
+from deathnut.util.logger import RateLimitedLogger, get_deathnut_logger
+from deathnut.util import server_timing
 
 logger = get_deathnut_logger(__name__)
+OUTAGE_POLICIES = ("error", "deny", "allow", "stale")
+# warnings logged per request, repeats are only counted
+_throttled_logger = RateLimitedLogger(logger)
 
 class BaseAuthorizationInterface(ABC):
     def __init__(self, service, resource_type=None, strict=True, enabled=True, **kwargs):
@@ -22,11 +28,73 @@ class BaseAuthorizationInterface(ABC):
             If True, authorization checks will run. If False, all users will have access to
             everything.
             Note: this value is a default and can be overiden when calling client methods.
+        executor_max_workers: int
+            Size of the thread pool shared by all speculative (dont_wait) executions of this
+            interface.
+        executor_queue_limit: int
+            Number of speculative executions allowed to wait for a free thread. Once the pool is
+            saturated requests fall back to checking authorization before running the handler.
+        role_hierarchy: dict
+            Role inheritance, mapping a role to the roles it implies, ex:
+            {'owner': ['edit'], 'edit': ['view']}. A user holding 'owner' on a resource then passes
+            requires_role('view') without a 'view' grant being stored. Every qualifying role is
+            checked in a single round trip.
+        metrics: NoopMetrics
+            Instrumentation hook shared with the DeathnutClient (see deathnut.util.metrics).
+            Records allow/deny decisions, speculative executions wasted on denied users, executor
+            queue depth and cache hit ratios, labelled with the service name.
+        server_timing: bool
+            If True, decorated endpoints report how long identity parsing (dn-identity), redis
+            calls (dn-redis) and the wrapped handler (dn-handler) took in a Server-Timing response
+            header. Off by default, as it exposes internal timings to callers.
+        outage_policy: str
+            Decision taken by requires_role while the client's circuit_breaker is open (can be
+            overridden per route): "error" (default) fails the request as a redis outage, "deny"
+            and "allow" answer every check, "stale" serves the last decision seen for the
+            (user, role, resource) and denies those never seen.
+        stale_decision_cache_size: int
+            Number of last known decisions kept for the "stale" policy when a circuit_breaker is
+            configured (default 10000).
+        backend: DeathnutBackend
+            Backend to use instead of a redis DeathnutClient built from the other kwargs, ex:
+            SqliteDeathnutClient for single node deployments (see deathnut.client.backend).
         *Other params defined in DeathnutClient.
         """
-        self._client = DeathnutClient(service, resource_type, **kwargs)
+        self._client = kwargs.get("backend") or DeathnutClient(service, resource_type, **kwargs)
+        self._qualifying_roles = _invert_hierarchy(kwargs.get("role_hierarchy") or {})
         self._enabled_default = enabled
         self._strict_default = strict
+        self._executor = BoundedExecutor(kwargs.get("executor_max_workers"),
+            kwargs.get("executor_queue_limit"))
+        self._metrics = self._client.get_metrics()
+        self._register_gauges()
+        self._server_timing = kwargs.get("server_timing", False)
+        self._outage_policy = self._check_outage_policy(kwargs.get("outage_policy") or "error")
+        self._last_known = None
+        if self._client.get_circuit_breaker() is not None:
+            self._last_known = LRUCache(kwargs.get("stale_decision_cache_size", 10000))
+
+    def _register_gauges(self):
+        service = self._client.get_name()
+        self._metrics.register_gauge("deathnut_executor_queue_depth",
+            lambda: self._executor.metrics()["queue_depth"], service=service)
+        self._metrics.register_gauge("deathnut_decision_cache_hit_ratio",
+            lambda: (self._client.get_cache_stats() or {}).get("hit_ratio"), service=service)
+        self._metrics.register_gauge("deathnut_user_cache_hit_ratio",
+            lambda: get_user_cache_stats()["hit_ratio"], service=service)
+        breaker = self._client.get_circuit_breaker()
+        if breaker is not None:
+            self._metrics.register_gauge("deathnut_circuit_open",
+                lambda: int(breaker.stats()["open"]), service=service)
+
+    def _record_decision(self, allowed):
+        self._metrics.increment("deathnut_authorization_total",
+            result="allow" if allowed else "deny", service=self._client.get_name())
+        return allowed
+
+    def _record_wasted(self):
+        self._metrics.increment("deathnut_speculative_wasted_total",
+            service=self._client.get_name())
 
     @staticmethod
     @abstractmethod
@@ -48,23 +116,59 @@ class BaseAuthorizationInterface(ABC):
     def get_body_response(ret, *args, **kwargs):
         pass
 
+    @staticmethod
+    def get_cursor(*args, **kwargs):
+        """Pagination cursor for fetch_accessible_for_user(paginate=True)"""
+        return int(kwargs.get("cursor") or 0)
+
     @abstractmethod
     def create_auth_endpoint(self, name, requires_role, grants_role):
         pass
 
+    def add_server_timing_header(self, value, *args, **kwargs):
+        """Sets the Server-Timing header of the response to the current request"""
+        pass
+
     def get_client(self):
         return self._client
 
     def get_redis_connection(self):
         return self._client.get_redis_connection()
 
+    def get_executor_metrics(self):
+        return self._executor.metrics()
+
+    def qualifying_roles(self, role):
+        """role followed by every role implying it, closest first"""
+        return self._qualifying_roles.get(role, [role])
+
     def _get_auth_arguments(self, jwt_header, **kwargs):
         enabled = kwargs.get("enabled", self._enabled_default)
         strict = kwargs.get("strict", self._strict_default)
-        user = get_user_from_jwt_header(jwt_header)
+        with server_timing.phase(server_timing.IDENTITY):
+            user = get_user_from_jwt_header(jwt_header)
         return user, enabled, strict
 
-    def requires_role(self, role, id_identifier="id", **kwargs):
+    def _with_server_timing(self, wrapped):
+        """Collects a Server-Timing breakdown of each call to wrapped if server_timing is enabled"""
+        if not self._server_timing:
+            return wrapped
+        @functools.wraps(wrapped)
+        def timed(*args, **kwargs):
+            timing, token = server_timing.start()
+            try:
+                return wrapped(*args, **kwargs)
+            finally:
+                server_timing.finish(token)
+                self.add_server_timing_header(timing.header(), *args, **kwargs)
+        return timed
+
+    def requires_role(self, role, id_identifier="id", outage_policy=None, **kwargs):
+        """
+        outage_policy overrides the interface's outage_policy for this route, ex: "stale" for
+        reads and "deny" for writes.
+        """
+        outage_policy = self._check_outage_policy(outage_policy)
         def decorator(func):
             @functools.wraps(func)
             def wrapped(*args, **kwargs):
@@ -74,8 +178,9 @@ class BaseAuthorizationInterface(ABC):
                 # if request is a GET, fetch resource asynchronously and return if authorized.
                 dont_wait = self.get_dont_wait(*args, **kwargs)
                 return self._execute_if_authorized(user, role, resource_id, enabled, strict,
-                    dont_wait, func, *args, **kwargs)
-            return wrapped
+                    dont_wait, server_timing.timed_handler(func), *args,
+                    dn_outage_policy=outage_policy, **kwargs)
+            return self._with_server_timing(wrapped)
         return decorator
 
     def authentication_required(self, assign=[], uid_field="id", **kwargs):
@@ -90,69 +195,140 @@ class BaseAuthorizationInterface(ABC):
             def wrapped(*args, **kwargs):
                 jwt_header = self.get_auth_header(*args, **kwargs)
                 user, enabled, strict = self._get_auth_arguments(jwt_header, **kwargs)
+                handler = server_timing.timed_handler(func)
                 if assign:
-                    ret = self._execute_if_authenticated(user, enabled, strict, func, *args, **kwargs)
+                    ret = self._execute_if_authenticated(user, enabled, strict, handler, *args, **kwargs)
                     resp = dict(self.get_body_response(ret, *args, **kwargs))
                     uid = resp.get(uid_field)
                     if not uid:
                         raise DeathnutException("UID field <%s> not found in response <%s>" % (uid_field, resp))
-                    self.assign_roles(uid, assign, deathnut_user=user, **kwargs)
+                    with server_timing.phase(server_timing.REDIS):
+                        self.assign_roles(uid, assign, deathnut_user=user, **kwargs)
                     return ret
                 else:
-                    return self._execute_if_authenticated(user, enabled, strict, func, *args, **kwargs)
-            return wrapped
+                    return self._execute_if_authenticated(user, enabled, strict, handler, *args, **kwargs)
+            return self._with_server_timing(wrapped)
         return decorator
 
-    def fetch_accessible_for_user(self, role, **kwargs):
+    def fetch_accessible_for_user(self, role, paginate=False, **kwargs):
+        """
+        Passes the ids the calling user has role for to the wrapped function as deathnut_ids, at
+        most 'limit' of them (taken from the endpoint's kwargs, default 500). Ids granted through
+        roles implying role (see role_hierarchy) are included.
+
+        If paginate is True the ids are read one HSCAN batch at a time starting from the cursor
+        returned by get_cursor ('cursor' kwarg or query parameter, 0 to start) and the cursor of
+        the next batch is passed as deathnut_cursor (0 once every id has been returned). A cursor
+        walks a single role, so paginated listings only include ids granted role itself. When
+        paginating 'limit' is only the batch size hint passed to HSCAN: a page may hold more
+        ids (small hashes are always returned whole), trimming it would lose the ids past the
+        cut since an HSCAN cursor cannot resume mid batch. Bitmap storage and the SQLite backend
+        return at most 'limit' ids per page.
+        """
         def decorator(func):
             @functools.wraps(func)
             def wrapped(*args, **kwargs):
                 limit = kwargs.get('limit', 500)
                 jwt_header = self.get_auth_header(*args, **kwargs)
                 user, enabled, strict = self._get_auth_arguments(jwt_header, **kwargs)
-                deathnut_ids = self._client.get_resources(user, role, limit)
-                return self._execute_if_authenticated(user, enabled, strict, func, *args,
+                handler = server_timing.timed_handler(func)
+                if paginate:
+                    cursor = self.get_cursor(*args, **kwargs)
+                    with server_timing.phase(server_timing.REDIS):
+                        next_cursor, deathnut_ids = self._client.get_resources_from(user, role,
+                            cursor, limit)
+                    return self._execute_if_authenticated(user, enabled, strict, handler, *args,
+                        deathnut_ids=deathnut_ids, deathnut_cursor=next_cursor, **kwargs)
+                with server_timing.phase(server_timing.REDIS):
+                    deathnut_ids = self.get_accessible(user, role, limit)
+                return self._execute_if_authenticated(user, enabled, strict, handler, *args,
                     deathnut_ids=deathnut_ids, **kwargs)
-            return wrapped
+            return self._with_server_timing(wrapped)
         return decorator
 
     def _change_roles(self, action, roles, resource_id, **kwargs):
         user = kwargs.get('deathnut_user', 'Unauthenticated')
         if not self.is_authenticated(user):
-            logger.warn("Unauthenticated user attempt to update roles")
+            _throttled_logger.warning("Unauthenticated user attempt to update roles")
             return
         if roles:
-            for role in roles:
-                action(user, role, resource_id)
+            action([(user, role, resource_id) for role in roles])
 
     def assign_roles(self, resource_id, roles, **kwargs):
-        return self._change_roles(self._client.assign_role, roles, resource_id, **kwargs)
+        return self._change_roles(self._client.assign_roles, roles, resource_id, **kwargs)
 
     def revoke_roles(self, resource_id, roles, **kwargs):
-        return self._change_roles(self._client.revoke_role, roles, resource_id, **kwargs)
+        return self._change_roles(self._client.revoke_roles, roles, resource_id, **kwargs)
 
     def _is_auth_required(self, user, enabled, strict):
         """if this is true, do not return wrapped function"""
         if not enabled:
-            logger.warn("Authorization is not enabled")
+            _throttled_logger.warning("Authorization is not enabled")
             return False
         if not strict and user == "Unauthenticated":
-            logger.warn("Strict auth checking disabled, granting access to unauthenticated user")
+            _throttled_logger.warning("Strict auth checking disabled, granting access to unauthenticated user")
             return False
         return True
 
-    def is_authorized(self, user, role, resource_id):
-        """user is authenticated and has access to resource"""
+    def is_authorized(self, user, role, resource_id, outage_policy=None):
+        """
+        user is authenticated and has access to resource. outage_policy (default: the interface's)
+        decides while the circuit breaker is open.
+        """
         if not self.is_authenticated(user):
-            return not self._strict_default
-        return self._client.check_role(user, role, resource_id)
+            return self._record_decision(not self._strict_default)
+        try:
+            with server_timing.phase(server_timing.REDIS):
+                allowed = self._client.check_any_role(user, self.qualifying_roles(role),
+                    resource_id)
+        except CircuitOpenError as exc:
+            allowed = self._outage_decision(exc, outage_policy, user, role, resource_id)
+        else:
+            self._remember_decision(user, role, resource_id, allowed)
+        return self._record_decision(allowed)
+
+    @staticmethod
+    def _check_outage_policy(outage_policy):
+        if outage_policy is not None and outage_policy not in OUTAGE_POLICIES:
+            raise DeathnutException("Unknown outage policy <{}>, expected one of {}".format(
+                outage_policy, OUTAGE_POLICIES))
+        return outage_policy
+
+    def _remember_decision(self, user, role, resource_id, allowed):
+        if self._last_known is not None:
+            self._last_known.set((user, role, resource_id), allowed)
+
+    def _outage_decision(self, exc, outage_policy, user, role, resource_id):
+        """Decision while the circuit breaker is open, re-raises exc under the "error" policy"""
+        outage_policy = outage_policy or self._outage_policy
+        if outage_policy == "error":
+            raise exc
+        _throttled_logger.warning("Circuit breaker open, applying outage policy %s",
+            outage_policy)
+        if outage_policy == "stale":
+            allowed = self._last_known.get((user, role, resource_id), MISSING)
+            return allowed is not MISSING and allowed
+        return outage_policy == "allow"
+
+    def filter_authorized(self, user, role, resource_ids):
+        """Returns the subset of resource_ids (in order) the user has role, or an implying role, for"""
+        resource_ids = list(resource_ids)
+        if not self.is_authenticated(user):
+            return [] if self._strict_default else resource_ids
+        granted = self._client.check_any_roles_many(user, self.qualifying_roles(role),
+            resource_ids)
+        return [rid for rid in resource_ids if granted[rid]]
+
+    def get_accessible(self, user, role, limit=None):
+        """Resource ids user has role (or an implying role) for, at most limit of them"""
+        return self._client.get_resources_any_role(user, self.qualifying_roles(role), limit)
 
     def is_authenticated(self, user):
         return user != "Unauthenticated"
 
 
     def _execute_if_authorized(self, dn_user, dn_role, dn_rid, dn_enabled, dn_strict, dn_dont_wait,
-        dn_func, *args, **kwargs):
+        dn_func, *args, dn_outage_policy=None, **kwargs):
         """
         Executes a wrapped function if a user has the required role for a given resource_id.
 
@@ -173,13 +349,15 @@ class BaseAuthorizationInterface(ABC):
             Whether deathnut, if enabled, will allow access to unauthenticated users.
         dn_func: function
             The wrapped function.
+        dn_outage_policy: str
+            Route's outage policy, see requires_role.
         """
         if not self._is_auth_required(dn_user, dn_enabled, dn_strict):
             return self._execute(dn_func, *args, **kwargs)
         if dn_dont_wait:
             return self._execute_asynchronously(dn_func, dn_role, dn_rid, *args,
-                                                deathnut_user=dn_user, **kwargs)
-        if self.is_authorized(dn_user, dn_role, dn_rid):
+                dn_outage_policy=dn_outage_policy, deathnut_user=dn_user, **kwargs)
+        if self.is_authorized(dn_user, dn_role, dn_rid, dn_outage_policy):
             return self._execute(dn_func, *args, deathnut_user=dn_user, **kwargs)
         raise DeathnutException("Not authorized")
 
@@ -189,15 +367,21 @@ class BaseAuthorizationInterface(ABC):
         return dn_func(*args, **kwargs)
 
 
-    def _execute_asynchronously(self, dn_func, dn_role, dn_rid, *args, **kwargs):
+    def _execute_asynchronously(self, dn_func, dn_role, dn_rid, *args, dn_outage_policy=None,
+        **kwargs):
         dn_user = kwargs.get('deathnut_user', 'Unauthenticated')
-        with ThreadPoolExecutor() as ex:
-            # assigns should not occur on GET / will not succeed as we dont pass user info
-            fetched_result = ex.submit(dn_func, *args, **kwargs)
-            is_authorized = ex.submit(self.is_authorized, dn_user, dn_role, dn_rid)
-            if is_authorized.result():
-                return fetched_result.result()
+        # assigns should not occur on GET / will not succeed as we dont pass user info
+        fetched_result = self._executor.try_submit(self._execute, dn_func, *args, **kwargs)
+        if fetched_result is None:
+            # executor saturated, check then run serially rather than queue unboundedly.
+            if self.is_authorized(dn_user, dn_role, dn_rid, dn_outage_policy):
+                return self._execute(dn_func, *args, **kwargs)
             raise DeathnutException("Not authorized")
+        if self.is_authorized(dn_user, dn_role, dn_rid, dn_outage_policy):
+            return fetched_result.result()
+        if not fetched_result.cancel():
+            self._record_wasted()
+        raise DeathnutException("Not authorized")
 
 
     def _execute_if_authenticated(self, dn_user, dn_enabled, dn_strict, dn_func, *args, **kwargs):
@@ -224,3 +408,20 @@ class BaseAuthorizationInterface(ABC):
         if self.is_authenticated(dn_user):
             return self._execute(dn_func, *args, deathnut_user=dn_user, **kwargs)
         raise DeathnutException("No authentication provided")
+
+
+def _invert_hierarchy(role_hierarchy):
+    """Maps each role to itself and every role implying it, transitively, closest first"""
+    implied_by = {}
+    for role, implied in role_hierarchy.items():
+        for implied_role in implied:
+            implied_by.setdefault(implied_role, []).append(role)
+    qualifying = {}
+    for role in set(role_hierarchy) | set(implied_by):
+        roles = [role]
+        for current in roles:
+            for parent in implied_by.get(current, []):
+                if parent not in roles:
+                    roles.append(parent)
+        qualifying[role] = roles
+    return qualifying
@@ -43,11 +43,20 @@ class FalconAuthorization(BaseAuthorizationInterface):
         dn_args.update(kwargs)
         return dn_args[id_identifier]
 
+    @staticmethod
+    def get_cursor(*args, **kwargs):
+        req = args[1]
+        return int(kwargs.get("cursor") or req.get_param("cursor") or 0)
+
     @staticmethod
     def get_dont_wait(*args, **kwargs):
         req = args[1]
         return kwargs.get("dont_wait", req.method == "GET")
 
+    def add_server_timing_header(self, value, *args, **kwargs):
+        resp = args[2]
+        resp.append_header("Server-Timing", value)
+
     def create_auth_endpoint(self, name):
         return FalconAuthEndpoint(self, self._app, self._spec, name)
 
@@ -86,16 +95,7 @@ class FalconAuthEndpoint(BaseAuthEndpoint):
                 grants = dn_auth["grants"]
                 revoke = dn_auth.get("revoke", False)
                 calling_user = kwargs.get("deathnut_user", "Unauthenticated")
-                if not auth_o.get_client().check_role(calling_user, requires, id):
-                    raise DeathnutException('Unauthorized to grant')
-                # make sure the granting user has access to grant all roles.
-                for role in grants:
-                    endpoint.check_grant_enabled(requires, role)
-                kwargs.update(deathnut_user=user)
-                if revoke:
-                    auth_o.revoke_roles(id, grants, **kwargs)
-                else:
-                    auth_o.assign_roles(id, grants, **kwargs)
+                endpoint.change_roles(calling_user, requires, user, grants, id, revoke)
                 resp.media = {"id": id, "user": user, "requires": requires, "grants": grants, "revoke": revoke}
                 resp.status = falcon.HTTP_200
         curr_auth_endpoint = DeathnutAuth()
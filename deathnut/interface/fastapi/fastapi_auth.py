@@ -1,22 +1,76 @@
 import asyncio
 import functools
 
+from deathnut.client.async_deathnut_client import AsyncDeathnutClient
+from deathnut.client.storage import get_storage
 from deathnut.interface.base_auth_endpoint import BaseAuthEndpoint
 from deathnut.interface.base_interface import BaseAuthorizationInterface
 from deathnut.schema.pydantic.dn_schemas_pydantic import DeathnutAuthSchema
+from deathnut.util.circuit_breaker import CircuitOpenError
 from deathnut.util.deathnut_exception import DeathnutException
-from deathnut.util.logger import get_deathnut_logger
+from deathnut.util import server_timing
+from deathnut.util.logger import RateLimitedLogger, get_deathnut_logger
+from deathnut.util.redis import redis_asyncio
+from fastapi import HTTPException
 from redis.exceptions import ConnectionError
 from starlette.requests import Request
 from starlette.responses import JSONResponse
 
 logger = get_deathnut_logger(__name__)
+_throttled_logger = RateLimitedLogger(logger)
+# DeathnutClient options AsyncDeathnutClient does not implement, the sync client is used if set
+SYNC_ONLY_OPTIONS = ("migrate_from", "write_behind", "decision_cache_size", "redis_replicas",
+    "redis_sentinel", "read_your_writes")
 
 class FastapiAuthorization(BaseAuthorizationInterface):
     def __init__(self, app, service, resource_type=None, strict=True, enabled=True, **kwargs):
+        """
+        Decorated coroutines are wrapped in coroutines, so authorization checks are awaited on the
+        server's event loop alongside the handler. Redis I/O goes through an AsyncDeathnutClient
+        when an asyncio connection (async_redis_connection) or redis_host/redis_port are provided;
+        if only a sync redis_connection (or a backend) is given, or the client is configured with
+        an option only the sync client implements (a storage other than "hash", migrate_from,
+        write_behind, decision_cache_size, redis_replicas, redis_sentinel or read_your_writes),
+        the sync client runs in the loop's executor.
+
+        *Other params defined in BaseAuthorizationInterface.
+        """
         super(FastapiAuthorization, self).__init__(service, resource_type, strict, enabled, **kwargs)
         self._app = app
+        self._async_client = self._get_async_client(service, resource_type,
+            **dict(kwargs, metrics=self._metrics))
         self.register_error_handler()
+        if self._server_timing:
+            self.register_server_timing_middleware()
+
+    @staticmethod
+    def _sync_only_option(**kwargs):
+        """A configured option AsyncDeathnutClient does not implement, None if there is none"""
+        if get_storage(kwargs.get("storage")).name != "hash":
+            return "storage"
+        for option in SYNC_ONLY_OPTIONS:
+            if kwargs.get(option):
+                return option
+        return None
+
+    @staticmethod
+    def _get_async_client(service, resource_type, **kwargs):
+        if kwargs.get("backend"):
+            return None
+        option = FastapiAuthorization._sync_only_option(**kwargs)
+        if option is not None:
+            logger.info("%s is not supported by AsyncDeathnutClient, running the sync client in "
+                "the executor", option)
+            return None
+        if "async_redis_connection" in kwargs:
+            return AsyncDeathnutClient(service, resource_type,
+                **dict(kwargs, redis_connection=kwargs["async_redis_connection"]))
+        if "redis_connection" not in kwargs and redis_asyncio is not None:
+            return AsyncDeathnutClient(service, resource_type, **kwargs)
+        return None
+
+    def get_async_client(self):
+        return self._async_client
 
     def register_error_handler(self):
         @self._app.exception_handler(DeathnutException)
@@ -26,11 +80,39 @@ class FastapiAuthorization(BaseAuthorizationInterface):
         async def redis_exception_handler(request: Request, exc: ConnectionError):
             return JSONResponse(status_code=500, content={"message": "could not connect to redis"})
 
+    def register_server_timing_middleware(self):
+        @self._app.middleware("http")
+        async def add_server_timing(request: Request, call_next):
+            response = await call_next(request)
+            value = getattr(request.state, "deathnut_server_timing", None)
+            if value:
+                response.headers.append("Server-Timing", value)
+            return response
+
+    def add_server_timing_header(self, value, request, *args, **kwargs):
+        # written to the response by the middleware, handlers return bodies rather than responses
+        request.state.deathnut_server_timing = value
+
+    def _with_server_timing_async(self, wrapped):
+        """Coroutine version of _with_server_timing"""
+        if not self._server_timing:
+            return wrapped
+        @functools.wraps(wrapped)
+        async def timed(*args, **kwargs):
+            timing, token = server_timing.start()
+            try:
+                return await wrapped(*args, **kwargs)
+            finally:
+                server_timing.finish(token)
+                self.add_server_timing_header(timing.header(), *args, **kwargs)
+        return timed
+
     @staticmethod
     def _execute(dn_func, request, *args, **kwargs):
         request.deathnut_user = kwargs.pop('deathnut_user', 'Unauthenticated')
         request.deathnut_ids = kwargs.pop('deathnut_ids', [])
-        return asyncio.run(dn_func(*args, request=request, **kwargs))
+        request.deathnut_cursor = kwargs.pop('deathnut_cursor', 0)
+        return dn_func(*args, request=request, **kwargs)
 
     @staticmethod
     def get_body_response(ret, *args, **kwargs):
@@ -45,33 +127,183 @@ class FastapiAuthorization(BaseAuthorizationInterface):
     def get_resource_id(id_identifier, request, *args, **kwargs):
         return request.path_params[id_identifier]
 
-    def _execute_asynchronously(self, dn_func, dn_role, dn_rid, request, *args, **kwargs):
-        loop = asyncio.new_event_loop()
-        request.deathnut_user = kwargs.pop('deathnut_user', 'Unauthenticated')
-        asyncio.set_event_loop(loop)
-        results = loop.run_until_complete(asyncio.gather(loop.run_in_executor(None,
-                                          functools.partial(self.is_authorized,
-                                                            request.deathnut_user,dn_role, dn_rid)),
-                                          dn_func(*args, request=request, **kwargs)))
-        if results[0]:
-            return results[1]
-        raise DeathnutException("Not authorized")
+    @staticmethod
+    def get_cursor(request, *args, **kwargs):
+        cursor = kwargs.get('cursor') or request.query_params.get('cursor') or 0
+        try:
+            return int(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor <{}>".format(cursor))
 
     @staticmethod
     def get_dont_wait(request, *args, **kwargs):
-        kwargs.get('dont_wait', None)
         return kwargs.get("dont_wait", request.method == "GET")
 
-    def assign_roles(self, resource_id, roles, **kwargs):
+    @staticmethod
+    async def _run_sync(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func,
+            *args))
+
+    async def _call_client(self, method, *args):
+        """Awaits an AsyncDeathnutClient method, or runs the DeathnutClient one in the executor"""
+        if self._async_client:
+            return await getattr(self._async_client, method)(*args)
+        return await self._run_sync(getattr(self._client, method), *args)
+
+    def requires_role(self, role, id_identifier="id", outage_policy=None, **kwargs):
+        self._check_outage_policy(outage_policy)
+        def decorator(func):
+            if not asyncio.iscoroutinefunction(func):
+                return super(FastapiAuthorization, self).requires_role(role, id_identifier,
+                    outage_policy, **kwargs)(func)
+            @functools.wraps(func)
+            async def wrapped(*args, **kwargs):
+                resource_id = self.get_resource_id(id_identifier, *args, **kwargs)
+                jwt_header = self.get_auth_header(*args, **kwargs)
+                user, enabled, strict = self._get_auth_arguments(jwt_header, **kwargs)
+                dont_wait = self.get_dont_wait(*args, **kwargs)
+                return await self._execute_if_authorized_async(user, role, resource_id, enabled,
+                    strict, dont_wait, server_timing.timed_handler(func), *args,
+                    dn_outage_policy=outage_policy, **kwargs)
+            return self._with_server_timing_async(wrapped)
+        return decorator
+
+    def authentication_required(self, assign=[], uid_field="id", **kwargs):
+        def decorator(func):
+            if not asyncio.iscoroutinefunction(func):
+                return super(FastapiAuthorization, self).authentication_required(assign, uid_field,
+                    **kwargs)(func)
+            @functools.wraps(func)
+            async def wrapped(*args, **kwargs):
+                jwt_header = self.get_auth_header(*args, **kwargs)
+                user, enabled, strict = self._get_auth_arguments(jwt_header, **kwargs)
+                ret = await self._execute_if_authenticated_async(user, enabled, strict,
+                    server_timing.timed_handler(func), *args, **kwargs)
+                if assign:
+                    resp = dict(self.get_body_response(ret, *args, **kwargs))
+                    uid = resp.get(uid_field)
+                    if not uid:
+                        raise DeathnutException("UID field <%s> not found in response <%s>" % (uid_field, resp))
+                    with server_timing.phase(server_timing.REDIS):
+                        await self.assign_roles_async(uid, assign, deathnut_user=user)
+                return ret
+            return self._with_server_timing_async(wrapped)
+        return decorator
+
+    def fetch_accessible_for_user(self, role, paginate=False, **kwargs):
+        def decorator(func):
+            if not asyncio.iscoroutinefunction(func):
+                return super(FastapiAuthorization, self).fetch_accessible_for_user(role, paginate,
+                    **kwargs)(func)
+            @functools.wraps(func)
+            async def wrapped(*args, **kwargs):
+                limit = kwargs.get('limit', 500)
+                jwt_header = self.get_auth_header(*args, **kwargs)
+                user, enabled, strict = self._get_auth_arguments(jwt_header, **kwargs)
+                handler = server_timing.timed_handler(func)
+                if paginate:
+                    cursor = self.get_cursor(*args, **kwargs)
+                    with server_timing.phase(server_timing.REDIS):
+                        next_cursor, deathnut_ids = await self._call_client('get_resources_from',
+                            user, role, cursor, limit)
+                    return await self._execute_if_authenticated_async(user, enabled, strict,
+                        handler, *args, deathnut_ids=deathnut_ids, deathnut_cursor=next_cursor,
+                        **kwargs)
+                with server_timing.phase(server_timing.REDIS):
+                    deathnut_ids = await self.get_accessible_async(user, role, limit)
+                return await self._execute_if_authenticated_async(user, enabled, strict, handler,
+                    *args, deathnut_ids=deathnut_ids, **kwargs)
+            return self._with_server_timing_async(wrapped)
+        return decorator
+
+    async def check_role_async(self, user, role, resource_id):
+        return await self._call_client('check_role', user, role, resource_id)
+
+    async def is_authorized_async(self, user, role, resource_id, outage_policy=None):
+        """Coroutine version of is_authorized"""
+        if not self.is_authenticated(user):
+            return self._record_decision(not self._strict_default)
+        try:
+            with server_timing.phase(server_timing.REDIS):
+                allowed = await self._call_client('check_any_role', user,
+                    self.qualifying_roles(role), resource_id)
+        except CircuitOpenError as exc:
+            allowed = self._outage_decision(exc, outage_policy, user, role, resource_id)
+        else:
+            self._remember_decision(user, role, resource_id, allowed)
+        return self._record_decision(allowed)
+
+    async def get_accessible_async(self, user, role, limit=None):
+        """Coroutine version of get_accessible"""
+        return await self._call_client('get_resources_any_role', user,
+            self.qualifying_roles(role), limit)
+
+    @staticmethod
+    def _discard(task):
+        """Cancels a speculative handler, retrieving its exception should it have finished"""
+        task.cancel()
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+    async def _execute_if_authorized_async(self, dn_user, dn_role, dn_rid, dn_enabled, dn_strict,
+        dn_dont_wait, dn_func, *args, dn_outage_policy=None, **kwargs):
+        """Coroutine version of _execute_if_authorized, dn_func must be a coroutine function"""
+        if not self._is_auth_required(dn_user, dn_enabled, dn_strict):
+            return await self._execute(dn_func, *args, **kwargs)
+        if dn_dont_wait:
+            # fetch the resource while authorization is checked, return it only if authorized.
+            handler = asyncio.ensure_future(self._execute(dn_func, *args, deathnut_user=dn_user,
+                **kwargs))
+            try:
+                is_authorized = await self.is_authorized_async(dn_user, dn_role, dn_rid,
+                    dn_outage_policy)
+            except BaseException:
+                self._discard(handler)
+                raise
+            if is_authorized:
+                return await handler
+            self._discard(handler)
+            self._record_wasted()
+            raise DeathnutException("Not authorized")
+        if await self.is_authorized_async(dn_user, dn_role, dn_rid, dn_outage_policy):
+            return await self._execute(dn_func, *args, deathnut_user=dn_user, **kwargs)
+        raise DeathnutException("Not authorized")
+
+    async def _execute_if_authenticated_async(self, dn_user, dn_enabled, dn_strict, dn_func, *args,
+        **kwargs):
+        """Coroutine version of _execute_if_authenticated, dn_func must be a coroutine function"""
+        if not self._is_auth_required(dn_user, dn_enabled, dn_strict):
+            return await self._execute(dn_func, *args, **kwargs)
+        if self.is_authenticated(dn_user):
+            return await self._execute(dn_func, *args, deathnut_user=dn_user, **kwargs)
+        raise DeathnutException("No authentication provided")
+
+    def _get_deathnut_user(self, **kwargs):
         request = kwargs.get('request')
-        dn_user = kwargs.get('deathnut_user', getattr(request, 'deathnut_user', 'Unauthenticated'))
-        return super(FastapiAuthorization, self)._change_roles(self._client.assign_role, roles, resource_id,
-            deathnut_user=dn_user)
+        return kwargs.get('deathnut_user', getattr(request, 'deathnut_user', 'Unauthenticated'))
+
+    def assign_roles(self, resource_id, roles, **kwargs):
+        return super(FastapiAuthorization, self)._change_roles(self._client.assign_roles, roles, resource_id,
+            deathnut_user=self._get_deathnut_user(**kwargs))
 
     def revoke_roles(self, resource_id, roles, **kwargs):
-        dn_user = kwargs.get('deathnut_user', kwargs['request'].deathnut_user)
-        return super(FastapiAuthorization, self)._change_roles(self._client.revoke_role, roles, resource_id,
-            deathnut_user=dn_user)
+        return super(FastapiAuthorization, self)._change_roles(self._client.revoke_roles, roles, resource_id,
+            deathnut_user=self._get_deathnut_user(**kwargs))
+
+    async def _change_roles_async(self, action, roles, resource_id, **kwargs):
+        user = self._get_deathnut_user(**kwargs)
+        if not self.is_authenticated(user):
+            _throttled_logger.warning("Unauthenticated user attempt to update roles")
+            return
+        if roles:
+            await self._call_client(action, [(user, role, resource_id) for role in roles])
+
+    async def assign_roles_async(self, resource_id, roles, **kwargs):
+        """Coroutine version of assign_roles"""
+        return await self._change_roles_async('assign_roles', roles, resource_id, **kwargs)
+
+    async def revoke_roles_async(self, resource_id, roles, **kwargs):
+        """Coroutine version of revoke_roles"""
+        return await self._change_roles_async('revoke_roles', roles, resource_id, **kwargs)
 
     def create_auth_endpoint(self, name):
         """
@@ -91,20 +323,20 @@ class FastapiAuthEndpoint(BaseAuthEndpoint):
         self._app = app
         super(FastapiAuthEndpoint, self).__init__(auth_o, name)
 
+    async def change_roles_async(self, calling_user, requires, user, grants, resource_id,
+                                 revoke=False):
+        """Coroutine version of change_roles"""
+        roles = self._grants_to_apply(requires, user, grants)
+        if not await self._auth_o._call_client('check_and_change_roles', calling_user, requires,
+                user, roles, resource_id, revoke):
+            raise DeathnutException('Unauthorized to grant')
+
     def generate_auth_endpoint(self):
         @self._app.post(self._name, response_model=DeathnutAuthSchema)
         @self._auth_o.authentication_required(strict=True)
         async def auth(deathnutAuth: DeathnutAuthSchema, request: Request):
-            calling_user = request.deathnut_user
-            if not self._auth_o.get_client().check_role(calling_user, deathnutAuth.requires, deathnutAuth.id):
-                raise DeathnutException('Unauthorized to grant')
-            # make sure the granting user has access to grant all roles.
-            for role in deathnutAuth.grants:
-                self.check_grant_enabled(deathnutAuth.requires, role)
-            if deathnutAuth.revoke:
-                self._auth_o.revoke_roles(deathnutAuth.id, deathnutAuth.grants, deathnut_user=deathnutAuth.user, request=request)
-            else:
-                self._auth_o.assign_roles(deathnutAuth.id, deathnutAuth.grants, deathnut_user=deathnutAuth.user, request=request)
+            await self.change_roles_async(request.deathnut_user, deathnutAuth.requires,
+                deathnutAuth.user, deathnutAuth.grants, deathnutAuth.id, deathnutAuth.revoke)
             return {"id": deathnutAuth.id, "user": deathnutAuth.user, "requires": deathnutAuth.requires,
                     "grants": deathnutAuth.grants, "revoke": deathnutAuth.revoke}
         return auth
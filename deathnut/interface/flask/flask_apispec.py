@@ -50,15 +50,6 @@ class FlaskAPISpecAuthEndpoint(BaseAuthEndpoint):
         @self._auth_o.authentication_required(strict=True)
         def auth(id, user, requires, grants, revoke=False, **kwargs):
             calling_user = kwargs.get('deathnut_user', 'Unauthenticated')
-            if not self._auth_o.get_client().check_role(calling_user, requires, id):
-                raise DeathnutException('Unauthorized to grant')
-            # make sure the granting user has access to grant all roles.
-            for role in grants:
-                self.check_grant_enabled(requires, role)
-            kwargs.update(deathnut_user=user)
-            if revoke:
-                self._auth_o.revoke_roles(id, grants, **kwargs)
-            else:
-                self._auth_o.assign_roles(id, grants, **kwargs)
+            self.change_roles(calling_user, requires, user, grants, id, revoke)
             return {"id": id, "user": user, "requires": requires, "grants": grants, "revoke": revoke}, 200
         return auth
@@ -2,7 +2,7 @@ from abc import ABC
 
 from deathnut.interface.base_interface import BaseAuthorizationInterface
 from deathnut.util.logger import get_deathnut_logger
-from flask import request
+from flask import after_this_request, request
 
 logger = get_deathnut_logger(__name__)
 
@@ -22,6 +22,10 @@ class FlaskAuthorization(BaseAuthorizationInterface, ABC):
             dn_args.update(request.json)
         return dn_args[id_identifier]
 
+    @staticmethod
+    def get_cursor(*args, **kwargs):
+        return int(kwargs.get('cursor') or request.args.get('cursor') or 0)
+
     @staticmethod
     def get_body_response(ret, *args, **kwargs):
         return ret[0]
@@ -29,3 +33,9 @@ class FlaskAuthorization(BaseAuthorizationInterface, ABC):
     @staticmethod
     def get_dont_wait(*args, **kwargs):
         return kwargs.get('dont_wait', request.method == 'GET')
+
+    def add_server_timing_header(self, value, *args, **kwargs):
+        @after_this_request
+        def add_server_timing(response):
+            response.headers.add('Server-Timing', value)
+            return response
@@ -4,7 +4,6 @@ from deathnut.schema.restplus.dn_schemas_restplus import \
     register_restplus_schemas
 from deathnut.util.deathnut_exception import DeathnutException
 from deathnut.util.logger import get_deathnut_logger
-from deathnut.util.redis import get_redis_connection
 from flask import request
 from flask_restplus import Resource
 from redis.exceptions import ConnectionError
@@ -13,9 +12,8 @@ logger = get_deathnut_logger(__name__)
 
 class FlaskRestplusAuthorization(FlaskAuthorization):
     def __init__(self, api, service, resource_type=None, strict=True, enabled=True, **kwargs):
-        redis = get_redis_connection(**kwargs)
         super(FlaskRestplusAuthorization, self).__init__(service,resource_type=resource_type,
-            strict=strict, enabled=enabled, redis_connection=redis)
+            strict=strict, enabled=enabled, **kwargs)
         self._api = api
         self.deathnut_auth_schema, self.deathnut_error_schema = register_restplus_schemas(api)
         self.register_error_handler()
@@ -65,15 +63,6 @@ class FlaskRestplusAuthEndpoint(BaseAuthEndpoint):
                 grants = dn_auth["grants"]
                 revoke = dn_auth.get("revoke", False)
                 calling_user = kwargs.get('deathnut_user', 'Unauthenticated')
-                if not interface._auth_o.get_client().check_role(calling_user, requires, id):
-                    raise DeathnutException('Unauthorized to grant')
-                # make sure the granting user has access to grant all roles.
-                for role in grants:
-                    interface.check_grant_enabled(requires, role)
-                kwargs.update(deathnut_user=user)
-                if revoke:
-                    interface._auth_o.revoke_roles(id, grants, **kwargs)
-                else:
-                    interface._auth_o.assign_roles(id, grants, **kwargs)
+                interface.change_roles(calling_user, requires, user, grants, id, revoke)
                 return {"id": id, "user": user, "requires": requires, "grants": grants, "revoke": revoke}, 200
         self._ns.add_resource(DeathnutAuth, self._name)
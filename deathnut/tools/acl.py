@@ -0,0 +1,91 @@
+"""
+Streaming export/import of deathnut grants as NDJSON, one object per line:
+
+    {"user": "michael", "role": "own", "ids": ["1", "2", "3"]}
+
+A (user, role) with many ids spans several lines. Export walks redis with SCAN/HSCAN and import
+loads fixed size batches, so memory stays bounded however many grants are moved. Ids are
+written as decoded, the file can be loaded into a service/resource type or storage other than
+the one it was exported from.
+"""
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from deathnut.util.logger import get_deathnut_logger
+
+logger = get_deathnut_logger(__name__)
+
+
+def export_grants(client, out, count=1000):
+    """
+    Writes every grant of client's service to the text stream out.
+
+    Parameters
+    ----------
+    client: DeathnutClient
+        Client of the service to export.
+    out: file
+        Text stream NDJSON lines are written to.
+    count: int
+        SCAN/HSCAN batch size, also the maximum number of ids per line.
+
+    Returns
+    -------
+    int
+        Number of grants written.
+    """
+    total = 0
+    for user, role, ids in client.scan_grants(count):
+        out.write(json.dumps({"user": user, "role": role, "ids": ids}) + "\n")
+        total += len(ids)
+    return total
+
+
+def read_grants(lines):
+    """Yields (user, role, resource_id) grants from NDJSON lines, skipping blank ones"""
+    for line in lines:
+        if line.strip():
+            record = json.loads(line)
+            for resource_id in record["ids"]:
+                yield record["user"], record["role"], resource_id
+
+
+def _batches(grants, batch_size):
+    batch = []
+    for grant in grants:
+        batch.append(grant)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_grants(client, lines, batch_size=5000, max_in_flight=4):
+    """
+    Assigns every grant read from NDJSON lines, batch_size grants per pipeline with up to
+    max_in_flight pipelines running concurrently (each on its own pooled connection). At most
+    max_in_flight + 1 batches are held in memory.
+
+    Returns
+    -------
+    int
+        Number of grants loaded.
+    """
+    def load(batch):
+        client.assign_roles(batch)
+        return len(batch)
+
+    total = 0
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max_in_flight,
+            thread_name_prefix="deathnut-import") as pool:
+        for batch in _batches(read_grants(lines), batch_size):
+            if len(in_flight) >= max_in_flight:
+                total += in_flight.popleft().result()
+            in_flight.append(pool.submit(load, batch))
+        while in_flight:
+            total += in_flight.popleft().result()
+    client.flush()
+    return total
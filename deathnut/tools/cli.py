@@ -0,0 +1,98 @@
+"""
+deathnut-acl: export/import a service's grants as NDJSON, ex:
+
+    deathnut-acl export --service recipes --redis-host 10.0.0.3 -o recipes.ndjson
+    deathnut-acl import --service recipes --redis-url redis://localhost:6379/0 -i recipes.ndjson
+    deathnut-acl migrate --service recipes --redis-host 10.0.0.3 --from set --to hash
+    deathnut-acl reindex --service recipes --redis-host 10.0.0.3
+
+'-' (the default) reads from stdin/writes to stdout.
+"""
+import argparse
+import sys
+
+from deathnut.client.deathnut_client import DeathnutClient
+from deathnut.tools.acl import export_grants, import_grants
+from deathnut.tools.migrate import LayoutMigrator
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog="deathnut-acl", description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    export = commands.add_parser("export", help="Write every grant to NDJSON")
+    export.add_argument("-o", "--output", default="-")
+    export.add_argument("--count", type=int, default=1000, help="SCAN/HSCAN batch size")
+    load = commands.add_parser("import", help="Assign every grant read from NDJSON")
+    load.add_argument("-i", "--input", default="-")
+    load.add_argument("--batch-size", type=int, default=5000, help="Grants per pipeline")
+    load.add_argument("--max-in-flight", type=int, default=4,
+        help="Pipelines sent concurrently")
+    migrate = commands.add_parser("migrate", help="Convert keys between storage layouts, "
+        "resuming from the last checkpoint")
+    migrate.add_argument("--from", dest="source", required=True, choices=["set", "hash", "bitmap"])
+    migrate.add_argument("--to", dest="target", required=True, choices=["set", "hash", "bitmap"])
+    migrate.add_argument("--batch-size", type=int, default=100, help="SCAN count hint")
+    migrate.add_argument("--latency-target", type=float, default=0.005,
+        help="PING seconds above which the migration slows down")
+    reindex = commands.add_parser("reindex", help="Rebuild every user's role index (read by "
+        "get_roles) from existing role keys")
+    reindex.add_argument("--count", type=int, default=1000, help="SCAN batch size")
+    for command in (export, load, migrate, reindex):
+        command.add_argument("--service", required=True)
+        command.add_argument("--resource-type")
+        command.add_argument("--storage", default="hash", choices=["set", "hash", "bitmap"])
+        command.add_argument("--hash-tag-keys", action="store_true")
+        command.add_argument("--redis-url")
+        command.add_argument("--redis-host")
+        command.add_argument("--redis-port", type=int)
+        command.add_argument("--redis-pw")
+        command.add_argument("--redis-db", type=int, default=0)
+        command.add_argument("--redis-cluster", action="store_true")
+    return parser
+
+
+def _open(path, mode):
+    if path == "-":
+        return sys.stdout if "w" in mode else sys.stdin
+    return open(path, mode)
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    client = DeathnutClient(args.service, args.resource_type, storage=args.storage,
+        hash_tag_keys=args.hash_tag_keys, redis_url=args.redis_url, redis_host=args.redis_host,
+        redis_port=args.redis_port, redis_pw=args.redis_pw, redis_db=args.redis_db,
+        redis_cluster=args.redis_cluster,
+        redis_max_connections=getattr(args, "max_in_flight", 1) + 1)
+    if args.command == "export":
+        stream = _open(args.output, "w")
+        try:
+            total = export_grants(client, stream, args.count)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+        print("Exported {} grant(s)".format(total), file=sys.stderr)
+    elif args.command == "migrate":
+        stats = LayoutMigrator(client, args.source, args.target, args.batch_size,
+            args.latency_target).run()
+        print("Converted {converted} of {scanned} key(s), {ids} id(s)".format(**stats),
+            file=sys.stderr)
+    elif args.command == "reindex":
+        total = client.rebuild_role_indexes(args.count)
+        print("Indexed {} role(s)".format(total), file=sys.stderr)
+    else:
+        stream = _open(args.input, "r")
+        try:
+            total = import_grants(client, stream, args.batch_size, args.max_in_flight)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        print("Imported {} grant(s)".format(total), file=sys.stderr)
+    client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
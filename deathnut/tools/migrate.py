@@ -0,0 +1,136 @@
+"""
+Online conversion of a service's role keys from one storage layout to another, ex: the original
+sets to hashes (see docs/redis.md):
+
+    1. deploy clients with storage="hash", migrate_from="set" (they read and write each key in
+       the layout it currently has)
+    2. LayoutMigrator(client, "set", "hash").run()
+    3. deploy clients with storage="hash" only
+"""
+import time
+
+from deathnut.client.deathnut_client import _escape_glob
+from deathnut.client.storage import get_storage
+from deathnut.util.deathnut_exception import DeathnutException
+from deathnut.util.logger import get_deathnut_logger
+from deathnut.util.redis import is_cluster_connection
+
+logger = get_deathnut_logger(__name__)
+
+
+class LayoutMigrator(object):
+    """
+    Walks the service's role keys with SCAN, batch_size keys at a time, converting each key still
+    in the source layout. A key is read under WATCH and rewritten in one MULTI/EXEC, so writes
+    racing with the conversion are never lost (the conversion is retried). Only one key is held
+    in memory at a time.
+
+    The SCAN cursor is checkpointed in redis ('{service}-migration:{source}->{target}') after every
+    batch, so an interrupted run resumes where it stopped. After every batch the migrator PINGs
+    redis and backs off (up to max_pause seconds) while the round trip exceeds latency_target.
+
+    Keys holding ids the target layout cannot store (ex: non integer ids for bitmap storage) are
+    logged, counted as skipped and left untouched in the source layout. The checkpoint still moves
+    past them; once they are fixed a new run (the checkpoint is removed when a run completes)
+    converts them.
+
+    Not available on Redis Cluster, where SCAN has no single resumable cursor.
+
+    Parameters
+    ----------
+    client: DeathnutClient
+        Client of the service to migrate.
+    source: str or storage instance
+        Layout keys are converted from.
+    target: str or storage instance
+        Layout keys are converted to.
+    batch_size: int
+        SCAN count hint.
+    latency_target: float
+        Seconds of PING round trip above which the migrator slows down.
+    max_pause: float
+        Longest pause between batches.
+    """
+    def __init__(self, client, source, target, batch_size=100, latency_target=0.005,
+        max_pause=1.0):
+        self._conn = client.get_redis_connection()
+        if is_cluster_connection(self._conn):
+            raise DeathnutException("Layout migration is not supported on Redis Cluster")
+        self._name = client.get_name()
+        self._source = get_storage(source)
+        self._target = get_storage(target)
+        self._source.bind(self._name)
+        self._target.bind(self._name)
+        self._batch_size = batch_size
+        self._latency_target = latency_target
+        self._max_pause = max_pause
+        self._pause = 0.0
+        self._checkpoint_key = "{}-migration:{}->{}".format(self._name, self._source.name,
+            self._target.name)
+
+    def _convert(self, key):
+        """Rewrites key in the target layout, returns its number of ids (None if skipped)"""
+        def convert(pipe):
+            if pipe.type(key).decode() != self._source.redis_type:
+                return None
+            ids = self._source.decode(self._conn, self._source.members(pipe, key))
+            members = self._target.encode(self._conn, ids, True)
+            pipe.multi()
+            pipe.delete(key)
+            for member in members:
+                self._target.queue_assign(pipe, key, member)
+            return len(ids)
+        return self._conn.transaction(convert, key, value_from_callable=True)
+
+    def _throttle(self):
+        start = time.perf_counter()
+        self._conn.ping()
+        if time.perf_counter() - start > self._latency_target:
+            self._pause = min(self._max_pause, max(self._pause * 2, 0.01))
+        else:
+            self._pause /= 2
+        if self._pause >= 0.01:
+            time.sleep(self._pause)
+            return self._pause
+        return 0.0
+
+    def run(self, max_batches=None):
+        """
+        Migrates keys from the checkpoint on, stopping after max_batches SCAN batches if set.
+
+        Returns
+        -------
+        dict
+            scanned/converted/skipped keys, ids moved, seconds spent paused and whether the
+            keyspace was fully walked (in which case the checkpoint is removed).
+        """
+        stats = {"scanned": 0, "converted": 0, "skipped": 0, "ids": 0, "paused": 0.0,
+            "done": False}
+        cursor = int(self._conn.get(self._checkpoint_key) or 0)
+        match = _escape_glob("{}:".format(self._name)) + "*"
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            cursor, keys = self._conn.scan(cursor, match=match, count=self._batch_size)
+            for key in keys:
+                stats["scanned"] += 1
+                try:
+                    converted = self._convert(key)
+                except DeathnutException as exc:
+                    logger.warning("Skipping key <%s>, it cannot be converted to %s: %s", key,
+                        self._target.name, exc)
+                    stats["skipped"] += 1
+                    continue
+                if converted is not None:
+                    stats["converted"] += 1
+                    stats["ids"] += converted
+            batches += 1
+            if cursor == 0:
+                self._conn.delete(self._checkpoint_key)
+                stats["done"] = True
+                break
+            self._conn.set(self._checkpoint_key, cursor)
+            stats["paused"] += self._throttle()
+        logger.warning("Migrated %d of %d key(s) from %s to %s for <%s>, skipped %d",
+            stats["converted"], stats["scanned"], self._source.name, self._target.name, self._name,
+            stats["skipped"])
+        return stats
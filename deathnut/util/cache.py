@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    Thread safe, bounded LRU cache with an optional per-entry TTL.
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of entries kept. The least recently used entry is evicted first.
+    ttl: float
+        Seconds an entry stays valid. None means entries only leave the cache through eviction or
+        invalidation.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def generation(self):
+        """Snapshot to pass to set() so values read before an invalidation are not cached"""
+        return self._generation
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key, MISSING)
+            if entry is not MISSING:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    self._touch(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            expires = time.time() + self._ttl if self._ttl is not None else None
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires)
+            self._added(key)
+            while len(self._data) > self._maxsize:
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+            self._cleared()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data),
+                "hit_ratio": float(self.hits) / lookups if lookups else 0.0}
+
+    def _touch(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+
+    def _remove(self, key):
+        del self._data[key]
+
+    def _added(self, key):
+        pass
+
+    def _cleared(self):
+        pass
+
+
+class DecisionCache(LRUCache):
+    """
+    LRU cache of authorization decisions keyed on (redis_key, resource_id).
+
+    Keeps a secondary index of the resource ids cached for each redis key so a keyspace
+    notification for '{service}:{user}:{role}' can drop every decision derived from that hash.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        super(DecisionCache, self).__init__(maxsize, ttl)
+        self._by_redis_key = {}
+
+    def invalidate_redis_key(self, redis_key):
+        with self._lock:
+            self._generation += 1
+            for resource_id in list(self._by_redis_key.get(redis_key, ())):
+                self._remove((redis_key, resource_id))
+
+    def _added(self, key):
+        self._by_redis_key.setdefault(key[0], set()).add(key[1])
+
+    def _remove(self, key):
+        super(DecisionCache, self)._remove(key)
+        resource_ids = self._by_redis_key.get(key[0])
+        if resource_ids is not None:
+            resource_ids.discard(key[1])
+            if not resource_ids:
+                del self._by_redis_key[key[0]]
+
+    def _cleared(self):
+        self._by_redis_key.clear()
@@ -0,0 +1,113 @@
+import functools
+import threading
+import time
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised without contacting redis while the circuit breaker is open"""
+
+
+class CircuitBreaker(object):
+    """
+    Fails redis operations fast once redis looks unhealthy instead of letting every request wait
+    for a socket timeout.
+
+    After failure_threshold consecutive failures (connection errors, timeouts, or calls slower than
+    latency_threshold) the breaker opens and calls raise CircuitOpenError immediately. After
+    reset_timeout seconds a single trial call is let through: success closes the breaker, failure
+    opens it again.
+
+    Note: a call can only be counted once it returns, set redis_socket_timeout so calls hanging on
+    a dead socket fail within a bounded time.
+
+    Parameters
+    ----------
+    failure_threshold: int
+        Consecutive failures opening the breaker.
+    latency_threshold: float
+        Seconds above which a successful call still counts as a failure, None to only count errors.
+    reset_timeout: float
+        Seconds the breaker stays open before a trial call is allowed.
+    """
+    def __init__(self, failure_threshold=5, latency_threshold=None, reset_timeout=5.0):
+        self._failure_threshold = failure_threshold
+        self._latency_threshold = latency_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self.rejected = 0
+
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call must not reach redis"""
+        if self._state == CLOSED:
+            return
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+                self._state = HALF_OPEN
+            if self._state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            if self._state != CLOSED:
+                self.rejected += 1
+                raise CircuitOpenError("Circuit breaker open, redis unavailable")
+
+    def after_call(self, elapsed, error=None):
+        """Records the outcome of a call let through by before_call"""
+        if error is not None and (isinstance(error, CircuitOpenError) or
+                not isinstance(error, (ConnectionError, TimeoutError))):
+            # not a sign of redis health either way
+            with self._lock:
+                self._trial_running = False
+            return
+        failed = error is not None or (self._latency_threshold is not None and
+            elapsed > self._latency_threshold)
+        if not failed and self._state == CLOSED and not self._failures:
+            return
+        with self._lock:
+            self._trial_running = False
+            if not failed:
+                self._failures = 0
+                self._state = CLOSED
+                return
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self._failure_threshold:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        state = self.state()
+        return {"state": state, "open": state != CLOSED, "rejected": self.rejected}
+
+
+def guarded(func):
+    """Method decorator running the call through self._breaker, if one is configured"""
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        breaker = self._breaker
+        if breaker is None:
+            return func(self, *args, **kwargs)
+        breaker.before_call()
+        start = time.perf_counter()
+        try:
+            result = func(self, *args, **kwargs)
+        except Exception as exc:
+            breaker.after_call(time.perf_counter() - start, exc)
+            raise
+        breaker.after_call(time.perf_counter() - start)
+        return result
+    return wrapped
@@ -0,0 +1,70 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BoundedExecutor(object):
+    """
+    Lazily created ThreadPoolExecutor with a bound on outstanding work.
+
+    At most max_workers tasks run while up to queue_limit more wait for a thread. Submissions past
+    that are rejected (try_submit returns None) so callers can fall back to doing the work inline
+    instead of piling up behind a saturated pool.
+
+    Parameters
+    ----------
+    max_workers: int
+        Number of threads. Defaults to the ThreadPoolExecutor default, min(32, cpu_count + 4).
+    queue_limit: int
+        Number of tasks allowed to wait for a free thread. Defaults to max_workers.
+    """
+    def __init__(self, max_workers=None, queue_limit=None):
+        self._max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self._queue_limit = self._max_workers if queue_limit is None else queue_limit
+        self._slots = threading.BoundedSemaphore(self._max_workers + self._queue_limit)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._outstanding = 0
+        self._submitted = 0
+        self._rejected = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._max_workers,
+                        thread_name_prefix="deathnut")
+        return self._executor
+
+    def try_submit(self, fn, *args, **kwargs):
+        """Returns a Future, or None if the executor is saturated"""
+        if not self._slots.acquire(False):
+            with self._lock:
+                self._rejected += 1
+            return None
+        with self._lock:
+            self._submitted += 1
+            self._outstanding += 1
+        try:
+            future = self._get_executor().submit(fn, *args, **kwargs)
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, _):
+        with self._lock:
+            self._outstanding -= 1
+        self._slots.release()
+
+    def metrics(self):
+        with self._lock:
+            return {"max_workers": self._max_workers, "queue_limit": self._queue_limit,
+                    "outstanding": self._outstanding,
+                    "queue_depth": max(0, self._outstanding - self._max_workers),
+                    "submitted": self._submitted, "rejected": self._rejected}
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
@@ -1,14 +1,65 @@
 import base64
 import json
 
+from deathnut.util.cache import MISSING, LRUCache
 from deathnut.util.logger import get_deathnut_logger
 
+try:
+    import orjson
+    fast_json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        fast_json_loads = ujson.loads
+    except ImportError:
+        fast_json_loads = json.loads
+
 logger = get_deathnut_logger(__name__)
 
 
+def make_user_extractor(json_loads=None):
+    """
+    Returns a function extracting the user id from a raw X-Endpoint-Api-Userinfo header value.
+
+    Parameters
+    ----------
+    json_loads: function
+        JSON parser to use. Defaults to the fastest one installed (orjson, ujson, then json).
+    """
+    loads = json_loads or fast_json_loads
+    def extract_user(jwt_header):
+        decoded_token = loads(base64.b64decode(jwt_header))
+        # firebase style tokens nest the user id in a json encoded 'claims' field
+        return decoded_token.get("user_id") or loads(decoded_token['claims'])['user_id']
+    return extract_user
+
+
+_user_extractor = make_user_extractor()
+_user_cache = LRUCache(maxsize=4096)
+
+
+def set_user_extractor(extractor):
+    """Replaces the function mapping a raw header to a user id, clearing cached users"""
+    global _user_extractor
+    _user_extractor = extractor
+    _user_cache.clear()
+
+
+def configure_user_cache(maxsize):
+    """Sets how many distinct headers are remembered. 0 disables caching"""
+    global _user_cache
+    _user_cache = LRUCache(maxsize=maxsize)
+
+
+def get_user_cache_stats():
+    return _user_cache.stats()
+
+
 def get_user_from_jwt_header(jwt_header):
     user = "Unauthenticated"
     if jwt_header:
-        decoded_token = json.loads(base64.b64decode(jwt_header))
-        user = decoded_token.get("user_id") or json.loads(decoded_token['claims'])['user_id']
+        user = _user_cache.get(jwt_header)
+        if user is MISSING:
+            user = _user_extractor(jwt_header)
+            _user_cache.set(jwt_header, user)
     return user
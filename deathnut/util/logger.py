@@ -1,17 +1,108 @@
+"""
+Deathnut logs through the 'deathnut' logger only, the root logger is left to the application.
+Records are put on a bounded queue and written by a background QueueListener so request threads
+never block on stdout or stackdriver, records are dropped (and counted) if the queue is full.
+"""
+import atexit
 import logging
+import queue
 import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
 
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.INFO)
+DEFAULT_QUEUE_SIZE = 10000
 
-try:
-    import sofrito
+package_logger = logging.getLogger("deathnut")
+_listener = None
 
-    root_logger.handlers = [sofrito.stackdriver_logging.stackdriver_handler("deathnut")]
-except ImportError:
-    root_logger.handlers = [logging.StreamHandler(sys.stdout)]
-except:
-    root_logger.handlers = [sofrito.stackdriver_logging.stackdriver_handler()]
+
+def _default_handler():
+    try:
+        import sofrito
+    except ImportError:
+        return logging.StreamHandler(sys.stdout)
+    try:
+        return sofrito.stackdriver_logging.stackdriver_handler("deathnut")
+    except:
+        return sofrito.stackdriver_logging.stackdriver_handler()
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler which drops records instead of raising when the queue is full"""
+    def __init__(self, record_queue):
+        super(DroppingQueueHandler, self).__init__(record_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging(handler=None, level=logging.INFO, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    (Re)configures the 'deathnut' logger to write asynchronously to handler, by default stackdriver
+    if sofrito is installed, otherwise stdout. Pass handler=False to leave deathnut records to
+    propagate to the application's own logging configuration instead.
+    """
+    global _listener
+    stop_logging()
+    package_logger.handlers = []
+    package_logger.setLevel(level)
+    if handler is False:
+        package_logger.propagate = True
+        return
+    record_queue = queue.Queue(queue_size)
+    package_logger.addHandler(DroppingQueueHandler(record_queue))
+    package_logger.propagate = False
+    _listener = QueueListener(record_queue, handler or _default_handler(),
+        respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Writes out queued records and stops the background listener"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+configure_logging()
+
+
+class RateLimitedLogger(object):
+    """
+    Logs a given message at most once per interval seconds, repeats in between are counted and
+    reported with the next message that gets through.
+    """
+    def __init__(self, logger, interval=60.0):
+        self._logger = logger
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._last = {}
+        self._suppressed = {}
+
+    def log(self, level, msg, *args):
+        if not self._logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(msg)
+            if last is not None and now - last < self._interval:
+                self._suppressed[msg] = self._suppressed.get(msg, 0) + 1
+                return
+            self._last[msg] = now
+            suppressed = self._suppressed.pop(msg, 0)
+        if suppressed:
+            msg, args = msg + " (%d similar messages suppressed)", args + (suppressed,)
+        self._logger.log(level, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
 
 
 def get_deathnut_logger(name):
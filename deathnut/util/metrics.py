@@ -0,0 +1,147 @@
+import functools
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class NoopMetrics(object):
+    """
+    Instrumentation hook interface, also the default which records nothing.
+
+    Deathnut reports:
+        deathnut_operation_seconds (histogram, label operation): client latency per operation.
+        deathnut_authorization_total (counter, label result): allow/deny decisions.
+        deathnut_speculative_wasted_total (counter): dont_wait handlers that ran for a denied user.
+        deathnut_executor_queue_depth, deathnut_decision_cache_hit_ratio,
+        deathnut_user_cache_hit_ratio, deathnut_circuit_open (gauges, read when collected).
+    Every metric also has a service label, the name of the client's service (and resource type).
+    """
+    enabled = False
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def register_gauge(self, name, callback, **labels):
+        pass
+
+
+class PrometheusMetrics(NoopMetrics):
+    """
+    Thread safe in-process metrics rendered in the Prometheus text exposition format, ex with
+    flask:
+
+        metrics = PrometheusMetrics()
+        auth_o = FlaskAPISpecAuthorization(app, 'recipes', metrics=metrics, ...)
+
+        @app.route('/metrics')
+        def export_metrics():
+            return metrics.render(), 200, {'Content-Type': PrometheusMetrics.CONTENT_TYPE}
+
+    Parameters
+    ----------
+    buckets: tuple
+        Upper bounds (seconds) of histogram buckets.
+    """
+    enabled = True
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self._buckets), 0.0, 0]
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def increment(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def register_gauge(self, name, callback, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = callback
+
+    def get_count(self, name, **labels):
+        """Value of a counter, or number of observations of a histogram"""
+        key = self._key(name, labels)
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][2]
+            return self._counters.get(key, 0)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\")
+            .replace('"', '\\"')) for k, v in pairs) + "}"
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            histograms = dict((k, (list(v[0]), v[1], v[2])) for k, v in self._histograms.items())
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        lines = []
+        typed = set()
+        def add_type(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} {}".format(name, kind))
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            add_type(name, "histogram")
+            for bound, bucket_count in zip(self._buckets, buckets):
+                lines.append("{}_bucket{} {}".format(name, self._labels(labels, [("le", bound)]),
+                    bucket_count))
+            lines.append("{}_bucket{} {}".format(name, self._labels(labels, [("le", "+Inf")]),
+                count))
+            lines.append("{}_sum{} {}".format(name, self._labels(labels), total))
+            lines.append("{}_count{} {}".format(name, self._labels(labels), count))
+        for (name, labels), value in sorted(counters.items()):
+            add_type(name, "counter")
+            lines.append("{}{} {}".format(name, self._labels(labels), value))
+        for (name, labels), callback in sorted(gauges.items(), key=lambda item: item[0]):
+            value = callback()
+            if value is None:
+                continue
+            add_type(name, "gauge")
+            lines.append("{}{} {}".format(name, self._labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+def timed(operation):
+    """Method decorator recording the call's latency on self._metrics as operation"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(self, *args, **kwargs):
+            if not self._metrics.enabled:
+                return func(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self._metrics.observe("deathnut_operation_seconds", time.perf_counter() - start,
+                    operation=operation, service=self._name)
+        return wrapped
+    return decorator
@@ -1,16 +1,103 @@
+import threading
+import time
+
 import redis
 from deathnut.util.deathnut_exception import DeathnutException
 from deathnut.util.logger import get_deathnut_logger
+from redis.sentinel import Sentinel
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:
+    redis_asyncio = None
+
+try:
+    from redis.cluster import RedisCluster
+    from redis.exceptions import RedisClusterException
+    _CLUSTER_ERRORS = (RedisClusterException,)
+except ImportError:
+    _CLUSTER_ERRORS = ()
+    try:
+        from rediscluster import RedisCluster
+        from rediscluster.exceptions import RedisClusterException as LegacyClusterException
+        _CLUSTER_ERRORS += (LegacyClusterException,)
+    except ImportError:
+        RedisCluster = None
+
+try:
+    from redis.asyncio.cluster import RedisCluster as AsyncRedisCluster
+except ImportError:
+    AsyncRedisCluster = None
 
 logger = get_deathnut_logger(__name__)
 
+_connections = {}
+_connections_lock = threading.Lock()
+
+_POOL_OPTIONS = {
+    "redis_max_connections": "max_connections",
+    "redis_socket_timeout": "socket_timeout",
+    "redis_socket_connect_timeout": "socket_connect_timeout",
+    "redis_health_check_interval": "health_check_interval",
+}
+
+
+def _pool_options(kwargs):
+    return dict((option, kwargs[kwarg]) for kwarg, option in _POOL_OPTIONS.items()
+        if kwargs.get(kwarg) is not None)
+
+
+def _shared_connection(kind, kwargs, factory):
+    """
+    Returns the connection registered for these connection kwargs, creating it with factory if
+    needed. Interfaces/clients configured for the same redis therefore share a single pool.
+    """
+    options = _pool_options(kwargs)
+    if not kwargs.get("redis_url"):
+        if None in (kwargs.get("redis_host"), kwargs.get("redis_port")):
+            raise DeathnutException(
+                "redis_host and redis_port kwargs must be provided if redis connection not passed"
+            )
+    key = (kind, bool(kwargs.get("redis_cluster")), kwargs.get("redis_url"),
+        kwargs.get("redis_host"), kwargs.get("redis_port"), kwargs.get("redis_pw"),
+        kwargs.get("redis_db")) + tuple(sorted(options.items()))
+    with _connections_lock:
+        client = _connections.get(key)
+        if client is None:
+            client = factory(options)
+            _connections[key] = client
+        return client
+
+
+def close_redis_connections():
+    """
+    Disconnects and forgets every shared sync connection, ex: after forking worker processes.
+    asyncio connections are only forgotten (they must be closed from their event loop).
+    """
+    with _connections_lock:
+        for key, client in _connections.items():
+            if key[0] == "sentinel":
+                for sentinel in client.sentinels:
+                    sentinel.connection_pool.disconnect()
+            elif key[0] == "sync":
+                pool = getattr(client, "connection_pool", None)
+                if pool is not None:
+                    pool.disconnect()
+                elif hasattr(client, "disconnect_connection_pools"):
+                    client.disconnect_connection_pools()
+        _connections.clear()
+
 
 def get_redis_connection(**kwargs):
     """
-    Returns a redis.Redis connection after verifying the connection is working.
+    Returns a redis.Redis connection.
+
+    No command is sent here: redis-py connects lazily on first use, so creating an interface never
+    blocks on (or silently swallows) an unreachable redis.
 
-    If redis_connection kwargs is not passed, will attempt to create a connection from the
-    redis_host, redis_port, redis_pw, redis_db kwargs.
+    If redis_connection kwargs is not passed, a connection is created from redis_url or from the
+    redis_host, redis_port, redis_pw, redis_db kwargs. Connections created this way are shared by
+    every client asking for the same server and options.
 
     Kwargs Parameters
     ----------
@@ -18,6 +105,9 @@ def get_redis_connection(**kwargs):
         redis client class. Allows deathnut clients to inject their custom redis connection.
         Clients that do not wish to handle their own redis can provide [redis_host, redis_port,
         redis_pw, redis_str] and we will create a default connection for them.
+    redis_url: str
+        redis:// (or rediss://, unix://) url of the server. Takes precedence over redis_host etc.
+        *Note: used only if redis_connection not provided
     redis_host: str
         Hostname of redis server
         *Note: used only if redis_connection not provided
@@ -30,23 +120,189 @@ def get_redis_connection(**kwargs):
     redis_db: int
         Redis database index
         *Note: used only if redis_connection not provided
+    redis_cluster: bool
+        If True, the server is a startup node of a Redis Cluster and a RedisCluster client is
+        created (requires redis>=4.1 or redis-py-cluster).
+        *Note: used only if redis_connection not provided
+    redis_max_connections: int
+        Maximum size of the connection pool.
+    redis_socket_timeout: float
+        Seconds to wait on a command before raising a TimeoutError.
+    redis_socket_connect_timeout: float
+        Seconds to wait while connecting before raising.
+    redis_health_check_interval: int
+        Seconds a connection may sit idle before it is checked with a PING prior to use.
+    redis_sentinel: dict
+        {"sentinels": [(host, port), ...], "service_name": str, "password": str}. If provided the
+        current primary of service_name is discovered through sentinel.
     """
     if "redis_connection" in kwargs:
-        client = kwargs["redis_connection"]
-    else:
-        redis_host = kwargs.get("redis_host", None)
-        redis_port = kwargs.get("redis_port", None)
-        redis_pw = kwargs.get("redis_pw", None)
-        redis_db = kwargs.get("redis_db", None)
-        if None in (redis_host, redis_port):
-            raise DeathnutException(
-                "redis_host and redis_port kwargs must be provided if redis connection not passed"
-            )
-        client = redis.Redis(
-            host=redis_host, port=redis_port, password=redis_pw, db=redis_db
-        )
+        return kwargs["redis_connection"]
+    if kwargs.get("redis_sentinel"):
+        return _sentinel_connection(kwargs)
+    if kwargs.get("redis_cluster") and RedisCluster is None:
+        raise DeathnutException("redis cluster support requires redis>=4.1 "
+            "(pip install deathnut[cluster])")
+    def create(options):
+        if kwargs.get("redis_cluster"):
+            if kwargs.get("redis_url"):
+                return RedisCluster.from_url(kwargs["redis_url"], **options)
+            return RedisCluster(host=kwargs["redis_host"], port=kwargs["redis_port"],
+                password=kwargs.get("redis_pw"), **options)
+        if kwargs.get("redis_url"):
+            return redis.Redis.from_url(kwargs["redis_url"], **options)
+        return redis.Redis(host=kwargs["redis_host"], port=kwargs["redis_port"],
+            password=kwargs.get("redis_pw"), db=kwargs.get("redis_db"), **options)
+    return _shared_connection("sync", kwargs, create)
+
+
+def _get_sentinel(kwargs):
+    config = kwargs["redis_sentinel"]
+    key = ("sentinel", tuple(tuple(x) for x in config["sentinels"]), config.get("password"))
+    with _connections_lock:
+        sentinel = _connections.get(key)
+        if sentinel is None:
+            sentinel = Sentinel(config["sentinels"], password=config.get("password"),
+                socket_timeout=kwargs.get("redis_socket_timeout"))
+            _connections[key] = sentinel
+        return sentinel
+
+
+def _sentinel_connection(kwargs, replica=False):
+    """Shared connection to the primary (or a replica) of the sentinel's service"""
+    config = kwargs["redis_sentinel"]
+    options = _pool_options(kwargs)
+    key = ("sync", "sentinel", tuple(tuple(x) for x in config["sentinels"]),
+        config["service_name"], config.get("password"), replica) + tuple(sorted(options.items()))
+    sentinel = _get_sentinel(kwargs)
+    with _connections_lock:
+        client = _connections.get(key)
+        if client is None:
+            connect = sentinel.slave_for if replica else sentinel.master_for
+            client = connect(config["service_name"], **options)
+            _connections[key] = client
+        return client
+
+
+def get_redis_replicas(**kwargs):
+    """
+    Returns the list of read replica connections configured through redis_replicas (connections or
+    dicts of get_redis_connection kwargs) or redis_sentinel. Empty if neither is set.
+    """
+    if kwargs.get("redis_sentinel"):
+        return [_sentinel_connection(kwargs, replica=True)]
+    replicas = []
+    for replica in kwargs.get("redis_replicas") or []:
+        if isinstance(replica, dict):
+            replica = get_redis_connection(**replica)
+        replicas.append(replica)
+    return replicas
+
+
+def get_async_redis_connection(**kwargs):
+    """
+    Returns a redis.asyncio.Redis connection (or redis.asyncio.cluster.RedisCluster if
+    redis_cluster is set).
+
+    Connections built from redis_url or redis_host/redis_port/redis_pw/redis_db share a single
+    connection pool per distinct server and options, so every AsyncDeathnutClient talking to the
+    same redis reuses sockets.
+
+    Kwargs Parameters
+    ----------
+    redis_connection: redis.asyncio.Redis
+        Allows deathnut clients to inject their own asyncio redis connection.
+    Other kwargs:
+        See get_redis_connection. Used only if redis_connection not provided.
+    """
+    if redis_asyncio is None:
+        raise DeathnutException("asyncio support requires redis>=4.2 (pip install deathnut[async])")
+    if "redis_connection" in kwargs:
+        return kwargs["redis_connection"]
+    def create(options):
+        if kwargs.get("redis_cluster"):
+            if kwargs.get("redis_url"):
+                return AsyncRedisCluster.from_url(kwargs["redis_url"], **options)
+            return AsyncRedisCluster(host=kwargs["redis_host"], port=kwargs["redis_port"],
+                password=kwargs.get("redis_pw"), **options)
+        if kwargs.get("redis_url"):
+            return redis_asyncio.Redis.from_url(kwargs["redis_url"], **options)
+        return redis_asyncio.Redis(host=kwargs["redis_host"], port=kwargs["redis_port"],
+            password=kwargs.get("redis_pw"), db=kwargs.get("redis_db") or 0, **options)
+    return _shared_connection("async", kwargs, create)
+
+
+def is_cluster_connection(client):
+    """True for sync or asyncio Redis Cluster clients"""
+    return any(cls is not None and isinstance(client, cls)
+        for cls in (RedisCluster, AsyncRedisCluster))
+
+
+def supports_cluster_transactions(client):
+    """
+    True if a Redis Cluster client runs pipelines in MULTI/EXEC. Cluster pipelines of older
+    redis-py releases (and rediscluster) raise RedisClusterException when a transaction is asked
+    for. Creating the pipeline does no I/O.
+    """
     try:
-        client.ping()
-    except:
-        logger.exception("Could not establish redis connection")
-    return client
+        client.pipeline(transaction=True)
+    except _CLUSTER_ERRORS:
+        return False
+    return True
+
+
+class KeyspaceListener(object):
+    """
+    Background thread subscribed to redis keyspace notifications for keys matching a pattern.
+
+    Requires the server to publish hash events (notify-keyspace-events containing at least 'Kh',
+    plus 'g' to catch DEL/RENAME). Whenever the subscription is (re)established on_reset is called
+    since notifications may have been missed while disconnected.
+
+    Parameters
+    ----------
+    client: redis.Redis
+        connection used to derive the pubsub connection.
+    key_pattern: str
+        glob pattern for the keys to watch, ex: 'my-service:*'
+    on_key: function
+        called with the (decoded) key name for every event received.
+    on_reset: function
+        called whenever notifications may have been missed.
+    """
+    def __init__(self, client, key_pattern, on_key, on_reset, retry_interval=1.0):
+        db = client.connection_pool.connection_kwargs.get("db") or 0
+        self._prefix = "__keyspace@{}__:".format(db)
+        self._pattern = self._prefix + key_pattern
+        self._client = client
+        self._on_key = on_key
+        self._on_reset = on_reset
+        self._retry_interval = retry_interval
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="deathnut-keyspace-listener")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+    def _run(self):
+        while self._running:
+            pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe(self._pattern)
+                self._on_reset()
+                while self._running:
+                    message = pubsub.get_message(timeout=self._retry_interval)
+                    if message and message["type"] == "pmessage":
+                        channel = message["channel"]
+                        if isinstance(channel, bytes):
+                            channel = channel.decode()
+                        self._on_key(channel[len(self._prefix):])
+            except redis.exceptions.RedisError:
+                logger.exception("Lost keyspace notification subscription, retrying")
+                self._on_reset()
+                time.sleep(self._retry_interval)
+            finally:
+                pubsub.close()
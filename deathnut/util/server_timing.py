@@ -0,0 +1,85 @@
+"""
+Per request timing breakdown reported in a Server-Timing response header, see
+https://www.w3.org/TR/server-timing/. Decorators start a ServerTiming for the request, deathnut code
+marks its phases with `with phase(...)` and the adapter writes header() to the response.
+"""
+import asyncio
+import functools
+import time
+from contextvars import ContextVar
+
+IDENTITY = "dn-identity"
+REDIS = "dn-redis"
+HANDLER = "dn-handler"
+
+_current = ContextVar("deathnut_server_timing", default=None)
+
+
+class ServerTiming(object):
+    def __init__(self):
+        self._entries = []
+
+    def record(self, name, seconds):
+        # list.append is atomic, handlers may record from an executor thread
+        self._entries.append((name, seconds))
+
+    def wrap(self, func):
+        """Returns func recording its duration as the handler phase"""
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_coroutine(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.record(HANDLER, time.perf_counter() - start)
+            return timed_coroutine
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(HANDLER, time.perf_counter() - start)
+        return timed
+
+    def header(self):
+        """Header value, ex: 'dn-identity;dur=0.041, dn-redis;dur=0.512, dn-handler;dur=12.3'"""
+        totals = {}
+        for name, seconds in list(self._entries):
+            totals[name] = totals.get(name, 0.0) + seconds
+        return ", ".join("{};dur={:.3f}".format(name, totals[name] * 1000)
+            for name in (IDENTITY, REDIS, HANDLER) if name in totals)
+
+
+def start():
+    """Makes a new ServerTiming the current one, returns it and the token to pass to finish"""
+    timing = ServerTiming()
+    return timing, _current.set(timing)
+
+
+def finish(token):
+    _current.reset(token)
+
+
+def timed_handler(func):
+    """func, recording its duration on the current ServerTiming if one was started"""
+    timing = _current.get()
+    return func if timing is None else timing.wrap(func)
+
+
+class phase(object):
+    """Context manager recording the duration of its block on the current ServerTiming, if any"""
+    __slots__ = ("_name", "_timing", "_start")
+
+    def __init__(self, name):
+        self._name = name
+        self._timing = _current.get()
+
+    def __enter__(self):
+        if self._timing is not None:
+            self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self._timing is not None:
+            self._timing.record(self._name, time.perf_counter() - self._start)
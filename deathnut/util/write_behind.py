@@ -0,0 +1,153 @@
+import atexit
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+from deathnut.util.logger import get_deathnut_logger
+
+logger = get_deathnut_logger(__name__)
+
+
+class WriteBehindQueue(object):
+    """
+    Bounded queue of role assigns/revokes written to redis by a background thread.
+
+    A flush happens once batch_size operations are queued or flush_interval seconds after the
+    first queued operation, whichever comes first. Operations on the same (user, role, resource)
+    within a batch are coalesced to the last one, then all assigns and all revokes are each
+    written in one pipeline through write(assign, grants).
+
+    Until written, queued operations are visible through pending(), so reads can overlay them.
+    put() blocks while the queue is full. Batches failing with a redis connection error or timeout
+    are retried every retry_interval seconds, other errors are logged and the batch dropped. The
+    queue is flushed on close(), which is registered to run at interpreter exit.
+
+    Parameters
+    ----------
+    write: callable
+        write(assign, grants) applying a list of (user, role, resource_id) grants.
+    max_size: int
+        Number of queued operations beyond which put() blocks.
+    flush_interval: float
+        Seconds operations may wait to be coalesced with others.
+    batch_size: int
+        Maximum number of operations written per flush.
+    retry_interval: float
+        Seconds to wait before retrying a batch after a redis error.
+    """
+    def __init__(self, write, max_size=10000, flush_interval=0.005, batch_size=500,
+        retry_interval=0.5):
+        self._write = write
+        self._max_size = max_size
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._retry_interval = retry_interval
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._pending = {}
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._flush_requests = 0
+        self._closed = False
+        self._thread = None
+
+    def put(self, assign, grants):
+        """Queues assigns (or revokes) of (user, role, resource_id) grants"""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write-behind queue is closed")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="deathnut-write-behind")
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.close)
+            for grant in grants:
+                while len(self._queue) >= self._max_size:
+                    self._cond.wait()
+                sequence = next(self._sequence)
+                self._queue.append((sequence, assign, grant))
+                self._pending[grant] = (sequence, assign)
+            self._cond.notify_all()
+
+    def pending(self, user, role, resource_id):
+        """True/False for a queued assign/revoke of the grant not yet written, None otherwise"""
+        entry = self._pending.get((user, role, resource_id))
+        return None if entry is None else entry[1]
+
+    def __len__(self):
+        return len(self._queue) + self._in_flight
+
+    def flush(self, timeout=None):
+        """Blocks until every operation queued so far was written, returns False on timeout"""
+        with self._cond:
+            self._flush_requests += 1
+            self._cond.notify_all()
+            try:
+                return self._cond.wait_for(lambda: not self._queue and not self._in_flight,
+                    timeout)
+            finally:
+                self._flush_requests -= 1
+
+    def close(self, timeout=5.0):
+        """Flushes the queue and stops the background thread"""
+        if self._thread is None or self._closed:
+            self._closed = True
+            return
+        if not self.flush(timeout):
+            logger.error("Write-behind queue closed with %d unwritten operation(s)", len(self))
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        atexit.unregister(self.close)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            if len(self._queue) < self._batch_size and not self._flush_requests:
+                self._cond.wait_for(lambda: len(self._queue) >= self._batch_size or
+                    self._flush_requests or self._closed, self._flush_interval)
+            batch = [self._queue.popleft() for _ in range(min(len(self._queue),
+                self._batch_size))]
+            self._in_flight = len(batch)
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            latest = OrderedDict()
+            for sequence, assign, grant in batch:
+                latest.pop(grant, None)
+                latest[grant] = (sequence, assign)
+            try:
+                for assign in (True, False):
+                    grants = [grant for grant, (_, op) in latest.items() if op is assign]
+                    if grants:
+                        self._write(assign, grants)
+            except (ConnectionError, TimeoutError):
+                logger.exception("Write-behind flush of %d operation(s) failed, retrying",
+                    len(batch))
+                with self._cond:
+                    self._queue.extendleft(reversed(batch))
+                    self._in_flight = 0
+                    self._cond.notify_all()
+                time.sleep(self._retry_interval)
+                continue
+            except Exception:
+                logger.exception("Write-behind flush of %d operation(s) failed, dropping them",
+                    len(batch))
+            with self._cond:
+                for grant, (sequence, _) in latest.items():
+                    if self._pending.get(grant, (None,))[0] == sequence:
+                        del self._pending[grant]
+                self._in_flight = 0
+                self._cond.notify_all()
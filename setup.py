@@ -4,8 +4,11 @@ setup(
     name="deathnut",
     version="1.0",
     description="Simple redis-based authorization library",
-    install_requires=["redis==3.3.11"],
+    python_requires=">=3.7",
+    install_requires=["redis>=3.3.11,<9"],
+    extras_require={"async": ["redis>=4.2.0"], "cluster": ["redis>=4.1.0"]},
     packages=find_packages(),
     include_package_data=True,
+    entry_points={"console_scripts": ["deathnut-acl=deathnut.tools.cli:main"]},
     test_suite="nose.collector",
 )
@@ -0,0 +1,7 @@
+"""
+Reproducible deathnut benchmarks, run with:
+
+    python -m test.benchmarks --backend redis-server --output results.json
+
+See test/benchmarks/__main__.py for the available options.
+"""
@@ -0,0 +1,74 @@
+"""
+Runs the deathnut benchmark suites and writes the results as JSON so runs can be compared.
+
+    python -m test.benchmarks [--backend redis-server|fakeredis] [--sizes 10 400]
+        [--runs 10] [--suites client memory decorators] [--output results.json]
+
+Timings are in seconds. fakeredis numbers only make sense relative to each other; use a real
+redis-server binary for absolute figures. Only the JSON results are written to stdout, deathnut's
+own log records go to stderr.
+"""
+import argparse
+import datetime
+import json
+import logging
+import platform
+import subprocess
+import sys
+
+from deathnut.util.logger import configure_logging
+from test.benchmarks import bench_client, bench_decorators, bench_memory
+from test.benchmarks.server import get_connection, server_version
+from test.benchmarks.timing import TEST_RUNS_PER_SIZE, TEST_SIZES
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="deathnut benchmarks")
+    parser.add_argument("--backend", choices=["redis-server", "fakeredis"], default="redis-server")
+    parser.add_argument("--redis-binary", default="redis-server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=TEST_SIZES)
+    parser.add_argument("--runs", type=int, default=TEST_RUNS_PER_SIZE)
+    parser.add_argument("--requests", type=int, default=200,
+        help="requests per run for the decorator suite")
+    parser.add_argument("--suites", nargs="+", default=["client", "memory", "decorators"],
+        choices=["client", "memory", "decorators"])
+    parser.add_argument("--output", help="JSON file to write, stdout if omitted")
+    args = parser.parse_args(argv)
+    # keep stdout parseable as JSON
+    configure_logging(logging.StreamHandler(sys.stderr))
+
+    with get_connection(args.backend, args.redis_binary) as conn:
+        results = {"meta": {
+            "started": datetime.datetime.utcnow().isoformat() + "Z",
+            "backend": args.backend,
+            "redis_version": server_version(conn),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "revision": _git_revision(),
+            "sizes": args.sizes,
+            "runs": args.runs,
+        }}
+        if "client" in args.suites:
+            results["client"] = bench_client.run(conn, args.sizes, args.runs)
+        if "memory" in args.suites:
+            results["memory"] = bench_memory.run(conn, args.sizes, args.runs)
+        if "decorators" in args.suites:
+            results["decorators"] = bench_decorators.run(conn, args.requests, args.runs)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""DeathnutClient operation timings (assign/check/revoke/get_resources/get_roles)"""
+from deathnut.client.deathnut_client import DeathnutClient
+from test.benchmarks.timing import generate_ids, summarize, time_call
+
+USER = "michael"
+ROLE = "view"
+OTHER_ROLES = ["edit", "own"]
+
+
+def _assign_each(client, resource_ids):
+    for rid in resource_ids:
+        client.assign_role(USER, ROLE, rid)
+
+
+def _check_each(client, resource_ids):
+    for rid in resource_ids:
+        client.check_role(USER, ROLE, rid)
+
+
+def _revoke_each(client, resource_ids):
+    for rid in resource_ids:
+        client.revoke_role(USER, ROLE, rid)
+
+
+def run(conn, sizes, runs):
+    client = DeathnutClient(service="bench", resource_type="recipes", redis_connection=conn)
+    results = []
+    for size in sizes:
+        samples = dict((op, []) for op in ("assign_role", "assign_roles", "check_role",
+            "check_roles_many", "get_resources", "get_resources_limit", "get_roles", "revoke_role",
+            "revoke_roles"))
+        for _ in range(runs):
+            conn.flushall()
+            resource_ids = generate_ids(size)
+            grants = [(USER, ROLE, rid) for rid in resource_ids]
+            samples["assign_role"].append(time_call(_assign_each, client, resource_ids))
+            client.assign_roles((USER, role, rid) for rid in resource_ids[:10]
+                for role in OTHER_ROLES)
+            samples["check_role"].append(time_call(_check_each, client, resource_ids))
+            samples["check_roles_many"].append(time_call(client.check_roles_many, USER, ROLE,
+                resource_ids))
+            samples["get_resources"].append(time_call(client.get_resources, USER, ROLE))
+            samples["get_resources_limit"].append(time_call(client.get_resources, USER, ROLE,
+                limit=500))
+            samples["get_roles"].append(time_call(client.get_roles, USER))
+            samples["revoke_role"].append(time_call(_revoke_each, client, resource_ids))
+            conn.flushall()
+            samples["assign_roles"].append(time_call(client.assign_roles, grants))
+            samples["revoke_roles"].append(time_call(client.revoke_roles, grants))
+        for op, op_samples in samples.items():
+            results.append(summarize(op_samples, op=op, size=size))
+    return results
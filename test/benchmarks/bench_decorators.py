@@ -0,0 +1,124 @@
+"""
+End-to-end request latency through each adapter, with and without deathnut decorators.
+
+Each adapter builds a tiny app exposing the same GET endpoint twice (bare and wrapped in
+requires_role) and drives it through the framework's own test client. Adapters whose framework is
+not installed are reported as skipped.
+"""
+import base64
+import json
+
+from test.benchmarks.timing import summarize, time_call
+
+USER = "michael"
+RESOURCE_ID = "42"
+HEADERS = {"X-Endpoint-Api-Userinfo": base64.b64encode(json.dumps({"user_id": USER}).encode())
+    .decode()}
+
+
+def flask_apispec_app(conn):
+    from deathnut.interface.flask.flask_apispec import FlaskAPISpecAuthorization
+    from flask import Flask
+    app = Flask(__name__)
+    auth_o = FlaskAPISpecAuthorization(app, service="bench", resource_type="recipes",
+        redis_connection=conn)
+    @app.route("/bare/<id>")
+    def bare(id):
+        return {"id": id}
+    @app.route("/recipe/<id>")
+    @auth_o.requires_role("view")
+    def recipe(id, **kwargs):
+        return {"id": id}
+    client = app.test_client()
+    return auth_o, lambda path: client.get(path, headers=HEADERS, json={})
+
+
+def restplus_app(conn):
+    from deathnut.interface.flask.flask_restplus import FlaskRestplusAuthorization
+    from flask import Flask
+    from flask_restplus import Api, Resource
+    app = Flask(__name__)
+    api = Api(app)
+    auth_o = FlaskRestplusAuthorization(api, service="bench", resource_type="recipes",
+        redis_connection=conn)
+    @api.route("/bare/<id>")
+    class Bare(Resource):
+        def get(self, id):
+            return {"id": id}
+    @api.route("/recipe/<id>")
+    class Recipe(Resource):
+        @auth_o.requires_role("view")
+        def get(self, id, **kwargs):
+            return {"id": id}
+    client = app.test_client()
+    return auth_o, lambda path: client.get(path, headers=HEADERS, json={})
+
+
+def falcon_app(conn):
+    import falcon
+    import falcon.testing
+    from deathnut.interface.falcon.falcon_auth import FalconAuthorization
+    app = falcon.App() if hasattr(falcon, "App") else falcon.API()
+    auth_o = FalconAuthorization(app, None, service="bench", resource_type="recipes",
+        redis_connection=conn)
+    class Bare(object):
+        def on_get(self, req, resp, id):
+            resp.media = {"id": id}
+    class Recipe(object):
+        @auth_o.requires_role("view")
+        def on_get(self, req, resp, id, **kwargs):
+            resp.media = {"id": id}
+    app.add_route("/bare/{id}", Bare())
+    app.add_route("/recipe/{id}", Recipe())
+    client = falcon.testing.TestClient(app)
+    return auth_o, lambda path: client.simulate_get(path, headers=HEADERS, json={})
+
+
+def fastapi_app(conn):
+    from deathnut.interface.fastapi.fastapi_auth import FastapiAuthorization
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from starlette.requests import Request
+    app = FastAPI()
+    auth_o = FastapiAuthorization(app, service="bench", resource_type="recipes",
+        redis_connection=conn)
+    @app.get("/bare/{id}")
+    async def bare(id: str, request: Request):
+        return {"id": id}
+    @app.get("/recipe/{id}")
+    @auth_o.requires_role("view")
+    async def recipe(id: str, request: Request):
+        return {"id": id}
+    client = TestClient(app)
+    return auth_o, lambda path: client.get(path, headers=HEADERS)
+
+
+ADAPTERS = {"flask-apispec": flask_apispec_app, "restplus": restplus_app, "falcon": falcon_app,
+    "fastapi": fastapi_app}
+
+
+def run(conn, requests, runs):
+    results = []
+    for name, build in sorted(ADAPTERS.items()):
+        conn.flushall()
+        try:
+            auth_o, get = build(conn)
+        except ImportError as ex:
+            results.append({"adapter": name, "skipped": str(ex)})
+            continue
+        auth_o.assign_roles(RESOURCE_ID, ["view"], deathnut_user=USER)
+        for path in ("/bare/" + RESOURCE_ID, "/recipe/" + RESOURCE_ID):
+            response = get(path)
+            status = getattr(response, "status_code", None) or response.status
+            if str(status)[:3] != "200":
+                raise RuntimeError("{} {} returned {}".format(name, path, status))
+        samples = {"bare": [], "requires_role": []}
+        for _ in range(runs):
+            for label, path in (("bare", "/bare/"), ("requires_role", "/recipe/")):
+                path += RESOURCE_ID
+                samples[label].append(time_call(lambda: [get(path) for _ in range(requests)])
+                    / requests)
+        for label, label_samples in sorted(samples.items()):
+            results.append(summarize(label_samples, adapter=name, endpoint=label,
+                requests=requests))
+    return results
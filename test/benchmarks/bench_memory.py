@@ -0,0 +1,65 @@
+"""
+Redis memory used per storage strategy (sets vs hashes vs bitmaps, see docs/redis.md). hash and set
+store random uuids, bitmap stores the dense integer ids it is meant for and hash-dense the same
+integer ids in a hash, for comparison.
+"""
+import redis
+from test.benchmarks.timing import generate_ids
+
+KEY = "bench_recipes:michael:view"
+
+
+def _used_memory(conn):
+    try:
+        return int(conn.info("memory")["used_memory"])
+    except (redis.exceptions.ResponseError, KeyError):
+        return None
+
+
+def _key_memory(conn):
+    try:
+        return conn.memory_usage(KEY, samples=0)
+    except redis.exceptions.ResponseError:
+        return None
+
+
+def _fill_hash(pipe, resource_ids):
+    for rid in resource_ids:
+        pipe.hset(KEY, rid, 1)
+
+
+def _fill_set(pipe, resource_ids):
+    for rid in resource_ids:
+        pipe.sadd(KEY, rid)
+
+
+def _fill_bitmap(pipe, resource_ids):
+    for rid in resource_ids:
+        pipe.setbit(KEY, int(rid), 1)
+
+
+def _dense_ids(size):
+    return [str(i) for i in range(size)]
+
+
+# strategy -> (fill function, id generator)
+STRATEGIES = {"hash": (_fill_hash, generate_ids), "set": (_fill_set, generate_ids),
+    "bitmap": (_fill_bitmap, _dense_ids), "hash-dense": (_fill_hash, _dense_ids)}
+
+
+def run(conn, sizes, runs):
+    results = []
+    for strategy, (fill, ids) in sorted(STRATEGIES.items()):
+        for size in sizes:
+            conn.flushall()
+            baseline = _used_memory(conn)
+            resource_ids = ids(size)
+            for start in range(0, size, 10000):
+                pipe = conn.pipeline(transaction=False)
+                fill(pipe, resource_ids[start:start + 10000])
+                pipe.execute()
+            used = _used_memory(conn)
+            results.append({"strategy": strategy, "size": size, "key_bytes": _key_memory(conn),
+                "used_memory_delta": used - baseline if None not in (used, baseline) else None})
+    conn.flushall()
+    return results
@@ -0,0 +1,61 @@
+import contextlib
+import socket
+import subprocess
+import time
+
+import redis
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@contextlib.contextmanager
+def redis_server(binary="redis-server", timeout=10):
+    """Starts a throwaway, persistence-free redis-server on a free port and yields a connection"""
+    port = _free_port()
+    proc = subprocess.Popen([binary, "--port", str(port), "--save", "", "--appendonly", "no"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    conn = redis.Redis(host="127.0.0.1", port=port)
+    try:
+        deadline = time.time() + timeout
+        while True:
+            try:
+                conn.ping()
+                break
+            except redis.exceptions.ConnectionError:
+                if proc.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("could not start {}".format(binary))
+                time.sleep(0.05)
+        yield conn
+    finally:
+        conn.connection_pool.disconnect()
+        proc.terminate()
+        proc.wait()
+
+
+@contextlib.contextmanager
+def get_connection(backend, redis_binary="redis-server"):
+    """
+    Yields a redis connection for the requested backend: 'redis-server' (a local binary, started
+    and stopped here) or 'fakeredis' (in-process, useful for relative numbers only).
+    """
+    if backend == "fakeredis":
+        import fakeredis
+        yield fakeredis.FakeStrictRedis()
+    elif backend == "redis-server":
+        with redis_server(redis_binary) as conn:
+            yield conn
+    else:
+        raise ValueError("unknown backend {}".format(backend))
+
+
+def server_version(conn):
+    try:
+        return conn.info("server").get("redis_version")
+    except redis.exceptions.ResponseError:
+        return None
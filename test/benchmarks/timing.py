@@ -0,0 +1,26 @@
+import uuid
+from timeit import default_timer as timer
+
+TEST_SIZES = [10, 400, 10000, 1000000]
+TEST_RUNS_PER_SIZE = 10
+
+
+def generate_ids(size):
+    return [str(uuid.uuid4()) for _ in range(size)]
+
+
+def time_call(func, *args, **kwargs):
+    """Returns the seconds (monotonic, high resolution clock) taken by func(*args, **kwargs)"""
+    start = timer()
+    func(*args, **kwargs)
+    return timer() - start
+
+
+def summarize(samples, **labels):
+    """Summary statistics (seconds) for a list of timings, merged with identifying labels"""
+    ordered = sorted(samples)
+    count = len(ordered)
+    result = dict(labels)
+    result.update(runs=count, mean=sum(ordered) / count, min=ordered[0], max=ordered[-1],
+        median=ordered[count // 2], p95=ordered[min(count - 1, int(count * 0.95))])
+    return result
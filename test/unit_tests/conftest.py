@@ -0,0 +1,39 @@
+import base64
+import json
+
+from deathnut.interface.base_interface import BaseAuthorizationInterface
+
+
+def encode_user(user):
+    return base64.b64encode(json.dumps({"user_id": user}).encode()).decode()
+
+def user_headers(user):
+    return {"X-Endpoint-Api-Userinfo": encode_user(user)}
+
+def fetch_all_pages(fetch_page):
+    """Follows cursors from 0 until the last page, fetch_page(cursor) returns a page's json body"""
+    seen, cursor = [], 0
+    while True:
+        page = fetch_page(cursor)
+        seen.extend(page["ids"])
+        cursor = page["cursor"]
+        if not cursor:
+            return seen
+
+
+class StubInterface(BaseAuthorizationInterface):
+    """Framework-less interface, for tests calling the interface methods directly"""
+    @staticmethod
+    def get_auth_header(*args, **kwargs):
+        pass
+    @staticmethod
+    def get_body_response(ret, *args, **kwargs):
+        pass
+    @staticmethod
+    def get_resource_id(id_identifier, *args, **kwargs):
+        pass
+    @staticmethod
+    def get_dont_wait(*args, **kwargs):
+        pass
+    def create_auth_endpoint(self, name, requires_role, grants_role):
+        pass
@@ -0,0 +1,31 @@
+import io
+import unittest
+
+import fakeredis
+from deathnut.client.deathnut_client import DeathnutClient
+from deathnut.tools.acl import export_grants, import_grants
+
+fake_redis_conn = fakeredis.FakeStrictRedis()
+
+
+class TestAclTools(unittest.TestCase):
+    def setUp(self):
+        fake_redis_conn.flushall()
+
+    def test_export_import(self):
+        source = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn)
+        source.assign_roles([("test_user", "own", str(i)) for i in range(250)] +
+            [("test_user2", "view", "1"), ("test:user", "view", "2")])
+        out = io.StringIO()
+        self.assertEqual(252, export_grants(source, out, count=100))
+        self.assertLess(2, len(out.getvalue().splitlines()))
+        target = DeathnutClient(service="test", resource_type="restored", hash_tag_keys=True,
+            storage="bitmap", redis_connection=fake_redis_conn)
+        self.assertEqual(252, import_grants(target, io.StringIO(out.getvalue()), batch_size=30,
+            max_in_flight=3))
+        self.assertEqual(sorted(str(i) for i in range(250)),
+            sorted(target.get_resources("test_user", "own")))
+        self.assertTrue(target.check_role("test:user", "view", "2"))
+        roundtrip = io.StringIO()
+        self.assertEqual(252, export_grants(target, roundtrip))
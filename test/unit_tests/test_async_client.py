@@ -0,0 +1,91 @@
+import asyncio
+import unittest
+import uuid
+
+import fakeredis
+from deathnut.client.async_deathnut_client import AsyncDeathnutClient
+from deathnut.client.deathnut_client import DeathnutClient
+from deathnut.util.deathnut_exception import DeathnutException
+from deathnut.util.logger import get_deathnut_logger
+
+logger = get_deathnut_logger(__name__)
+fake_server = fakeredis.FakeServer()
+fake_redis_conn = fakeredis.FakeStrictRedis(server=fake_server)
+dn_client = DeathnutClient(service="test", resource_type="recipes", redis_connection=fake_redis_conn)
+
+loop = asyncio.new_event_loop()
+
+def run(coro):
+    return loop.run_until_complete(coro)
+
+class TestAsyncDeathnutClient(unittest.TestCase):
+    def setUp(self):
+        fake_redis_conn.flushall()
+        self.dn_client = AsyncDeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fakeredis.FakeAsyncRedis(server=fake_server))
+
+    def test_assign_check_revoke(self):
+        random_resource_id = str(uuid.uuid4())
+        self.assertFalse(run(self.dn_client.check_role("test_user", "own", random_resource_id)))
+        run(self.dn_client.assign_role("test_user", "own", random_resource_id))
+        self.assertTrue(run(self.dn_client.check_role("test_user", "own", random_resource_id)))
+        # same layout as the sync client
+        self.assertTrue(dn_client.check_role("test_user", "own", random_resource_id))
+        run(self.dn_client.revoke_role("test_user", "own", random_resource_id))
+        self.assertFalse(run(self.dn_client.check_role("test_user", "own", random_resource_id)))
+        self.assertRaises(DeathnutException, run, self.dn_client.assign_role("Unauthenticated",
+            "own", random_resource_id))
+
+    def test_bulk_and_many(self):
+        resource_ids = [str(uuid.uuid4()) for _ in range(10)]
+        run(self.dn_client.assign_roles([("test_user", "view", rid) for rid in resource_ids]))
+        run(self.dn_client.revoke_roles([("test_user", "view", resource_ids[0])]))
+        allowed = run(self.dn_client.check_roles_many("test_user", "view", resource_ids))
+        self.assertFalse(allowed[resource_ids[0]])
+        self.assertTrue(all(allowed[rid] for rid in resource_ids[1:]))
+        self.assertEqual({"view": sorted(resource_ids[1:])},
+            dict((k, sorted(v)) for k, v in run(self.dn_client.get_roles("test_user")).items()))
+        run(self.dn_client.revoke_roles([("test_user", "view", rid) for rid in resource_ids[1:]]))
+        self.assertFalse(fake_redis_conn.exists("test_recipes-roles:test_user"))
+
+    def test_any_role(self):
+        run(self.dn_client.assign_roles([("test_user", "edit", "1"), ("test_user", "owner", "2")]
+            + [("test_user", "owner", str(i)) for i in range(10, 40)]))
+        self.assertEqual({"1": True, "2": True, "3": False}, run(
+            self.dn_client.check_any_roles_many("test_user", ["edit", "owner"], ["1", "2", "3"])))
+        ids = run(self.dn_client.get_resources_any_role("test_user", ["edit", "owner"]))
+        self.assertEqual("1", ids[0])
+        self.assertEqual(32, len(set(ids)))
+        self.assertEqual(5, len(run(self.dn_client.get_resources_any_role("test_user",
+            ["edit", "owner"], limit=5))))
+
+    def test_get_resources(self):
+        run(self.dn_client.assign_roles([("test_user", "view", str(uuid.uuid4()))
+            for _ in range(90)]))
+        self.assertEqual(90, len(run(self.dn_client.get_resources("test_user", "view"))))
+        self.assertEqual(42, len(run(self.dn_client.get_resources("test_user", "view", limit=42))))
+        async def collect():
+            return [page async for page in self.dn_client.get_resources_page("test_user", "view",
+                page_size=10)]
+        pages = run(collect())
+        self.assertEqual(90, sum(len(page) for page in pages))
+
+    def test_reverse_index(self):
+        indexed_client = AsyncDeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fakeredis.FakeAsyncRedis(server=fake_server), reverse_index=True)
+        run(indexed_client.assign_roles([("test_user", "own", "1"), ("test_user", "view", "1"),
+            ("test_user2", "view", "1"), ("test_user2", "view", "2")]))
+        self.assertEqual([("test_user", "own"), ("test_user", "view"), ("test_user2", "view")],
+            run(indexed_client.get_grantees("1")))
+        self.assertEqual(3, len(run(indexed_client.revoke_all("1"))))
+        self.assertEqual([], run(indexed_client.get_grantees("1")))
+        self.assertFalse(dn_client.check_role("test_user2", "view", "1"))
+        self.assertTrue(dn_client.check_role("test_user2", "view", "2"))
+
+    def test_check_and_change_roles(self):
+        self.assertFalse(run(self.dn_client.check_and_change_roles("owner", "own", "test_user",
+            ["view"], "1")))
+        dn_client.assign_role("owner", "own", "1")
+        self.assertTrue(run(self.dn_client.check_and_change_roles("owner", "own", "test_user",
+            ["view"], "1")))
+        self.assertTrue(dn_client.check_role("test_user", "view", "1"))
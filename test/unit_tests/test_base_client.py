@@ -1,9 +1,22 @@
+import time
 import unittest
 import uuid
 
 import fakeredis
+import redis
+from redis.crc import key_slot
+from redis.exceptions import RedisClusterException
 from deathnut.client.deathnut_client import DeathnutClient
+from deathnut.client.storage import BitmapStorage, IntegerIdMapper, RedisIdMapper
+from deathnut.util.circuit_breaker import CircuitBreaker, CircuitOpenError
+from deathnut.util.deathnut_exception import DeathnutException
 from deathnut.util.logger import get_deathnut_logger
+from deathnut.util.redis import close_redis_connections
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
 
 logger = get_deathnut_logger(__name__)
 fake_redis_conn = fakeredis.FakeStrictRedis()
@@ -52,3 +65,402 @@ class TestBaseDeathnutClient(unittest.TestCase):
         self.assertEqual(1, len(list(dn_client.get_resources_page("test_user", "view", page_size=90))))
         for page in dn_client.get_resources_page("test_user", "view", page_size=10):
             self.assertEqual(10, len(page))
+
+    def test_assign_revoke_roles_bulk(self):
+        resource_ids = [str(uuid.uuid4()) for _ in range(20)]
+        grants = [("test_user", role, rid) for rid in resource_ids for role in ("own", "view")]
+        dn_client.assign_roles(grants)
+        for rid in resource_ids:
+            self.assertTrue(dn_client.check_role("test_user", "own", rid))
+            self.assertTrue(dn_client.check_role("test_user", "view", rid))
+        dn_client.revoke_roles([("test_user", "own", rid) for rid in resource_ids], transaction=True)
+        for rid in resource_ids:
+            self.assertFalse(dn_client.check_role("test_user", "own", rid))
+            self.assertTrue(dn_client.check_role("test_user", "view", rid))
+
+    def test_bulk_rejects_unauthenticated(self):
+        random_resource_id = str(uuid.uuid4())
+        self.assertRaises(DeathnutException, dn_client.assign_roles, [("test_user", "own",
+            random_resource_id), ("Unauthenticated", "own", random_resource_id)])
+        self.assertFalse(dn_client.check_role("test_user", "own", random_resource_id))
+
+    def test_check_roles_many(self):
+        resource_ids = [str(uuid.uuid4()) for _ in range(10)]
+        dn_client.assign_roles([("test_user", "view", rid) for rid in resource_ids[::2]])
+        allowed = dn_client.check_roles_many("test_user", "view", resource_ids)
+        self.assertEqual(set(resource_ids), set(allowed))
+        for i, rid in enumerate(resource_ids):
+            self.assertEqual(i % 2 == 0, allowed[rid])
+        self.assertEqual({}, dn_client.check_roles_many("test_user", "view", []))
+
+    def test_decision_cache(self):
+        cached_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, decision_cache_size=2,
+            decision_cache_invalidation=False)
+        random_resource_id = str(uuid.uuid4())
+        self.assertFalse(cached_client.check_role("test_user", "own", random_resource_id))
+        self.assertFalse(cached_client.check_role("test_user", "own", random_resource_id))
+        self.assertEqual(1, cached_client.get_cache_stats()["hits"])
+        # writes made through this client invalidate its own cache
+        cached_client.assign_role("test_user", "own", random_resource_id)
+        self.assertTrue(cached_client.check_role("test_user", "own", random_resource_id))
+        # writes made elsewhere are only seen once the cache is invalidated
+        dn_client.revoke_role("test_user", "own", random_resource_id)
+        self.assertTrue(cached_client.check_role("test_user", "own", random_resource_id))
+        cached_client._cache.invalidate_redis_key("test_recipes:test_user:own")
+        self.assertFalse(cached_client.check_role("test_user", "own", random_resource_id))
+        allowed = cached_client.check_roles_many("test_user", "own", ["a", "b", "c"])
+        self.assertEqual({"a": False, "b": False, "c": False}, allowed)
+        self.assertEqual(2, cached_client.get_cache_stats()["size"])
+        self.assertIsNone(dn_client.get_cache_stats())
+
+    def test_decision_cache_keyspace_invalidation(self):
+        try:
+            fake_redis_conn.config_set("notify-keyspace-events", "Kgh")
+        except redis.exceptions.ResponseError:
+            self.skipTest("keyspace notifications not supported")
+        cached_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, decision_cache_size=10)
+        try:
+            random_resource_id = str(uuid.uuid4())
+            self.assertFalse(cached_client.check_role("test_user", "own", random_resource_id))
+            dn_client.assign_role("test_user", "own", random_resource_id)
+            deadline = time.time() + 5
+            while not cached_client.check_role("test_user", "own", random_resource_id):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+        finally:
+            cached_client.close()
+
+    def test_get_roles(self):
+        dn_client.assign_roles([("test_user", "own", "1"), ("test_user", "view", "1"),
+            ("test_user", "view", "2"), ("test_user2", "own", "3")])
+        roles = dn_client.get_roles("test_user")
+        self.assertEqual(["own", "view"], sorted(roles))
+        self.assertEqual(["1", "2"], sorted(roles["view"]))
+        # users sharing a prefix are not mixed up
+        self.assertEqual({"own": ["3"]}, dn_client.get_roles("test_user2"))
+        dn_client.revoke_role("test_user", "own", "1")
+        self.assertEqual(["view"], list(dn_client.get_roles("test_user")))
+        # the index drops a role once its last id is revoked, and only then
+        self.assertEqual({b"view"}, fake_redis_conn.smembers("test_recipes-roles:test_user"))
+        dn_client.revoke_roles([("test_user", "view", "1")])
+        self.assertEqual({b"view"}, fake_redis_conn.smembers("test_recipes-roles:test_user"))
+        dn_client.assign_role("owner", "own", "2")
+        self.assertTrue(dn_client.check_and_change_roles("owner", "own", "test_user", ["view"],
+            "2", revoke=True))
+        self.assertFalse(fake_redis_conn.exists("test_recipes-roles:test_user"))
+        bitmap_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, storage="bitmap")
+        bitmap_client.assign_role("test_user", "own", "5")
+        bitmap_client.revoke_role("test_user", "own", "5")
+        self.assertFalse(fake_redis_conn.exists("test_recipes-roles:test_user"))
+        self.assertEqual({}, dn_client.get_roles("nobody"))
+
+    def test_rebuild_role_index(self):
+        fake_redis_conn.hset("test_recipes:legacy_user:own", "1", 1)
+        fake_redis_conn.hset("test_recipes:legacy_user:view", "1", 1)
+        self.assertEqual({}, dn_client.get_roles("legacy_user"))
+        self.assertEqual({"own", "view"}, dn_client.rebuild_role_index("legacy_user"))
+        self.assertEqual({"own": ["1"], "view": ["1"]}, dn_client.get_roles("legacy_user"))
+        fake_redis_conn.hset("test_recipes:legacy:user:own", "2", 1)
+        fake_redis_conn.hset("test_recipes_other:legacy_user2:own", "3", 1)
+        self.assertEqual(3, dn_client.rebuild_role_indexes(count=2))
+        self.assertEqual({"own": ["2"]}, dn_client.get_roles("legacy:user"))
+        self.assertEqual({}, dn_client.get_roles("legacy_user2"))
+
+    def test_get_resources_from(self):
+        resource_ids = set(str(uuid.uuid4()) for _ in range(1000))
+        dn_client.assign_roles([("test_user", "view", rid) for rid in resource_ids])
+        self.assertEqual(10, len(dn_client.get_resources("test_user", "view", limit=10)))
+        seen = []
+        cursor, ids = dn_client.get_resources_from("test_user", "view", 0, 100)
+        seen.extend(ids)
+        while cursor:
+            cursor, ids = dn_client.get_resources_from("test_user", "view", cursor, 100)
+            seen.extend(ids)
+        self.assertEqual(resource_ids, set(seen))
+
+    def test_hash_tagged_keys(self):
+        tagged_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, hash_tag_keys=True)
+        tagged_client.assign_roles([("test_user", "own", "1"), ("test_user", "view", "1")],
+            transaction=True)
+        self.assertTrue(fake_redis_conn.hget("test_recipes:{test_user}:own", "1"))
+        self.assertTrue(tagged_client.check_role("test_user", "view", "1"))
+        self.assertEqual({"own": ["1"], "view": ["1"]}, tagged_client.get_roles("test_user"))
+        slots = set(key_slot(key) for key in fake_redis_conn.keys())
+        self.assertEqual(1, len(slots))
+        self.assertEqual({"own", "view"}, tagged_client.rebuild_role_index("test_user"))
+
+    def test_cluster_transactions_fall_back(self):
+        class FakeClusterRedis(fakeredis.FakeStrictRedis):
+            """Stands in for a cluster client whose pipelines reject transactions"""
+            def pipeline(self, transaction=True, shard_hint=None):
+                if transaction:
+                    raise RedisClusterException("transaction is deprecated in cluster mode")
+                return super(FakeClusterRedis, self).pipeline(transaction=False)
+        cluster_conn = FakeClusterRedis()
+        with patch("deathnut.client.deathnut_client.is_cluster_connection", return_value=True):
+            cluster_client = DeathnutClient(service="test", resource_type="recipes",
+                redis_connection=cluster_conn, reverse_index=True)
+        grants = [("test_user", "own", "1"), ("test_user", "view", "1"), ("other_user", "own", "2")]
+        cluster_client.assign_roles(grants, transaction=True)
+        self.assertTrue(cluster_conn.hget("test_recipes:{test_user}:own", "1"))
+        self.assertEqual({"own": ["2"]}, cluster_client.get_roles("other_user"))
+        self.assertEqual([("other_user", "own")], cluster_client.get_grantees("2"))
+        cluster_client.revoke_roles(grants, transaction=True)
+        self.assertFalse(cluster_client.check_any_role("test_user", ["own", "view"], "1"))
+
+    def test_lazy_shared_connection(self):
+        start = time.time()
+        client_a = DeathnutClient(service="a", redis_host="127.0.0.1", redis_port=1,
+            redis_socket_timeout=0.5, redis_max_connections=4)
+        client_b = DeathnutClient(service="b", redis_host="127.0.0.1", redis_port=1,
+            redis_socket_timeout=0.5, redis_max_connections=4)
+        client_c = DeathnutClient(service="c", redis_url="redis://127.0.0.1:1/0")
+        self.assertLess(time.time() - start, 0.5)
+        self.assertIs(client_a.get_redis_connection(), client_b.get_redis_connection())
+        self.assertIsNot(client_a.get_redis_connection(), client_c.get_redis_connection())
+        pool = client_a.get_redis_connection().connection_pool
+        self.assertEqual(4, pool.max_connections)
+        self.assertEqual(0.5, pool.connection_kwargs["socket_timeout"])
+        close_redis_connections()
+        self.assertIsNot(client_a.get_redis_connection(), DeathnutClient(service="a",
+            redis_host="127.0.0.1", redis_port=1, redis_socket_timeout=0.5,
+            redis_max_connections=4).get_redis_connection())
+
+    def test_shared_sentinel_connections(self):
+        sentinel = {"sentinels": [("127.0.0.1", 1)], "service_name": "mymaster"}
+        client_a = DeathnutClient(service="a", redis_sentinel=sentinel, redis_socket_timeout=0.5)
+        client_b = DeathnutClient(service="b", redis_sentinel=sentinel, redis_socket_timeout=0.5)
+        self.assertIs(client_a.get_redis_connection(), client_b.get_redis_connection())
+        self.assertIs(client_a._replicas[0], client_b._replicas[0])
+        self.assertIsNot(client_a.get_redis_connection(), client_a._replicas[0])
+        close_redis_connections()
+        self.assertIsNot(client_a.get_redis_connection(), DeathnutClient(service="a",
+            redis_sentinel=sentinel, redis_socket_timeout=0.5).get_redis_connection())
+
+    def test_read_replicas(self):
+        replica_conn = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+        replicated_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, redis_replicas=[replica_conn], read_your_writes=0.2)
+        replicated_client.assign_role("test_user", "own", "1")
+        # reads of a recently written user stay on the primary
+        self.assertTrue(replicated_client.check_role("test_user", "own", "1"))
+        self.assertEqual({"own": ["1"]}, replicated_client.get_roles("test_user"))
+        # other users (and test_user once the window passes) read from the (lagging) replica
+        dn_client.assign_role("other_user", "own", "1")
+        self.assertFalse(replicated_client.check_role("other_user", "own", "1"))
+        time.sleep(0.3)
+        self.assertFalse(replicated_client.check_role("test_user", "own", "1"))
+        self.assertEqual([], replicated_client.get_resources("test_user", "own", limit=10))
+        replica_conn.hset("test_recipes:test_user:own", "1", 1)
+        self.assertTrue(replicated_client.check_role("test_user", "own", "1"))
+        # writes never go to the replica
+        replicated_client.revoke_role("test_user", "own", "1")
+        self.assertTrue(replica_conn.hget("test_recipes:test_user:own", "1"))
+        self.assertFalse(fake_redis_conn.hget("test_recipes:test_user:own", "1"))
+
+    def test_bitmap_storage(self):
+        bitmap_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, storage="bitmap")
+        resource_ids = [str(i) for i in range(0, 5000, 3)]
+        bitmap_client.assign_roles([("test_user", "view", rid) for rid in resource_ids])
+        bitmap_client.assign_role("test_user", "own", "7")
+        self.assertEqual(b"string", fake_redis_conn.type("test_recipes:test_user:view"))
+        self.assertTrue(bitmap_client.check_role("test_user", "view", "3"))
+        self.assertFalse(bitmap_client.check_role("test_user", "view", "4"))
+        self.assertFalse(bitmap_client.check_role("test_user", "view", "not-an-int"))
+        self.assertEqual({"3": True, "4": False, "x": False},
+            bitmap_client.check_roles_many("test_user", "view", ["3", "4", "x"]))
+        self.assertEqual(resource_ids, bitmap_client.get_resources("test_user", "view"))
+        self.assertEqual(resource_ids[:10], bitmap_client.get_resources("test_user", "view", 10))
+        for count in (10, 1024):
+            seen, cursor = [], 0
+            while True:
+                cursor, ids = bitmap_client.get_resources_from("test_user", "view", cursor, count)
+                self.assertLessEqual(len(ids), count)
+                seen.extend(ids)
+                if not cursor:
+                    break
+            self.assertEqual(resource_ids, seen)
+        bitmap_client.revoke_role("test_user", "own", "7")
+        self.assertEqual(["view"], list(bitmap_client.get_roles("test_user")))
+        self.assertRaises(DeathnutException, bitmap_client.assign_role, "test_user", "own", "x")
+        self.assertRaises(DeathnutException, bitmap_client.assign_role, "test_user", "own",
+            str(2 ** 24 + 1))
+        self.assertFalse(bitmap_client.check_role("test_user", "view", str(2 ** 32)))
+        large_client = DeathnutClient(service="test", resource_type="large",
+            redis_connection=fake_redis_conn, storage=BitmapStorage(IntegerIdMapper(2 ** 25)))
+        large_client.assign_role("test_user", "own", str(2 ** 24 + 1))
+        self.assertTrue(large_client.check_role("test_user", "own", str(2 ** 24 + 1)))
+
+    def test_bitmap_storage_id_mapper(self):
+        bitmap_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, storage=BitmapStorage(RedisIdMapper()))
+        resource_ids = [str(uuid.uuid4()) for _ in range(20)]
+        bitmap_client.assign_roles([("test_user", "view", rid) for rid in resource_ids])
+        bitmap_client.revoke_roles([("test_user", "view", rid) for rid in resource_ids[10:]] +
+            [("test_user", "view", "never-assigned")])
+        self.assertEqual(b"19", fake_redis_conn.hget("{test_recipes}-ids:fwd", resource_ids[19]))
+        self.assertEqual(1, len(set(key_slot(key) for key in fake_redis_conn.keys("*-ids:*"))))
+        # a second client (fresh mapping cache) resolves ids through redis
+        other_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, storage=BitmapStorage(RedisIdMapper()))
+        self.assertEqual(resource_ids[:10], other_client.get_resources("test_user", "view"))
+        self.assertTrue(other_client.check_role("test_user", "view", resource_ids[0]))
+        self.assertFalse(other_client.check_role("test_user", "view", resource_ids[10]))
+        self.assertFalse(other_client.check_role("test_user", "view", "never-assigned"))
+
+    def test_reverse_index(self):
+        indexed_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, reverse_index=True)
+        self.assertRaises(DeathnutException, dn_client.get_grantees, "1")
+        indexed_client.assign_roles([("test_user", "own", "1"), ("test_user", "view", "1"),
+            ("test:user", "view", "1"), ("test_user", "view", "2")], transaction=True)
+        self.assertEqual([("test:user", "view"), ("test_user", "own"), ("test_user", "view")],
+            indexed_client.get_grantees("1"))
+        indexed_client.revoke_role("test_user", "own", "1")
+        self.assertEqual([("test:user", "view"), ("test_user", "view")],
+            indexed_client.get_grantees("1"))
+        self.assertEqual([("test:user", "view"), ("test_user", "view")],
+            indexed_client.revoke_all("1"))
+        self.assertFalse(indexed_client.check_role("test_user", "view", "1"))
+        self.assertFalse(indexed_client.check_role("test:user", "view", "1"))
+        self.assertTrue(indexed_client.check_role("test_user", "view", "2"))
+        self.assertFalse(fake_redis_conn.exists("test_recipes-grantees:1"))
+        self.assertEqual([], indexed_client.revoke_all("1"))
+
+    def test_reverse_index_bitmap(self):
+        indexed_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, reverse_index=True, storage="bitmap",
+            hash_tag_keys=True)
+        indexed_client.assign_roles([("test_user", "own", "1"), ("test_user2", "view", "1")])
+        self.assertEqual([("test_user", "own"), ("test_user2", "view")],
+            indexed_client.revoke_all("1"))
+        self.assertFalse(indexed_client.check_role("test_user", "own", "1"))
+        self.assertFalse(indexed_client.check_role("test_user2", "view", "1"))
+        self.assertEqual([], indexed_client.get_grantees("1"))
+
+    def test_check_and_change_roles(self):
+        indexed_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, reverse_index=True)
+        self.assertFalse(indexed_client.check_and_change_roles("owner", "own", "test_user",
+            ["view", "edit"], "1"))
+        self.assertFalse(indexed_client.check_role("test_user", "view", "1"))
+        indexed_client.assign_role("owner", "own", "1")
+        self.assertTrue(indexed_client.check_and_change_roles("owner", "own", "test_user",
+            ["view", "edit"], "1"))
+        self.assertEqual({"edit": ["1"], "view": ["1"]}, indexed_client.get_roles("test_user"))
+        self.assertIn(("test_user", "edit"), indexed_client.get_grantees("1"))
+        self.assertTrue(indexed_client.check_and_change_roles("owner", "own", "test_user",
+            ["edit"], "1", revoke=True))
+        self.assertFalse(indexed_client.check_role("test_user", "edit", "1"))
+        self.assertEqual([("owner", "own"), ("test_user", "view")], indexed_client.get_grantees("1"))
+
+    def test_check_and_change_roles_bitmap(self):
+        bitmap_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, storage=BitmapStorage(RedisIdMapper()))
+        self.assertFalse(bitmap_client.check_and_change_roles("owner", "own", "test_user",
+            ["view"], "abc", revoke=True))
+        self.assertFalse(bitmap_client.check_and_change_roles("owner", "own", "test_user",
+            ["view"], "abc"))
+        # refused grants on unseen ids do not use up offsets
+        self.assertFalse(fake_redis_conn.exists("{test_recipes}-ids:fwd"))
+        bitmap_client.assign_role("owner", "own", "abc")
+        self.assertTrue(bitmap_client.check_and_change_roles("owner", "own", "test_user",
+            ["view"], "abc"))
+        self.assertTrue(bitmap_client.check_role("test_user", "view", "abc"))
+        self.assertFalse(bitmap_client.check_and_change_roles("test_user", "own", "owner",
+            ["view"], "abc"))
+
+    def test_check_any_role(self):
+        cached_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, decision_cache_size=10,
+            decision_cache_invalidation=False)
+        dn_client.assign_role("test_user", "edit", "1")
+        self.assertTrue(cached_client.check_any_role("test_user", ["view", "edit", "owner"], "1"))
+        self.assertEqual(3, cached_client.get_cache_stats()["size"])
+        self.assertTrue(cached_client.check_any_role("test_user", ["view", "edit", "owner"], "1"))
+        self.assertFalse(cached_client.check_any_role("test_user", ["view", "owner"], "2"))
+        self.assertFalse(dn_client.check_any_role("test_user", ["view", "owner"], "1"))
+        self.assertTrue(dn_client.check_any_role("test_user", ["edit"], "1"))
+
+    def test_check_any_roles_many(self):
+        cached_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, decision_cache_size=100,
+            decision_cache_invalidation=False)
+        dn_client.assign_roles([("test_user", "edit", "1"), ("test_user", "owner", "2"),
+            ("test_user", "view", "3")])
+        expected = {"1": True, "2": True, "3": False, "4": False}
+        for client in (dn_client, cached_client, cached_client):
+            self.assertEqual(expected, client.check_any_roles_many("test_user",
+                ["edit", "owner"], ["1", "2", "3", "4"]))
+        self.assertEqual({"1": False, "3": True}, dn_client.check_any_roles_many("test_user",
+            ["view"], ["1", "3"]))
+        bitmap_client = DeathnutClient(service="test", resource_type="bitmaps",
+            redis_connection=fake_redis_conn, storage="bitmap")
+        bitmap_client.assign_roles([("test_user", "edit", "1"), ("test_user", "owner", "2000")])
+        self.assertEqual({"1": True, "2000": True, "3": False, "x": False},
+            bitmap_client.check_any_roles_many("test_user", ["edit", "owner"],
+            ["1", "2000", "3", "x"]))
+
+    def test_get_resources_any_role(self):
+        for storage in ("hash", "bitmap"):
+            client = DeathnutClient(service="test", resource_type=storage,
+                redis_connection=fake_redis_conn, storage=storage)
+            client.assign_roles([("test_user", "owner", str(i)) for i in range(0, 3000, 2)] +
+                [("test_user", "edit", str(i)) for i in range(0, 30, 3)])
+            edit = [str(i) for i in range(0, 30, 3)]
+            owned = [str(i) for i in range(0, 3000, 2)]
+            ids = client.get_resources_any_role("test_user", ["edit", "owner"])
+            self.assertEqual(set(edit + owned), set(ids))
+            self.assertEqual(len(ids), len(set(ids)))
+            self.assertEqual(sorted(edit), sorted(ids[:len(edit)]))
+            ids = client.get_resources_any_role("test_user", ["edit", "owner"], limit=1500)
+            self.assertEqual(1500, len(set(ids)))
+            self.assertEqual(sorted(edit), sorted(ids[:len(edit)]))
+            self.assertEqual(5, len(client.get_resources_any_role("test_user", ["view", "edit"],
+                limit=5)))
+
+    def test_circuit_breaker(self):
+        server = fakeredis.FakeServer()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+        guarded_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fakeredis.FakeStrictRedis(server=server), circuit_breaker=breaker)
+        guarded_client.assign_role("test_user", "own", "1")
+        server.connected = False
+        for _ in range(2):
+            self.assertRaises(redis.exceptions.ConnectionError, guarded_client.check_role,
+                "test_user", "own", "1")
+        self.assertEqual("open", breaker.state())
+        self.assertRaises(CircuitOpenError, guarded_client.check_role, "test_user", "own", "1")
+        self.assertEqual(1, breaker.stats()["rejected"])
+        server.connected = True
+        time.sleep(0.1)
+        self.assertEqual("half_open", breaker.state())
+        self.assertTrue(guarded_client.check_role("test_user", "own", "1"))
+        self.assertEqual("closed", breaker.state())
+
+    def test_write_behind(self):
+        buffered_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, write_behind=True, write_behind_interval=0.5)
+        buffered_client.assign_role("test_user", "own", "1")
+        buffered_client.assign_roles([("test_user", "view", str(i)) for i in range(10)])
+        buffered_client.revoke_role("test_user", "view", "0")
+        # not written yet, but visible to checks through this client
+        self.assertFalse(dn_client.check_role("test_user", "own", "1"))
+        self.assertTrue(buffered_client.check_role("test_user", "own", "1"))
+        self.assertTrue(buffered_client.check_any_role("test_user", ["edit", "own"], "1"))
+        allowed = buffered_client.check_roles_many("test_user", "view", ["0", "1"])
+        self.assertEqual({"0": False, "1": True}, allowed)
+        self.assertRaises(DeathnutException, buffered_client.assign_role, "Unauthenticated", "own",
+            "1")
+        self.assertTrue(buffered_client.flush(5))
+        self.assertTrue(dn_client.check_role("test_user", "own", "1"))
+        self.assertEqual(sorted(str(i) for i in range(1, 10)),
+            sorted(dn_client.get_resources("test_user", "view")))
+        buffered_client.revoke_role("test_user", "own", "1")
+        buffered_client.close()
+        self.assertFalse(dn_client.check_role("test_user", "own", "1"))
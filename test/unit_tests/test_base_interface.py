@@ -1,10 +1,14 @@
+import base64
+import json
 import time
 import unittest
 import uuid
 from timeit import default_timer as timer
 
 import fakeredis
+import redis
 from deathnut.interface.base_interface import BaseAuthorizationInterface
+from deathnut.util.circuit_breaker import CircuitBreaker, CircuitOpenError
 from deathnut.util.deathnut_exception import DeathnutException
 from deathnut.util.logger import get_deathnut_logger
 
@@ -16,6 +20,9 @@ except ImportError:
 logger = get_deathnut_logger(__name__)
 fake_redis_conn = fakeredis.FakeStrictRedis()
 
+def encode_user(user):
+    return base64.b64encode(json.dumps({"user_id": user}).encode())
+
 def execute_me_on_success(*args, **kwargs):
     return True
 
@@ -73,3 +80,108 @@ class TestRestDeathnutClient(unittest.TestCase):
         end = timer()
         dont_wait_time = int(end - start)
         self.assertGreater(wait_time, dont_wait_time)
+
+    def test_filter_authorized(self):
+        resource_ids = [str(uuid.uuid4()) for _ in range(6)]
+        for rid in resource_ids[1::2]:
+            auth_o.assign_roles(rid, ["view"], deathnut_user="test_user")
+        self.assertEqual(resource_ids[1::2], auth_o.filter_authorized("test_user", "view",
+            iter(resource_ids)))
+        self.assertEqual([], auth_o.filter_authorized("Unauthenticated", "view", resource_ids))
+
+    def test_saturated_executor_runs_serially(self):
+        small_auth_o = TestInterface(service="test", resource_type="resource",
+            redis_connection=fake_redis_conn, executor_max_workers=1, executor_queue_limit=0)
+        random_resource_id = str(uuid.uuid4())
+        small_auth_o.assign_roles(random_resource_id, ["own"], deathnut_user="test_user")
+        blocker = small_auth_o._executor.try_submit(time.sleep, 0.5)
+        self.assertTrue(small_auth_o._execute_if_authorized("test_user", "own", random_resource_id,
+            True, True, True, execute_me_on_success))
+        self.assertRaises(DeathnutException, small_auth_o._execute_if_authorized, "other_user",
+            "own", random_resource_id, True, True, True, execute_me_on_success)
+        metrics = small_auth_o.get_executor_metrics()
+        self.assertEqual(2, metrics["rejected"])
+        self.assertEqual(1, metrics["outstanding"])
+        blocker.result()
+        # done callbacks release the slot right after the result is published
+        while small_auth_o.get_executor_metrics()["outstanding"]:
+            time.sleep(0.01)
+        self.assertTrue(small_auth_o._execute_if_authorized("test_user", "own", random_resource_id,
+            True, True, True, execute_me_on_success))
+        self.assertEqual(2, small_auth_o.get_executor_metrics()["submitted"])
+
+    def test_fetch_accessible_paginated(self):
+        resource_ids = set(str(uuid.uuid4()) for _ in range(30))
+        for rid in resource_ids:
+            auth_o.assign_roles(rid, ["view"], deathnut_user="test_user")
+        @auth_o.fetch_accessible_for_user("view", paginate=True)
+        def list_resources(**kwargs):
+            return kwargs["deathnut_ids"], kwargs["deathnut_cursor"]
+        seen = []
+        with patch.object(auth_o, "get_auth_header", new=lambda *args, **kwargs: encode_user("test_user")):
+            ids, cursor = list_resources(limit=10)
+            seen.extend(ids)
+            while cursor:
+                ids, cursor = list_resources(limit=10, cursor=cursor)
+                seen.extend(ids)
+        self.assertEqual(resource_ids, set(seen))
+
+    def test_role_hierarchy(self):
+        hierarchy_auth_o = TestInterface(service="test", resource_type="resource",
+            redis_connection=fake_redis_conn, decision_cache_size=10,
+            decision_cache_invalidation=False,
+            role_hierarchy={"owner": ["edit"], "edit": ["view"], "admin": ["owner"]})
+        self.assertEqual(["view", "edit", "owner", "admin"],
+            hierarchy_auth_o.qualifying_roles("view"))
+        self.assertEqual(["comment"], hierarchy_auth_o.qualifying_roles("comment"))
+        resource_ids = [str(uuid.uuid4()) for _ in range(3)]
+        hierarchy_auth_o.assign_roles(resource_ids[0], ["owner"], deathnut_user="test_user")
+        hierarchy_auth_o.assign_roles(resource_ids[1], ["view"], deathnut_user="test_user")
+        self.assertTrue(hierarchy_auth_o.is_authorized("test_user", "view", resource_ids[0]))
+        self.assertTrue(hierarchy_auth_o.is_authorized("test_user", "view", resource_ids[0]))
+        self.assertFalse(hierarchy_auth_o.is_authorized("test_user", "edit", resource_ids[1]))
+        self.assertFalse(hierarchy_auth_o.is_authorized("test_user", "view", resource_ids[2]))
+        self.assertFalse(auth_o.is_authorized("test_user", "view", resource_ids[0]))
+        self.assertEqual(resource_ids[:2], hierarchy_auth_o.filter_authorized("test_user", "view",
+            resource_ids))
+        self.assertEqual(sorted(resource_ids[:2]), sorted(hierarchy_auth_o.get_accessible(
+            "test_user", "view")))
+        self.assertEqual(1, len(hierarchy_auth_o.get_accessible("test_user", "view", limit=1)))
+
+    def test_server_timing(self):
+        headers = []
+        timed_auth_o = TestInterface(service="test", resource_type="resource",
+            redis_connection=fake_redis_conn, server_timing=True)
+        timed_auth_o.add_server_timing_header = lambda value, *args, **kwargs: headers.append(value)
+        random_resource_id = str(uuid.uuid4())
+        timed_auth_o.assign_roles(random_resource_id, ["own"], deathnut_user="test_user")
+        @timed_auth_o.requires_role("own")
+        def get_resource(**kwargs):
+            return True
+        with patch.object(timed_auth_o, "get_auth_header", new=lambda *args, **kwargs: encode_user("test_user")), \
+             patch.object(timed_auth_o, "get_resource_id", new=lambda *args, **kwargs: random_resource_id):
+            self.assertTrue(get_resource(dont_wait=False))
+        self.assertEqual(["dn-identity", "dn-redis", "dn-handler"],
+            [entry.split(";")[0] for entry in headers[0].split(", ")])
+
+    def test_outage_policy(self):
+        server = fakeredis.FakeServer()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        guarded_auth_o = TestInterface(service="test", resource_type="resource",
+            redis_connection=fakeredis.FakeStrictRedis(server=server), circuit_breaker=breaker,
+            outage_policy="stale")
+        guarded_auth_o.assign_roles("1", ["own"], deathnut_user="test_user")
+        self.assertTrue(guarded_auth_o.is_authorized("test_user", "own", "1"))
+        self.assertFalse(guarded_auth_o.is_authorized("test_user", "own", "2"))
+        server.connected = False
+        self.assertRaises(redis.exceptions.ConnectionError, guarded_auth_o.is_authorized,
+            "test_user", "own", "1")
+        self.assertTrue(guarded_auth_o.is_authorized("test_user", "own", "1"))
+        self.assertFalse(guarded_auth_o.is_authorized("test_user", "own", "2"))
+        self.assertFalse(guarded_auth_o.is_authorized("test_user", "own", "3"))
+        self.assertTrue(guarded_auth_o.is_authorized("test_user", "own", "3", "allow"))
+        self.assertFalse(guarded_auth_o.is_authorized("test_user", "own", "1", "deny"))
+        self.assertRaises(CircuitOpenError, guarded_auth_o.is_authorized, "test_user", "own", "1",
+            "error")
+        self.assertRaises(DeathnutException, guarded_auth_o.requires_role, "own",
+            outage_policy="maybe")
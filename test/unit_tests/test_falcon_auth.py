@@ -0,0 +1,86 @@
+import unittest
+
+import fakeredis
+import falcon
+import falcon.testing
+from deathnut.interface.falcon.falcon_auth import FalconAuthorization
+from test.unit_tests.conftest import fetch_all_pages, user_headers
+
+try:
+    from apispec import APISpec
+    from apispec.ext.marshmallow import MarshmallowPlugin
+    from falcon_apispec import FalconPlugin
+except ImportError:
+    FalconPlugin = None
+
+fake_redis_conn = fakeredis.FakeStrictRedis()
+
+def create_app(**kwargs):
+    app = falcon.App() if hasattr(falcon, "App") else falcon.API()
+    spec = APISpec(title="test", version="1.0.0", openapi_version="2.0",
+        plugins=[FalconPlugin(app), MarshmallowPlugin()]) if FalconPlugin else None
+    auth_o = FalconAuthorization(app, spec, service="test", resource_type="recipes",
+        redis_connection=fake_redis_conn, role_hierarchy={"own": ["view"]}, **kwargs)
+    class Recipe(object):
+        @auth_o.authentication_required(assign=["own"])
+        def on_post(self, req, resp, **kwargs):
+            resp.media = {"id": kwargs["id"]}
+        @auth_o.requires_role("view")
+        def on_get(self, req, resp, **kwargs):
+            resp.media = {"id": kwargs["id"]}
+    class Recipes(object):
+        @auth_o.fetch_accessible_for_user("view", paginate=True)
+        def on_get(self, req, resp, **kwargs):
+            resp.media = {"ids": kwargs["deathnut_ids"], "cursor": kwargs["deathnut_cursor"]}
+    app.add_route("/recipe/{id}", Recipe())
+    app.add_route("/recipes", Recipes())
+    return auth_o, falcon.testing.TestClient(app)
+
+class TestFalconAuthorization(unittest.TestCase):
+    def setUp(self):
+        fake_redis_conn.flushall()
+        self.auth_o, self.client = create_app()
+
+    def test_allow_deny(self):
+        self.assertEqual(200, self.client.simulate_post("/recipe/1",
+            headers=user_headers("owner"), json={}).status_code)
+        self.assertEqual(200, self.client.simulate_get("/recipe/1",
+            headers=user_headers("owner"), json={}).status_code)
+        denied = self.client.simulate_get("/recipe/1", headers=user_headers("test_user"), json={})
+        self.assertEqual(401, denied.status_code)
+        self.assertEqual({"message": "Not authorized"}, denied.json)
+        self.assertEqual(401, self.client.simulate_get("/recipe/1", json={}).status_code)
+
+    @unittest.skipIf(FalconPlugin is None, "falcon-apispec is not installed")
+    def test_grant_revoke(self):
+        auth_o, client = create_app()
+        auth_endpoint = auth_o.create_auth_endpoint("/auth-recipe")
+        auth_endpoint.allow_grant(requires_role="own", grants_roles=["view"])
+        def grant(calling_user, revoke=False):
+            return client.simulate_post("/auth-recipe", headers=user_headers(calling_user),
+                json={"id": "1", "user": "test_user", "requires": "own", "grants": ["view"],
+                "revoke": revoke})
+        client.simulate_post("/recipe/1", headers=user_headers("owner"), json={})
+        self.assertEqual(401, grant("test_user").status_code)
+        self.assertEqual(200, grant("owner").status_code)
+        self.assertEqual(200, client.simulate_get("/recipe/1", headers=user_headers("test_user"),
+            json={}).status_code)
+        self.assertEqual(200, grant("owner", revoke=True).status_code)
+        self.assertEqual(401, client.simulate_get("/recipe/1", headers=user_headers("test_user"),
+            json={}).status_code)
+
+    def test_pagination(self):
+        resource_ids = [str(i) for i in range(25)]
+        self.auth_o.get_client().assign_roles([("test_user", "view", rid) for rid in resource_ids])
+        seen = fetch_all_pages(lambda cursor: self.client.simulate_get("/recipes",
+            params={"cursor": cursor}, headers=user_headers("test_user")).json)
+        self.assertEqual(sorted(resource_ids), sorted(seen))
+
+    def test_server_timing(self):
+        _, client = create_app(server_timing=True)
+        client.simulate_post("/recipe/1", headers=user_headers("owner"), json={})
+        resp = client.simulate_get("/recipe/1", headers=user_headers("owner"), json={})
+        self.assertEqual(200, resp.status_code)
+        self.assertIn("dn-redis;dur=", resp.headers["Server-Timing"])
+        self.assertNotIn("Server-Timing", self.client.simulate_get("/recipe/1",
+            headers=user_headers("owner"), json={}).headers)
@@ -0,0 +1,154 @@
+import asyncio
+import types
+import unittest
+
+import fakeredis
+from deathnut.client.deathnut_client import DeathnutClient
+from deathnut.interface.fastapi.fastapi_auth import FastapiAuthorization
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from redis.exceptions import ConnectionError
+from starlette.requests import Request
+from test.unit_tests.conftest import fetch_all_pages, user_headers
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+fake_server = fakeredis.FakeServer()
+fake_redis_conn = fakeredis.FakeStrictRedis(server=fake_server)
+
+def create_app(sync=False, **kwargs):
+    app = FastAPI()
+    if not sync:
+        kwargs["async_redis_connection"] = fakeredis.FakeAsyncRedis(server=fake_server)
+    auth_o = FastapiAuthorization(app, service="test", resource_type="recipes",
+        redis_connection=fake_redis_conn, **kwargs)
+    @app.post("/recipe/{id}")
+    @auth_o.authentication_required(assign=["own"])
+    async def create_recipe(id: str, request: Request):
+        return {"id": id}
+    @app.get("/recipe/{id}")
+    @auth_o.requires_role("own")
+    async def get_recipe(id: str, request: Request):
+        return {"id": id}
+    @app.get("/shared/{id}")
+    @auth_o.requires_role("view")
+    async def get_shared_recipe(id: str, request: Request):
+        return {"id": id}
+    @app.get("/recipes")
+    @auth_o.fetch_accessible_for_user("view", paginate=True)
+    async def list_recipes(request: Request):
+        return {"ids": request.deathnut_ids, "cursor": request.deathnut_cursor}
+    auth_endpoint = auth_o.create_auth_endpoint("/auth-recipe")
+    auth_endpoint.allow_grant(requires_role="own", grants_roles=["view"])
+    return auth_o, TestClient(app)
+
+class TestFastapiAuthorization(unittest.TestCase):
+    def setUp(self):
+        fake_redis_conn.flushall()
+
+    def test_client_selection(self):
+        self.assertIsNotNone(create_app()[0].get_async_client())
+        self.assertIsNone(create_app(sync=True)[0].get_async_client())
+
+    def test_allow_deny(self):
+        for sync in (False, True):
+            fake_redis_conn.flushall()
+            _, client = create_app(sync=sync)
+            self.assertEqual(200, client.post("/recipe/1",
+                headers=user_headers("owner")).status_code)
+            self.assertEqual(200, client.get("/recipe/1",
+                headers=user_headers("owner")).status_code)
+            denied = client.get("/recipe/1", headers=user_headers("test_user"))
+            self.assertEqual(401, denied.status_code)
+            self.assertEqual({"message": "Not authorized"}, denied.json())
+            self.assertEqual(401, client.get("/recipe/1").status_code)
+
+    def test_grant_revoke(self):
+        for sync in (False, True):
+            fake_redis_conn.flushall()
+            _, client = create_app(sync=sync)
+            def grant(calling_user, revoke=False):
+                return client.post("/auth-recipe", headers=user_headers(calling_user), json={
+                    "id": "1", "user": "test_user", "requires": "own", "grants": ["view"],
+                    "revoke": revoke})
+            client.post("/recipe/1", headers=user_headers("owner"))
+            self.assertEqual(401, grant("test_user").status_code)
+            self.assertEqual(200, grant("owner").status_code)
+            self.assertEqual(200, client.get("/shared/1",
+                headers=user_headers("test_user")).status_code)
+            self.assertEqual(200, grant("owner", revoke=True).status_code)
+            self.assertEqual(401, client.get("/shared/1",
+                headers=user_headers("test_user")).status_code)
+
+    def test_pagination(self):
+        resource_ids = [str(i) for i in range(25)]
+        for sync in (False, True):
+            fake_redis_conn.flushall()
+            auth_o, client = create_app(sync=sync)
+            auth_o.get_client().assign_roles([("test_user", "view", rid) for rid in resource_ids])
+            seen = fetch_all_pages(lambda cursor: client.get("/recipes",
+                params={"cursor": cursor}, headers=user_headers("test_user")).json())
+            self.assertEqual(sorted(resource_ids), sorted(seen))
+
+    def test_server_timing(self):
+        for sync in (False, True):
+            _, client = create_app(sync=sync, server_timing=True)
+            client.post("/recipe/1", headers=user_headers("owner"))
+            resp = client.get("/recipe/1", headers=user_headers("owner"))
+            self.assertEqual(200, resp.status_code)
+            self.assertIn("dn-redis;dur=", resp.headers["Server-Timing"])
+            self.assertNotIn("Server-Timing", create_app(sync=sync)[1].get("/recipe/1",
+                headers=user_headers("owner")).headers)
+
+    def test_invalid_cursor(self):
+        _, client = create_app()
+        self.assertEqual(400, client.get("/recipes", params={"cursor": "abc"},
+            headers=user_headers("test_user")).status_code)
+
+    def test_dont_wait_cancels_handler(self):
+        auth_o, _ = create_app()
+        finished = []
+        async def handler(request):
+            await asyncio.sleep(0.2)
+            finished.append(request)
+        async def failing_check(*args):
+            raise ConnectionError("redis is down")
+        async def run():
+            with patch.object(auth_o, "is_authorized_async", new=failing_check):
+                with self.assertRaises(ConnectionError):
+                    await auth_o._execute_if_authorized_async("test_user", "own", "1", True,
+                        True, True, handler, types.SimpleNamespace())
+            await asyncio.sleep(0.3)
+        asyncio.run(run())
+        self.assertEqual([], finished)
+
+    def test_sync_only_storage_uses_sync_client(self):
+        auth_o, client = create_app(storage="bitmap")
+        self.assertIsNone(auth_o.get_async_client())
+        self.assertEqual(200, client.post("/recipe/7",
+            headers=user_headers("test_user")).status_code)
+        self.assertEqual(b"string", fake_redis_conn.type("test_recipes:test_user:own"))
+        self.assertEqual(200, client.get("/recipe/7",
+            headers=user_headers("test_user")).status_code)
+        self.assertEqual(401, client.get("/recipe/8",
+            headers=user_headers("test_user")).status_code)
+        self.assertTrue(DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn, storage="bitmap").check_role("test_user", "own", "7"))
+        migrating_auth_o, _ = create_app(storage="hash", migrate_from="set")
+        self.assertIsNone(migrating_auth_o.get_async_client())
+        hash_auth_o, _ = create_app(storage="hash")
+        self.assertIsNotNone(hash_auth_o.get_async_client())
+
+    def test_sync_only_options_use_sync_client(self):
+        auth_o, client = create_app(write_behind=True)
+        self.assertIsNone(auth_o.get_async_client())
+        self.assertEqual(200, client.post("/recipe/1",
+            headers=user_headers("test_user")).status_code)
+        self.assertTrue(auth_o.get_client().flush(5))
+        self.assertTrue(fake_redis_conn.hget("test_recipes:test_user:own", "1"))
+        for option in ({"decision_cache_size": 10, "decision_cache_invalidation": False},
+                {"redis_replicas": [fake_redis_conn]}, {"read_your_writes": 2.0}):
+            self.assertIsNone(create_app(**option)[0].get_async_client())
@@ -0,0 +1,73 @@
+import unittest
+
+import fakeredis
+from deathnut.interface.flask.flask_apispec import FlaskAPISpecAuthorization
+from flask import Flask
+from test.unit_tests.conftest import fetch_all_pages, user_headers
+
+fake_redis_conn = fakeredis.FakeStrictRedis()
+
+def create_app(**kwargs):
+    app = Flask(__name__)
+    auth_o = FlaskAPISpecAuthorization(app, service="test", resource_type="recipes",
+        redis_connection=fake_redis_conn, **kwargs)
+    auth_endpoint = auth_o.create_auth_endpoint("/auth-recipe")
+    auth_endpoint.allow_grant(requires_role="own", grants_roles=["view"])
+    @app.route("/recipe/<id>", methods=("POST",))
+    @auth_o.authentication_required(assign=["own"])
+    def create_recipe(id, **kwargs):
+        return {"id": id}, 200
+    @app.route("/recipe/<id>")
+    @auth_o.requires_role("view")
+    def get_recipe(id, **kwargs):
+        return {"id": id}, 200
+    @app.route("/recipes")
+    @auth_o.fetch_accessible_for_user("view", paginate=True)
+    def list_recipes(**kwargs):
+        return {"ids": kwargs["deathnut_ids"], "cursor": kwargs["deathnut_cursor"]}, 200
+    return auth_o, app.test_client()
+
+class TestFlaskAPISpecAuthorization(unittest.TestCase):
+    def setUp(self):
+        fake_redis_conn.flushall()
+        self.auth_o, self.client = create_app(role_hierarchy={"own": ["view"]})
+
+    def grant(self, calling_user, user, revoke=False):
+        return self.client.post("/auth-recipe", headers=user_headers(calling_user), json={"id": "1",
+            "user": user, "requires": "own", "grants": ["view"], "revoke": revoke})
+
+    def test_allow_deny(self):
+        self.assertEqual(200, self.client.post("/recipe/1", headers=user_headers("owner"),
+            json={}).status_code)
+        self.assertEqual(200, self.client.get("/recipe/1", headers=user_headers("owner"),
+            json={}).status_code)
+        denied = self.client.get("/recipe/1", headers=user_headers("test_user"), json={})
+        self.assertEqual(401, denied.status_code)
+        self.assertEqual({"message": "Not authorized"}, denied.get_json())
+        self.assertEqual(401, self.client.get("/recipe/1", json={}).status_code)
+
+    def test_grant_revoke(self):
+        self.client.post("/recipe/1", headers=user_headers("owner"), json={})
+        self.assertEqual(401, self.grant("test_user", "other_user").status_code)
+        self.assertEqual(200, self.grant("owner", "test_user").status_code)
+        self.assertEqual(200, self.client.get("/recipe/1", headers=user_headers("test_user"),
+            json={}).status_code)
+        self.assertEqual(200, self.grant("owner", "test_user", revoke=True).status_code)
+        self.assertEqual(401, self.client.get("/recipe/1", headers=user_headers("test_user"),
+            json={}).status_code)
+
+    def test_pagination(self):
+        resource_ids = [str(i) for i in range(25)]
+        self.auth_o.get_client().assign_roles([("test_user", "view", rid) for rid in resource_ids])
+        seen = fetch_all_pages(lambda cursor: self.client.get("/recipes",
+            query_string={"cursor": cursor}, headers=user_headers("test_user"), json={}).get_json())
+        self.assertEqual(sorted(resource_ids), sorted(seen))
+
+    def test_server_timing(self):
+        _, client = create_app(server_timing=True, role_hierarchy={"own": ["view"]})
+        client.post("/recipe/1", headers=user_headers("owner"), json={})
+        resp = client.get("/recipe/1", headers=user_headers("owner"), json={})
+        self.assertEqual(200, resp.status_code)
+        self.assertIn("dn-redis;dur=", resp.headers["Server-Timing"])
+        self.assertNotIn("Server-Timing", self.client.get("/recipe/1",
+            headers=user_headers("owner"), json={}).headers)
@@ -0,0 +1,32 @@
+import base64
+import json
+import unittest
+
+from deathnut.util import jwt
+
+
+def encode(payload):
+    return base64.b64encode(json.dumps(payload).encode())
+
+class TestJwt(unittest.TestCase):
+    def tearDown(self):
+        jwt.set_user_extractor(jwt.make_user_extractor())
+
+    def test_get_user_from_jwt_header(self):
+        self.assertEqual("Unauthenticated", jwt.get_user_from_jwt_header(""))
+        self.assertEqual("alice", jwt.get_user_from_jwt_header(encode({"user_id": "alice"})))
+        firebase_header = encode({"claims": json.dumps({"user_id": "bob"})})
+        self.assertEqual("bob", jwt.get_user_from_jwt_header(firebase_header))
+
+    def test_user_is_cached(self):
+        calls = []
+        def counting_loads(value):
+            calls.append(value)
+            return json.loads(value)
+        jwt.set_user_extractor(jwt.make_user_extractor(counting_loads))
+        header = encode({"user_id": "carol"})
+        hits = jwt.get_user_cache_stats()["hits"]
+        for _ in range(5):
+            self.assertEqual("carol", jwt.get_user_from_jwt_header(header))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(hits + 4, jwt.get_user_cache_stats()["hits"])
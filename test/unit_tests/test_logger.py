@@ -0,0 +1,38 @@
+import logging
+import unittest
+
+from deathnut.util.logger import RateLimitedLogger, configure_logging, get_deathnut_logger
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestLogger(unittest.TestCase):
+    def tearDown(self):
+        configure_logging()
+
+    def test_queued_handler(self):
+        handler = ListHandler()
+        configure_logging(handler=handler)
+        get_deathnut_logger("deathnut.test").warning("Assigning %d role(s)", 3)
+        get_deathnut_logger("deathnut.test").debug("not logged")
+        configure_logging()
+        self.assertEqual(["Assigning 3 role(s)"], handler.messages)
+
+    def test_rate_limited(self):
+        handler = ListHandler()
+        configure_logging(handler=handler)
+        throttled = RateLimitedLogger(get_deathnut_logger("deathnut.test"), interval=0.05)
+        for _ in range(5):
+            throttled.warning("Authorization is not enabled")
+        throttled._last["Authorization is not enabled"] -= 1
+        throttled.warning("Authorization is not enabled")
+        configure_logging()
+        self.assertEqual(["Authorization is not enabled",
+            "Authorization is not enabled (4 similar messages suppressed)"], handler.messages)
@@ -0,0 +1,93 @@
+import threading
+import time
+import unittest
+import uuid
+
+import fakeredis
+from deathnut.client.deathnut_client import DeathnutClient
+from deathnut.util.deathnut_exception import DeathnutException
+from deathnut.util.metrics import PrometheusMetrics
+from test.unit_tests.conftest import StubInterface
+
+fake_redis_conn = fakeredis.FakeStrictRedis()
+
+started = threading.Event()
+
+def slow_getter(*args, **kwargs):
+    started.set()
+    time.sleep(0.1)
+    return True
+
+class TestInterface(StubInterface):
+    def is_authorized(self, user, role, resource_id, outage_policy=None):
+        # decide only once the speculative handler runs, so it cannot be cancelled
+        started.wait(1)
+        return super(TestInterface, self).is_authorized(user, role, resource_id, outage_policy)
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        fake_redis_conn.flushall()
+
+    def test_render(self):
+        metrics = PrometheusMetrics(buckets=(0.1, 1))
+        metrics.observe("op_seconds", 0.05, operation="check")
+        metrics.observe("op_seconds", 0.5, operation="check")
+        metrics.increment("decisions_total", result='a"b')
+        metrics.register_gauge("depth", lambda: 3)
+        metrics.register_gauge("ratio", lambda: None)
+        self.assertEqual("\n".join([
+            '# TYPE op_seconds histogram',
+            'op_seconds_bucket{operation="check",le="0.1"} 1',
+            'op_seconds_bucket{operation="check",le="1"} 2',
+            'op_seconds_bucket{operation="check",le="+Inf"} 2',
+            'op_seconds_sum{operation="check"} 0.55',
+            'op_seconds_count{operation="check"} 2',
+            '# TYPE decisions_total counter',
+            'decisions_total{result="a\\"b"} 1',
+            '# TYPE depth gauge',
+            'depth 3']) + "\n", metrics.render())
+
+    def test_client_latency(self):
+        metrics = PrometheusMetrics()
+        client = DeathnutClient(service="test", redis_connection=fake_redis_conn, metrics=metrics)
+        client.assign_role("test_user", "own", "1")
+        client.check_role("test_user", "own", "1")
+        client.check_any_role("test_user", ["own"], "1")
+        client.get_resources("test_user", "own", limit=10)
+        other_client = DeathnutClient(service="other", redis_connection=fake_redis_conn,
+            metrics=metrics)
+        other_client.check_role("test_user", "own", "1")
+        self.assertEqual(1, metrics.get_count("deathnut_operation_seconds", operation="assign",
+            service="test"))
+        self.assertEqual(2, metrics.get_count("deathnut_operation_seconds", operation="check",
+            service="test"))
+        self.assertEqual(1, metrics.get_count("deathnut_operation_seconds", operation="check",
+            service="other"))
+        self.assertEqual(1, metrics.get_count("deathnut_operation_seconds",
+            operation="get_resources", service="test"))
+
+    def test_interface_decisions(self):
+        metrics = PrometheusMetrics()
+        auth_o = TestInterface(service="test", resource_type="resource",
+            redis_connection=fake_redis_conn, metrics=metrics)
+        random_resource_id = str(uuid.uuid4())
+        auth_o.assign_roles(random_resource_id, ["own"], deathnut_user="test_user")
+        started.set()
+        self.assertTrue(auth_o._execute_if_authorized("test_user", "own", random_resource_id,
+            True, True, False, slow_getter))
+        started.clear()
+        self.assertRaises(DeathnutException, auth_o._execute_if_authorized, "other_user", "own",
+            random_resource_id, True, True, True, slow_getter)
+        self.assertEqual(1, metrics.get_count("deathnut_authorization_total", result="allow",
+            service="test_resource"))
+        self.assertEqual(1, metrics.get_count("deathnut_authorization_total", result="deny",
+            service="test_resource"))
+        self.assertEqual(1, metrics.get_count("deathnut_speculative_wasted_total",
+            service="test_resource"))
+        TestInterface(service="test", resource_type="other", redis_connection=fake_redis_conn,
+            metrics=metrics)
+        rendered = metrics.render()
+        self.assertIn('deathnut_executor_queue_depth{service="test_resource"} 0', rendered)
+        for service in ("test_resource", "test_other"):
+            self.assertIn('deathnut_user_cache_hit_ratio{{service="{}"}}'.format(service),
+                rendered)
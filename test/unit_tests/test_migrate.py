@@ -0,0 +1,73 @@
+import unittest
+
+import fakeredis
+from deathnut.client.deathnut_client import DeathnutClient
+from deathnut.tools.migrate import LayoutMigrator
+
+fake_redis_conn = fakeredis.FakeStrictRedis()
+
+
+class TestLayoutMigrator(unittest.TestCase):
+    def setUp(self):
+        fake_redis_conn.flushall()
+
+    def test_set_to_hash(self):
+        legacy_client = DeathnutClient(service="test", resource_type="recipes", storage="set",
+            redis_connection=fake_redis_conn)
+        for i in range(30):
+            legacy_client.assign_roles([("user{}".format(i), "own", str(j)) for j in range(5)])
+        client = DeathnutClient(service="test", resource_type="recipes", storage="hash",
+            migrate_from="set", redis_connection=fake_redis_conn)
+        migrator = LayoutMigrator(client, "set", "hash", batch_size=10)
+        stats = migrator.run(max_batches=1)
+        while not stats["converted"]:
+            stats = migrator.run(max_batches=1)
+        self.assertFalse(stats["done"])
+        self.assertTrue(fake_redis_conn.exists("test_recipes-migration:set->hash"))
+        # both layouts are live, reads and writes go to each key's current layout
+        types = set(fake_redis_conn.type("test_recipes:user{}:own".format(i)) for i in range(30))
+        self.assertEqual({b"set", b"hash"}, types)
+        for i in range(30):
+            user = "user{}".format(i)
+            self.assertTrue(client.check_role(user, "own", "4"))
+            self.assertFalse(client.check_role(user, "own", "5"))
+            self.assertTrue(client.check_any_role(user, ["view", "own"], "3"))
+            self.assertEqual({"1": True, "9": False}, client.check_roles_many(user, "own",
+                ["1", "9"]))
+            client.revoke_role(user, "own", "0")
+            self.assertEqual(["1", "2", "3", "4"], sorted(client.get_resources(user, "own")))
+            self.assertEqual({"own": ["1", "2", "3", "4"]}, dict((role, sorted(ids))
+                for role, ids in client.get_roles(user).items()))
+        self.assertTrue(client.check_and_change_roles("user0", "own", "user1", ["view"], "1"))
+        stats = LayoutMigrator(client, "set", "hash", batch_size=10).run()
+        self.assertTrue(stats["done"])
+        self.assertFalse(fake_redis_conn.exists("test_recipes-migration:set->hash"))
+        migrated_client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn)
+        for i in range(30):
+            self.assertEqual(b"hash", fake_redis_conn.type("test_recipes:user{}:own".format(i)))
+            self.assertEqual(["1", "2", "3", "4"], sorted(migrated_client.get_resources(
+                "user{}".format(i), "own")))
+        self.assertTrue(migrated_client.check_role("user1", "view", "1"))
+
+    def test_hash_to_bitmap(self):
+        client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn)
+        client.assign_roles([("test_user", "own", str(i)) for i in range(0, 100, 7)])
+        self.assertEqual(1, LayoutMigrator(client, "hash", "bitmap").run()["converted"])
+        bitmap_client = DeathnutClient(service="test", resource_type="recipes", storage="bitmap",
+            redis_connection=fake_redis_conn)
+        self.assertEqual([str(i) for i in range(0, 100, 7)], bitmap_client.get_resources(
+            "test_user", "own"))
+
+    def test_skips_unconvertible_keys(self):
+        client = DeathnutClient(service="test", resource_type="recipes",
+            redis_connection=fake_redis_conn)
+        client.assign_roles([("bad_user", "own", "not-an-int"), ("bad_user", "view", str(2 ** 30)),
+            ("test_user", "own", "1")])
+        stats = LayoutMigrator(client, "hash", "bitmap", batch_size=1).run()
+        self.assertEqual((3, 1, 2, True), (stats["scanned"], stats["converted"], stats["skipped"],
+            stats["done"]))
+        self.assertEqual(b"hash", fake_redis_conn.type("test_recipes:bad_user:own"))
+        self.assertEqual(b"string", fake_redis_conn.type("test_recipes:test_user:own"))
+        self.assertFalse(fake_redis_conn.exists("test_recipes-migration:hash->bitmap"))
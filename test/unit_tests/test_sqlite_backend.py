@@ -0,0 +1,73 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+from deathnut.client.backend import DeathnutBackend
+from deathnut.client.sqlite_backend import SqliteDeathnutClient
+from deathnut.tools.acl import export_grants, import_grants
+from deathnut.util.deathnut_exception import DeathnutException
+from test.unit_tests.conftest import StubInterface
+
+
+class TestSqliteDeathnutClient(unittest.TestCase):
+    def setUp(self):
+        self.dn_client = SqliteDeathnutClient(service="test", resource_type="recipes")
+
+    def test_assign_check_revoke(self):
+        self.assertIsInstance(self.dn_client, DeathnutBackend)
+        random_resource_id = str(uuid.uuid4())
+        self.assertFalse(self.dn_client.check_role("test_user", "own", random_resource_id))
+        self.dn_client.assign_role("test_user", "own", random_resource_id)
+        self.assertTrue(self.dn_client.check_role("test_user", "own", random_resource_id))
+        self.assertTrue(self.dn_client.check_any_role("test_user", ["view", "own"],
+            random_resource_id))
+        self.dn_client.revoke_role("test_user", "own", random_resource_id)
+        self.assertFalse(self.dn_client.check_role("test_user", "own", random_resource_id))
+        self.assertRaises(DeathnutException, self.dn_client.assign_role, "Unauthenticated", "own",
+            random_resource_id)
+
+    def test_bulk_and_listing(self):
+        resource_ids = [str(i) for i in range(1200)]
+        self.dn_client.assign_roles([("test_user", "view", rid) for rid in resource_ids])
+        self.dn_client.revoke_roles([("test_user", "view", "0")])
+        allowed = self.dn_client.check_roles_many("test_user", "view", resource_ids)
+        self.assertFalse(allowed["0"])
+        self.assertTrue(all(allowed[rid] for rid in resource_ids[1:]))
+        self.assertEqual(resource_ids[1:], self.dn_client.get_resources("test_user", "view"))
+        self.assertEqual(10, len(self.dn_client.get_resources("test_user", "view", limit=10)))
+        pages = list(self.dn_client.get_resources_page("test_user", "view", page_size=500))
+        self.assertEqual(resource_ids[1:], [rid for page in pages for rid in page])
+        self.assertEqual(["view"], list(self.dn_client.get_roles("test_user")))
+
+    def test_grantees_and_check_and_change(self):
+        self.assertFalse(self.dn_client.check_and_change_roles("owner", "own", "test_user",
+            ["view"], "1"))
+        self.dn_client.assign_role("owner", "own", "1")
+        self.assertTrue(self.dn_client.check_and_change_roles("owner", "own", "test_user",
+            ["view", "edit"], "1"))
+        self.assertEqual([("owner", "own"), ("test_user", "edit"), ("test_user", "view")],
+            self.dn_client.get_grantees("1"))
+        self.assertEqual(3, len(self.dn_client.revoke_all("1")))
+        self.assertFalse(self.dn_client.check_role("test_user", "view", "1"))
+
+    def test_interface_and_tools(self):
+        auth_o = StubInterface(service="test", resource_type="recipes", backend=self.dn_client,
+            role_hierarchy={"own": ["view"]})
+        auth_o.assign_roles("1", ["own"], deathnut_user="test_user")
+        self.assertTrue(auth_o.is_authorized("test_user", "view", "1"))
+        self.assertEqual(["1"], auth_o.filter_authorized("test_user", "view", ["1", "2"]))
+        self.assertEqual(["1"], auth_o.get_accessible("test_user", "view"))
+        out = io.StringIO()
+        self.assertEqual(1, export_grants(self.dn_client, out))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            file_client = SqliteDeathnutClient(service="test", resource_type="recipes",
+                path=os.path.join(tmp_dir, "deathnut.db"))
+            self.assertEqual(1, import_grants(file_client, io.StringIO(out.getvalue())))
+            self.assertTrue(file_client.check_role("test_user", "own", "1"))
+            file_client.close()
+        finally:
+            shutil.rmtree(tmp_dir)